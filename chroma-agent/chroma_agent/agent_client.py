@@ -11,8 +11,11 @@ import threading
 import traceback
 import datetime
 import sys
+import zlib
 from chroma_agent.plugin_manager import DevicePluginMessageCollection, DevicePluginMessage, PRIO_HIGH
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from chroma_agent import version
 from chroma_agent.log import daemon_log, console_log, logging_in_debug_mode
 from chroma_agent.chroma_common.lib.date_time import IMLDateTime
@@ -25,10 +28,34 @@ MAX_SESSION_BACKOFF = datetime.timedelta(seconds = 60)
 
 GET_REQUEST_TIMEOUT = 60.0
 
+# POSTs are gzipped at this level once the manager advertises that it accepts them
+POST_COMPRESSION_LEVEL = 1
+
+
+def encode_post_body(body, compress):
+    """Return a JSON POST body as it is sent, gzipped if compress is set"""
+    if compress:
+        compressor = zlib.compressobj(POST_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    else:
+        return body
+
 # FIXME: this file needs a concurrency review pass
 
 
 class CryptoClient(object):
+    """HTTPS client authenticating with the server's certificate.
+
+    Requests are made on a keep-alive session for each method, i.e. one for the GETs
+    from HttpReader and one for the POSTs from HttpWriter, so that each direction keeps
+    its connection (and TLS session) to the manager rather than reconnecting for every
+    request.  After an error the method's session is discarded, so that the next request
+    reconnects.
+
+    Responses are gzipped by the manager when it chooses to (requests decodes them), and
+    POST bodies are gzipped once a response from the manager has advertised that it
+    accepts them with an Accept-Encoding header.
+    """
     def __init__(self, url, crypto, fqdn=None):
         self.url = url
         self._crypto = crypto
@@ -36,24 +63,97 @@ class CryptoClient(object):
         if not self.fqdn:
             self.fqdn = socket.getfqdn()
 
+        self._sessions = {}
+        self._sessions_cert = None
+        self._sessions_used = set()
+        self._sessions_lock = threading.Lock()
+
+        self.compress_posts = False
+
     def get(self, **kwargs):
         kwargs['timeout'] = GET_REQUEST_TIMEOUT
         return self.request('get', **kwargs)
 
-    def post(self, data, **kwargs):
-        return self.request('post', data = json.dumps(data), **kwargs)
+    def post(self, data, encoded = None, **kwargs):
+        """POST data, or the PostBody `encoded` from it if given, which saves encoding it again"""
+        if encoded is None:
+            compress = self.compress_posts
+            body = encode_post_body(json.dumps(data), compress)
+        else:
+            compress = encoded.compressed
+            body = encoded.finish()
+        if compress:
+            kwargs['headers'] = {'Content-Encoding': 'gzip'}
+        return self.request('post', data = body, **kwargs)
+
+    def _get_session(self, method, cert):
+        with self._sessions_lock:
+            if cert != self._sessions_cert:
+                # Connections made with another certificate (e.g. before registering) are no use
+                for session in self._sessions.values():
+                    session.close()
+                self._sessions.clear()
+                self._sessions_used.clear()
+                self._sessions_cert = cert
+
+            try:
+                return self._sessions[method]
+            except KeyError:
+                session = requests.Session()
+                session.cert = cert
+                # FIXME: set verify to true if we have a CA bundle
+                session.verify = False
+                session.headers.update({"Content-Type": "application/json"})
+                # Retry once if a connection cannot be made, which is before anything is sent,
+                # but only retry a GET if the connection fails after the request was sent: the
+                # manager may already have received a POST, and would handle it twice.
+                adapter = HTTPAdapter(max_retries = Retry(total = 1, method_whitelist = ['GET']))
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[method] = session
+                return session
+
+    def _reset_session(self, method):
+        with self._sessions_lock:
+            session = self._sessions.pop(method, None)
+            self._sessions_used.discard(method)
+        if session:
+            session.close()
+
+    def _send(self, method, cert, **kwargs):
+        session = self._get_session(method, cert)
+        try:
+            response = session.request(method, self.url, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            with self._sessions_lock:
+                was_used = method in self._sessions_used
+            self._reset_session(method)
+            if not was_used or method != 'get':
+                # A POST which failed may still have reached the manager, so is not sent again
+                raise
+
+            # The manager may have closed the idle connection before receiving this
+            # request: try again on a new session, which is only tried once because
+            # it has not been used.
+            daemon_log.info("Reconnecting to %s after %s" % (self.url, e))
+            return self._send(method, cert, **kwargs)
+        except Exception:
+            self._reset_session(method)
+            raise
+
+        with self._sessions_lock:
+            self._sessions_used.add(method)
+        return response
 
     def request(self, method, **kwargs):
         cert, key = self._crypto.certificate_file, self._crypto.private_key_file
         if cert:
-            kwargs['cert'] = (cert, key)
+            cert = (cert, key)
+        else:
+            cert = None
 
         try:
-            response = requests.request(method, self.url,
-                # FIXME: set verify to true if we have a CA bundle
-                verify = False,
-                headers = {"Content-Type": "application/json"},
-                **kwargs)
+            response = self._send(method, cert, **kwargs)
         except (socket.error,
                 requests.exceptions.ConnectionError,
                 requests.exceptions.ReadTimeout,
@@ -74,8 +174,12 @@ class CryptoClient(object):
         if not response.ok:
             daemon_log.error("Bad status %s from %s to %s" % (response.status_code, method, self.url))
             if response.status_code == 413:
-                daemon_log.error("Oversized request: %s" % json.dumps(kwargs, indent=2))
+                daemon_log.error("Oversized request: %s bytes%s" % (len(kwargs.get('data') or ''), " (gzipped)" if kwargs.get('headers', {}).get('Content-Encoding') == 'gzip' else ""))
             raise HttpError()
+
+        if not self.compress_posts and 'gzip' in response.headers.get('Accept-Encoding', ''):
+            daemon_log.info("Compressing messages to %s" % self.url)
+            self.compress_posts = True
         try:
             return response.json()
         except ValueError:
@@ -300,6 +404,87 @@ class ExceptionCatchingThread(threading.Thread):
             sys.exit(-1)
 
 
+class PostBody(object):
+    """The body of a POST of messages, assembled from messages which have each been
+    encoded to JSON once, and gzipped as it goes if `compress` is set.
+
+    `add` refuses a message which would take the body over `limit` bytes as sent,
+    except for the first, which is marked `oversized` instead.
+    """
+
+    def __init__(self, envelope, compress, limit):
+        self.compressed = compress
+        self.limit = limit
+        self.count = 0
+        self.oversized = False
+
+        self._chunks = []
+        self._length = 0        # Bytes of body output so far
+        self._pending = 0       # Bytes input to the compressor since its output was last flushed
+        self._compressor = zlib.compressobj(POST_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+
+        # The other fields of the envelope follow the messages
+        self._tail = '], ' + json.dumps(envelope)[1:] if envelope else ']}'
+        self._write('{"messages": [')
+
+    def _write(self, data):
+        if self._compressor:
+            self._pending += len(data)
+            data = self._compressor.compress(data)
+        self._chunks.append(data)
+        self._length += len(data)
+
+    def _bounded(self, data):
+        """Return True if the body is certain to fit with data added"""
+        remaining = len(data) + len(self._tail)
+        if not self._compressor:
+            return self._length + remaining <= self.limit
+
+        # Deflate never expands its input by more than a few bytes per 16KiB block, plus
+        # the gzip header and trailer
+        remaining += self._pending
+        return self._length + remaining + remaining / 1024 + 64 <= self.limit
+
+    def _add_compressed(self, data):
+        """Close to the limit: compress data on a copy of the compressor, flushed so that its
+        length is exact, and keep the copy if the body still fits"""
+        compressor = self._compressor.copy()
+        compressed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        end = compressor.copy()
+        if self._length + len(compressed) + len(end.compress(self._tail)) + len(end.flush()) > self.limit:
+            return False
+
+        self._compressor = compressor
+        self._chunks.append(compressed)
+        self._length += len(compressed)
+        self._pending = 0
+        return True
+
+    def add(self, fragment):
+        """Add a message encoded as JSON, return False if it does not fit"""
+        data = ', ' + fragment if self.count else fragment
+        if self._bounded(data):
+            self._write(data)
+        elif not (self._compressor and self._add_compressed(data)):
+            if self.count:
+                return False
+            self.oversized = True
+            self._write(data)
+
+        self.count += 1
+        return True
+
+    def finish(self):
+        """Return the complete body"""
+        if self._tail is not None:
+            self._write(self._tail)
+            if self._compressor:
+                self._chunks.append(self._compressor.flush())
+                self._length += len(self._chunks[-1])
+            self._tail = None
+        return ''.join(self._chunks)
+
+
 class HttpWriter(ExceptionCatchingThread):
     """Send messages to the manager, and handle control messages received in response"""
 
@@ -366,7 +551,10 @@ class HttpWriter(ExceptionCatchingThread):
         # Any message we drop will need its session killed
         kill_sessions = set()
 
-        messages_bytes = len(json.dumps(post_envelope))
+        # Each message is encoded once, into the body as it will be sent, so that
+        # MAX_BYTES_PER_POST applies to the (compressed) bytes actually POSTed
+        body = PostBody(dict((k, v) for k, v in post_envelope.items() if k != 'messages'),
+                        self._client.compress_posts, MAX_BYTES_PER_POST)
         while True:
             try:
                 message = self._retry_messages.get_nowait()
@@ -380,28 +568,28 @@ class HttpWriter(ExceptionCatchingThread):
 
             if message.callback:
                 completion_callbacks.append(message.callback)
-            message_length = len(json.dumps(message.dump(self._client._fqdn)))
+            dumped = message.dump(self._client._fqdn)
+            fragment = json.dumps(dumped)
 
-            if message_length > MAX_BYTES_PER_POST:
-                daemon_log.warning("Oversized message %s/%s: %s" % (message_length, MAX_BYTES_PER_POST, message.dump(self._client._fqdn)))
-
-            if messages and message_length > MAX_BYTES_PER_POST - messages_bytes:
+            if not body.add(fragment):
                 # This message will not fit into this POST: pop it back into the queue
                 daemon_log.info(
-                    "HttpWriter message %s overflowed POST %s/%s (%d "
+                    "HttpWriter message %s/%s/%s overflowed POST %s/%s (%d "
                     "messages), enqueuing" % (
-                    message.dump(self._client._fqdn), message_length,
+                    message.type, message.plugin_name, message.session_id, len(fragment),
                     MAX_BYTES_PER_POST, len(messages)))
                 self._retry_messages.put(message)
                 break
 
+            if body.oversized:
+                daemon_log.warning("Oversized message %s/%s: %s" % (len(fragment), MAX_BYTES_PER_POST, fragment))
+
             messages.append(message)
-            messages_bytes += message_length
+            post_envelope['messages'].append(dumped)
 
         daemon_log.debug("HttpWriter sending %s messages" % len(messages))
         try:
-            post_envelope['messages'] = [m.dump(self._client._fqdn) for m in messages]
-            self._client.post(post_envelope)
+            self._client.post(post_envelope, encoded = body)
         except HttpError:
             daemon_log.warning("HttpWriter: request failed")
             # Terminate any sessions which we've just droppped messages for
@@ -103,7 +103,8 @@ def scan_packages():
 
 
 class LustrePlugin(DevicePlugin):
-    delta_fields = ['capabilities', 'properties', 'mounts', 'packages', 'resource_locations']
+    # Sent with every scan rather than patched
+    unversioned_fields = ['started_at']
 
     def __init__(self, session):
         self.reset_state()
@@ -190,7 +191,6 @@ class LustrePlugin(DevicePlugin):
         else:
             packages = None
 
-        # FIXME: HYD-1095 we should be sending a delta instead of a full dump every time
         # FIXME: At this time the 'capabilities' attribute is unused on the manager
         return {
             "started_at": started_at,
@@ -206,7 +206,7 @@ class LustrePlugin(DevicePlugin):
     def start_session(self):
         self.reset_state()
         self._reset_delta()
-        return self._delta_result(self._scan(initial=True), self.delta_fields)
+        return self._patch_result(self._scan(initial=True), self.unversioned_fields)
 
     def update_session(self):
-        return self._delta_result(self._scan(), self.delta_fields)
+        return self._patch_result(self._scan(), self.unversioned_fields)
@@ -10,6 +10,7 @@ import collections
 
 from chroma_agent.log import daemon_log
 from chroma_agent.chroma_common.lib.agent_rpc import agent_error
+from chroma_agent.chroma_common.lib import delta
 
 EXCLUDED_PLUGINS = []
 
@@ -172,9 +173,38 @@ class DevicePlugin(object):
 
         return result if result else None                       # Turn {} into None, None will mean no message sent.
 
+    def _patch_result(self, result, unversioned_fields = None):
+        """
+        Return result as a patch (see chroma_common.lib.delta) against the previous result,
+        or whole at the start of a session, every FAILSAFEDUPDATE cycles and when an update
+        is triggered so that the receiver can resynchronise.
+
+        Each result is numbered by 'version', and a patch gives the 'base_version' it
+        applies to.  unversioned_fields are sent as they are rather than patched.
+        """
+        self._version += 1
+        message = {'version': self._version}
+        for key in unversioned_fields or []:
+            message[key] = result.pop(key)
+
+        if (self._baseline is not None and self._safety_send < DevicePlugin.FAILSAFEDUPDATE and
+                self.trigger_plugin_update is False):
+            self._safety_send += 1
+            message['base_version'] = self._version - 1
+            message['patch'] = delta.diff(self._baseline, result) or {}
+        else:
+            self._safety_send = 0
+            self.trigger_plugin_update = False
+            message.update(result)
+
+        self._baseline = result
+        return message
+
     def _reset_delta(self):
         self.last_result = collections.defaultdict(lambda: None)
         self._safety_send = 0
+        self._baseline = None
+        self._version = 0
 
 
 # For use with Queue.PriorityQueue (lower number is higher priority)
@@ -1,6 +1,8 @@
 import unittest
 import os
-from chroma_agent.device_plugins.audit.lustre import ObdfilterAudit
+import glob
+from tablib.packages import yaml
+from chroma_agent.device_plugins.audit.lustre import ObdfilterAudit, parse_job_stats
 
 from tests.test_utils import PatchedContextTestCase
 
@@ -16,6 +18,31 @@ class TestObdfilterAudit(PatchedContextTestCase):
         assert ObdfilterAudit.is_available()
 
 
+class TestObdfilterAuditJobStatsFile(PatchedContextTestCase):
+    def setUp(self):
+        tests = os.path.join(os.path.dirname(__file__), '..')
+        self.test_root = os.path.join(tests, "data/lustre_versions/2.7/oss")
+        super(TestObdfilterAuditJobStatsFile, self).setUp()
+        self.audit = ObdfilterAudit()
+
+    def test_job_stats_parsed(self):
+        """The job_stats parser reads job_stats files as yaml does"""
+        for path in glob.glob(os.path.join(self.test_root, '../../*/oss/proc/fs/lustre/obdfilter/*/job_stats')):
+            text = open(path).read()
+            self.assertEqual(parse_job_stats(text), yaml.load(text).get('job_stats') or [], path)
+
+        stats = self.audit._read_job_stats_yaml_file('lustre-OST0000')
+        self.assertEqual([stat['job_id'] for stat in stats], ['cp.0', 'dd.0'])
+        self.assertEqual(stats[1]['read_bytes'], {'samples': 662, 'unit': 'bytes', 'min': 106496, 'max': 1048576, 'sum': 671088640})
+
+    def test_job_stats_unexpected(self):
+        """Anything which the job_stats parser might not read as yaml does is refused, to be left to yaml"""
+        for job_id in ["'quoted'", 'yes', '1.5', '012', '']:
+            self.assertRaises(ValueError, parse_job_stats, "job_stats:\n- job_id: %s\n  snapshot_time: 1\n" % job_id)
+        self.assertRaises(ValueError, parse_job_stats, "job_stats:\n- job_id: a\n  read_bytes:\n    samples: 0\n")
+        self.assertRaises(ValueError, parse_job_stats, "")
+
+
 class TestObdfilterAuditReadingJobStats(unittest.TestCase):
     """Test that reading job stats will work assuming stats proc file is normal
 
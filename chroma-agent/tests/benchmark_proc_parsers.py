@@ -0,0 +1,90 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""Time the parsing of Lustre /proc stats files for one OST target, using the fixture
+files in tests/data.  job_stats is also timed for a file of --jobs jobs made from the
+fixture entries, as on a busy OSS, with the job_stats parser and with yaml.
+
+Run from the chroma-agent directory:
+
+    python -m tests.benchmark_proc_parsers [--jobs N] [--count N]
+"""
+
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from tablib.packages import yaml
+
+from chroma_agent.device_plugins.audit.lustre import ObdfilterAudit, parse_job_stats
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data/lustre_versions')
+OBDFILTER = 'proc/fs/lustre/obdfilter'
+
+
+def timed(count, fn, *args):
+    """Return the mean time of fn(*args) in milliseconds"""
+    started = time.time()
+    for i in xrange(count):
+        fn(*args)
+    return (time.time() - started) * 1000.0 / count
+
+
+def make_job_stats(jobs):
+    """Return the text of a job_stats file with `jobs` jobs, copied from the fixture files"""
+    entries = []
+    root = os.path.join(DATA, '2.7/oss', OBDFILTER)
+    for target in sorted(os.listdir(root)):
+        text = open(os.path.join(root, target, 'job_stats')).read()
+        entries.extend(text.split('\n- ')[1:])
+
+    lines = ['job_stats:']
+    for i in xrange(jobs):
+        entry = entries[i % len(entries)].rstrip('\n').split('\n')
+        lines.append('- job_id:          job.%d' % i)
+        lines.extend(entry[1:])
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type = int, default = 2000, help = "jobs in the generated job_stats file")
+    parser.add_argument('--count', type = int, default = 20, help = "times to parse each file")
+    args = parser.parse_args()
+
+    print "Mean time per target (ms)"
+
+    audit = ObdfilterAudit()
+    audit.fscontext = os.path.join(DATA, '2.0.66/oss')
+    for target in sorted(os.listdir(os.path.join(audit.fscontext, OBDFILTER))):
+        if target.startswith('lustre-'):
+            print "%-32s %10.3f" % ('stats %s' % target, timed(args.count, audit.read_stats, target))
+            print "%-32s %10.3f" % ('brw_stats %s' % target, timed(args.count, audit.read_brw_stats, target))
+
+    text = make_job_stats(args.jobs)
+    assert parse_job_stats(text) == yaml.load(text)['job_stats']
+    print "%-32s %10.3f" % ('job_stats (parser)', timed(args.count, parse_job_stats, text))
+    print "%-32s %10.3f" % ('job_stats (yaml)', timed(max(args.count / 10, 1), yaml.load, text))
+
+    # The whole of read_job_stats, which also picks out the most active jobs
+    fscontext = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(fscontext, OBDFILTER, 'lustre-OST0000'))
+        with open(os.path.join(fscontext, OBDFILTER, 'lustre-OST0000', 'job_stats'), 'w') as f:
+            f.write(text)
+
+        audit = ObdfilterAudit()
+        audit.fscontext = fscontext
+        print "%-32s %10.3f" % ('read_job_stats', timed(args.count, audit.read_job_stats, 'lustre-OST0000'))
+    finally:
+        shutil.rmtree(fscontext)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import copy
+import json
+
+from django.utils import unittest
+
+from chroma_agent.chroma_common.lib import delta
+
+
+class TestDelta(unittest.TestCase):
+    old = {
+        'unchanged': {'a': 1, 'b': [1, 2]},
+        'counters': {'read': 10, 'write': 20, 'gone': 0},
+        'mounts': [{'device': '/dev/sda', 'recovery': {'status': 'RECOVERING'}}, {'device': '/dev/sdb'}],
+        'locations': ['a', 'b'],
+        'flag': 1,
+        'packages': {'lustre': 'installed'}
+    }
+
+    new = {
+        'unchanged': {'a': 1, 'b': [1, 2]},
+        'counters': {'read': 11, 'write': 20, 'open': 1},
+        'mounts': [{'device': '/dev/sda', 'recovery': {'status': 'COMPLETE'}}, {'device': '/dev/sdb'}],
+        'locations': ['a', 'b', 'c'],
+        'flag': True,
+        'packages': None
+    }
+
+    def test_diff(self):
+        self.assertEqual(delta.diff(self.old, copy.deepcopy(self.old)), None)
+        self.assertEqual(delta.diff(self.old, self.new), {
+            'set': {'locations': ['a', 'b', 'c'], 'flag': True, 'packages': None},
+            'patch': {
+                'counters': {'set': {'read': 11, 'open': 1}, 'delete': ['gone']},
+                'mounts': {'patch': {'0': {'patch': {'recovery': {'set': {'status': 'COMPLETE'}}}}}}
+            }
+        })
+
+    def test_apply(self):
+        """A patch sent as JSON turns a JSON copy of the old value into the new one"""
+        patch = json.loads(json.dumps(delta.diff(self.old, self.new)))
+        self.assertEqual(delta.apply(json.loads(json.dumps(self.old)), patch), self.new)
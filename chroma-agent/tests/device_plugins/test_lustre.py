@@ -1,4 +1,5 @@
 import os
+import json
 import mock
 
 from chroma_agent.device_plugins import lustre
@@ -6,6 +7,7 @@ from tests.command_capture_testcase import CommandCaptureTestCase
 from django.utils import unittest
 
 from chroma_agent.device_plugins.lustre import LustrePlugin
+from chroma_agent.chroma_common.lib import delta
 
 
 class MockLocalAudit():
@@ -62,48 +64,51 @@ class TestLustreAudit(unittest.TestCase):
         self.lustre_plugin = LustrePlugin(None)
 
     def test_audit_delta_match(self):
-        delta_fields = ['capabilities', 'properties', 'mounts', 'packages', 'resource_locations']
-
         result_all = self.lustre_plugin.update_session()
         result_none = self.lustre_plugin.update_session()
 
-        for key in result_all:
-            if key in delta_fields:
-                self.assertEqual(result_none[key], None)
-            else:
-                # Time is a special case.
-                if key == 'started_at':
-                    self.assertGreater(result_none[key], result_all[key])
-                else:
-                    self.assertEqual(result_all[key], result_none[key])
+        self.assertEqual(result_none['patch'], {})
+        self.assertEqual(result_none['base_version'], result_all['version'])
+        self.assertEqual(result_none['version'], result_all['version'] + 1)
+        # Time is a special case.
+        self.assertGreater(result_none['started_at'], result_all['started_at'])
 
     def test_audit_delta_no_match(self):
-        result_all = self.lustre_plugin.update_session()
+        self.lustre_plugin.update_session()
+        baseline = json.loads(json.dumps(self.lustre_plugin._baseline))
 
         for key in TestLustreAudit.values:
             TestLustreAudit.values[key] = not TestLustreAudit.values[key]
 
         result_match = self.lustre_plugin.update_session()
 
-        for key in result_all:
-            # Time and version and packages are a special case.
-            if key == 'started_at':
-                self.assertGreater(result_match[key], result_all[key])
-            elif key not in ['agent_version', 'packages']:
-                self.assertNotEqual(result_all[key], result_match[key])
+        # Only the changed fields are sent, and patching the previous result with them gives the new one.
+        self.assertEqual(sorted(result_match['patch']['patch'].keys()), ['metrics', 'mounts', 'properties', 'resource_locations'])
+        self.assertEqual(delta.apply(baseline, json.loads(json.dumps(result_match['patch']))),
+                         json.loads(json.dumps(self.lustre_plugin._baseline)))
 
     def test_audit_failsafe(self):
         result_all = self.lustre_plugin.update_session()
 
         for x in range(0, LustrePlugin.FAILSAFEDUPDATE):
-            result_none = self.lustre_plugin.update_session()
+            self.assertTrue('patch' in self.lustre_plugin.update_session())
 
+        result_full = self.lustre_plugin.update_session()
         for key in result_all:
-            # Time is a special case.
-            if key == 'started_at':
-                self.assertGreater(result_none[key], result_all[key])
+            # Time and version are a special case.
+            if key in ['started_at', 'version']:
+                self.assertGreater(result_full[key], result_all[key])
             else:
-                self.assertEqual(result_all[key], result_none[key])
+                self.assertEqual(result_all[key], result_full[key])
+
+    def test_session_start(self):
+        self.lustre_plugin.update_session()
+        self.lustre_plugin.update_session()
+
+        result = self.lustre_plugin.start_session()
+        self.assertEqual(result['version'], 1)
+        self.assertFalse('patch' in result)
+        self.assertEqual(result['packages'], {'scan_packages': True})
 
 
 class TestLustreScanPackages(CommandCaptureTestCase):
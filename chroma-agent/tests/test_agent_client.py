@@ -2,11 +2,13 @@ import logging
 import time
 import json
 import datetime
+import zlib
 import mock
+import requests
 
 from django.utils import unittest
 
-from chroma_agent.agent_client import HttpWriter, Message, HttpReader, SessionTable, HttpError
+from chroma_agent.agent_client import CryptoClient, HttpWriter, Message, HttpReader, SessionTable, HttpError, PostBody
 from chroma_agent.log import daemon_log
 from chroma_agent.plugin_manager import PRIO_LOW, DevicePluginMessage, PRIO_NORMAL, PRIO_HIGH
 from chroma_agent.chroma_common.lib.date_time import IMLDateTime
@@ -236,10 +238,12 @@ class TestHttpWriter(unittest.TestCase):
         client._fqdn = "test_server"
         client.boot_time = IMLDateTime.utcnow()
         client.start_time = IMLDateTime.utcnow()
+        # Uncompressed, so that fake_post measures the envelope as sent
+        client.compress_posts = False
 
         writer = HttpWriter(client)
 
-        def fake_post(envelope):
+        def fake_post(envelope, **kwargs):
             if len(json.dumps(envelope)) > MAX_BYTES_PER_POST:
                 daemon_log.info("fake_post(): rejecting oversized message")
                 raise HttpError()
@@ -298,6 +302,23 @@ class TestHttpWriter(unittest.TestCase):
         self.assertEqual(len(messages), 1)
         self.assertEqual(messages[0]['type'], "SESSION_CREATE_REQUEST")
 
+    def test_compressed_size(self):
+        """With compression, messages are sized by their compressed length against MAX_BYTES_PER_POST"""
+        import chroma_agent.agent_client
+        with mock.patch.object(chroma_agent.agent_client, 'MAX_BYTES_PER_POST', 1024):
+            client = mock.Mock()
+            client._fqdn = "test_server"
+            client.boot_time = IMLDateTime.utcnow()
+            client.start_time = IMLDateTime.utcnow()
+            client.compress_posts = True
+
+            writer = HttpWriter(client)
+            for seq in range(4):
+                writer.put(Message("DATA", "test_plugin", DevicePluginMessage('x' * 1024, PRIO_NORMAL), "id_foo", seq))
+
+            self.assertTrue(writer.send())
+            self.assertEqual(len(client.post.call_args[0][0]['messages']), 4)
+
 
 class TestHttpReader(unittest.TestCase):
     def test_data_message(self):
@@ -348,3 +369,122 @@ class TestHttpReader(unittest.TestCase):
         session.teardown.assertCalledOnce()
         # Should have removed the session
         self.assertNotIn('test_plugin', client.sessions._sessions)
+
+
+class TestCryptoClient(unittest.TestCase):
+    def setUp(self):
+        crypto = mock.Mock(certificate_file = 'cert', private_key_file = 'key')
+        self.client = CryptoClient('https://manager/agent/message/', crypto, 'test_server')
+
+        self.sessions = []
+        self.connection_error = None
+
+        def new_session():
+            session = mock.Mock()
+            session.headers = {}
+            session.request.side_effect = self.connection_error
+            session.request.return_value.ok = True
+            session.request.return_value.headers = {}
+            session.request.return_value.json.return_value = {}
+            self.sessions.append(session)
+            return session
+
+        patcher = mock.patch('chroma_agent.agent_client.requests.Session', side_effect = new_session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sessions_reused(self):
+        """Each method keeps its session, with its connections, between requests"""
+        self.client.post({'messages': []})
+        self.client.post({'messages': []})
+        self.client.get(params = {})
+
+        self.assertEqual(len(self.sessions), 2)
+        self.assertEqual(self.sessions[0].request.call_count, 2)
+        self.assertEqual(self.sessions[0].cert, ('cert', 'key'))
+        self.assertEqual(self.sessions[1].request.call_args[0][0], 'get')
+        self.assertTrue(self.sessions[0].mount.called)
+
+    def test_reconnect(self):
+        """A connection error on a GET session which has worked before is retried once on a new session,
+        otherwise it is raised and the next request reconnects"""
+        self.client.get(params = {})
+        self.sessions[0].request.side_effect = requests.exceptions.ConnectionError()
+        self.client.get(params = {})
+
+        self.assertEqual(len(self.sessions), 2)
+        self.assertTrue(self.sessions[0].close.called)
+
+        self.sessions[1].request.side_effect = requests.exceptions.ConnectionError()
+        self.client.get(params = {})
+        self.assertEqual(len(self.sessions), 3)
+
+        self.connection_error = requests.exceptions.ConnectionError()
+        self.sessions[2].request.side_effect = self.connection_error
+        self.assertRaises(HttpError, self.client.get, params = {})
+        self.assertEqual(len(self.sessions), 4)
+        self.assertTrue(self.sessions[3].close.called)
+
+        self.assertRaises(HttpError, self.client.get, params = {})
+        self.assertEqual(len(self.sessions), 5)
+
+    def test_post_not_resent(self):
+        """A POST which fails is not sent again, as the manager may have received it"""
+        self.client.post({'messages': []})
+        self.sessions[0].request.side_effect = requests.exceptions.ConnectionError()
+        self.assertRaises(HttpError, self.client.post, {'messages': []})
+
+        self.assertEqual(len(self.sessions), 1)
+        self.assertEqual(self.sessions[0].request.call_count, 2)
+        self.assertTrue(self.sessions[0].close.called)
+
+        self.client.post({'messages': []})
+        self.assertEqual(len(self.sessions), 2)
+
+    def test_compression_negotiated(self):
+        """POSTs are gzipped once the manager has advertised that it accepts them"""
+        self.client.post({'messages': []})
+        self.assertEqual(self.sessions[0].request.call_args[1]['data'], json.dumps({'messages': []}))
+
+        self.sessions[0].request.return_value.headers = {'Accept-Encoding': 'gzip, deflate'}
+        self.client.post({'messages': []})
+        self.client.post({'messages': []})
+
+        kwargs = self.sessions[0].request.call_args[1]
+        self.assertEqual(kwargs['headers'], {'Content-Encoding': 'gzip'})
+        self.assertEqual(zlib.decompress(kwargs['data'], 16 + zlib.MAX_WBITS), json.dumps({'messages': []}))
+
+
+class TestPostBody(unittest.TestCase):
+    envelope = {'server_boot_time': 'boot', 'client_start_time': 'start'}
+
+    def _fill(self, compress, limit):
+        body = PostBody(self.envelope, compress, limit)
+        messages = []
+        while True:
+            message = {'type': 'DATA', 'seq': len(messages), 'body': 'x' * 100}
+            if not body.add(json.dumps(message)):
+                break
+            messages.append(message)
+
+        data = body.finish()
+        self.assertLessEqual(len(data), limit)
+        if compress:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        self.assertEqual(json.loads(data), dict(self.envelope, messages = messages))
+        return messages, len(data) + len(json.dumps(message)) + 2
+
+    def test_limit(self):
+        """Messages are added until the body as sent would exceed the limit"""
+        messages, next_length = self._fill(False, 1024)
+        self.assertGreater(next_length, 1024)
+
+        compressed_messages = self._fill(True, 1024)[0]
+        self.assertGreater(len(compressed_messages), len(messages))
+
+    def test_oversized(self):
+        body = PostBody(self.envelope, True, 16)
+        self.assertTrue(body.add(json.dumps({'body': 'x'})))
+        self.assertTrue(body.oversized)
+        self.assertFalse(body.add(json.dumps({'body': 'y'})))
+        self.assertEqual(json.loads(zlib.decompress(body.finish(), 16 + zlib.MAX_WBITS)), dict(self.envelope, messages = [{'body': 'x'}]))
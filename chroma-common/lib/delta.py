@@ -0,0 +1,79 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+# Nested differences between JSON-like values, so that a large structure which changes a
+# little at a time can be sent as its changes against the copy the receiver already has.
+#
+# A patch describes the changes to a dict, or to a list whose length has not changed:
+#
+#   {'set': {key: new value, ...}, 'patch': {key: patch, ...}, 'delete': [key, ...]}
+#
+# with empty members left out.  List indices are given as strings, as JSON object keys
+# must be.  Any other value that changes is replaced whole, by its parent's 'set'.
+
+
+def _patchable(old, new):
+    if isinstance(old, dict):
+        return isinstance(new, dict)
+    else:
+        return isinstance(old, (list, tuple)) and isinstance(new, (list, tuple)) and len(old) == len(new)
+
+
+def diff(old, new):
+    """
+    Return the patch which turns old into new, or None if they are the same.
+
+    :param old: A dict, or a list or tuple the same length as new
+    :param new: A dict, or a list or tuple the same length as old
+    """
+    if isinstance(new, dict):
+        items = new.iteritems()
+        deleted = [key for key in old if key not in new]
+    else:
+        items = ((str(index), value) for index, value in enumerate(new))
+        old = dict((str(index), value) for index, value in enumerate(old))
+        deleted = []
+
+    set_values = {}
+    patches = {}
+    for key, value in items:
+        try:
+            old_value = old[key]
+        except KeyError:
+            set_values[key] = value
+            continue
+
+        if _patchable(old_value, value):
+            patch = diff(old_value, value)
+            if patch:
+                patches[key] = patch
+        elif type(old_value) is not type(value) or old_value != value:
+            set_values[key] = value
+
+    patch = {}
+    if set_values:
+        patch['set'] = set_values
+    if patches:
+        patch['patch'] = patches
+    if deleted:
+        patch['delete'] = deleted
+
+    return patch or None
+
+
+def apply(value, patch):
+    """
+    Apply a patch from diff to a dict or list in place, and return it.
+    """
+    key = int if isinstance(value, list) else lambda k: k
+
+    for k in patch.get('delete', []):
+        del value[key(k)]
+    for k, v in patch.get('set', {}).items():
+        value[key(k)] = v
+    for k, p in patch.get('patch', {}).items():
+        apply(value[key(k)], p)
+
+    return value
@@ -0,0 +1,64 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import time
+
+from chroma_core.models import StateLock
+from chroma_core.services.job_scheduler.lock_cache import LockCache
+from benchmark.generic import GenericBenchmark
+
+
+class FakeJob(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class Benchmark(GenericBenchmark):
+    """Time adding, querying as CommandPlan does, and removing locks in a LockCache, for
+    increasing numbers of locks, to check that the cost grows linearly.
+
+    Jobs and locked items are stand-ins, and the lock change receivers are disabled,
+    so that only the cache itself is measured."""
+
+    ITEMS = 10
+
+    def __init__(self, *args, **kwargs):
+        self.counts = [kwargs['count'] * 10 ** n for n in range(kwargs['steps'])]
+        self.lock_change_receivers = LockCache.lock_change_receivers
+        LockCache.lock_change_receivers = []
+
+    def _locks(self, count):
+        # Like a bulk start: each job reads one of a few items and writes one of the others
+        locks = []
+        for job_id in xrange(1, count / 2 + 1):
+            job = FakeJob(job_id)
+            locks.append(StateLock(job, 'item%d' % (job_id % self.ITEMS), False))
+            locks.append(StateLock(job, 'item%d' % ((job_id + 1) % self.ITEMS), True, 'a', 'b'))
+        return locks
+
+    def _time(self, count):
+        lock_cache = LockCache()
+        locks = self._locks(count)
+
+        started = time.time()
+        for lock in locks:
+            lock_cache.get_latest_write(lock.locked_item, not_job = lock.job)
+            lock_cache.get_read_locks(lock.locked_item, after = lock.job.id - self.ITEMS, not_job = lock.job)
+            lock_cache.add(lock)
+        lock_cache.get_write_by_locked_item()
+        for lock in locks[::2]:
+            lock_cache.remove_job(lock.job)
+        return time.time() - started
+
+    def run(self):
+        previous = None
+        for count in self.counts:
+            elapsed = self._time(count)
+            growth = " (%.1fx)" % (elapsed / max(previous, 1e-9)) if previous is not None else ""
+            print "%d locks: %.3fs%s" % (count, elapsed, growth)
+            previous = elapsed
+
+    def cleanup(self):
+        LockCache.lock_change_receivers = self.lock_change_receivers
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from benchmark.lock_cache import Benchmark
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+            make_option("--count", type=int, default=10000,
+                help="number of locks in the first run (default: 10000)"),
+            make_option("--steps", type=int, default=2,
+                help="number of runs, each with 10 times the locks of the last (default: 2)"),
+    )
+    help = "Benchmark how the cost of LockCache operations grows with the number of locks"
+
+    def handle(self, *args, **kwargs):
+        bench = Benchmark(*args, **kwargs)
+        bench.run()
+        bench.cleanup()
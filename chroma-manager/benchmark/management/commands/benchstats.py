@@ -33,6 +33,16 @@ class Command(BaseCommand):
                 help="don't precreate stats (could skew DB perf numbers)"),
             make_option("--include_create", action='store_true', default=False,
                 help="include initial creation time in final tally"),
+            make_option("--job_ids", type=int, default=0,
+                help="number of job ids reporting job stats on each OST (default: 0)"),
+            make_option("--seed", type=int, default=0,
+                help="random seed for generated metrics (default: 0)"),
+            make_option("--max_points", type=str, default="100,1000",
+                help="comma separated max_points to query with (default: 100,1000)"),
+            make_option("--num_points", type=str, default="0,20",
+                help="comma separated num_points to query with (default: 0,20)"),
+            make_option("--json", type=str, default=None,
+                help="run query workloads and write a JSON report to this file"),
     )
     help = "Benchmark metrics storage by simulating incoming metrics traffic"
 
@@ -8,10 +8,17 @@ import os
 import sys
 import time
 import uuid
+import json
+import functools
+from datetime import datetime
 
+from django import db
 from django.test.simple import DjangoTestSuiteRunner
+from django.utils.timezone import utc
 
 from chroma_core.models import ManagedHost, ManagedOst, ManagedMdt, ManagedFilesystem, ManagedMgs, Volume, VolumeNode, Stats
+from chroma_core.lib.metrics import MetricStore
+from chroma_core.services.lustre_audit import update_scan
 from chroma_core.services.lustre_audit.update_scan import UpdateScan
 from benchmark.generic import GenericBenchmark
 
@@ -91,6 +98,18 @@ class OstGenerator(TargetGenerator):
         for idx in range(0, options.ost_stats):
             stat_name = "ost_stat_%d" % idx
             self.stats[stat_name] = 0
+        self.job_stats = dict(("job%d.0" % idx, GenStatsDict(read=0, write=0, open=0)) for idx in range(0, options.job_ids))
+
+    def step_job_stats(self):
+        """Generate job_stats as reported by the agent, with increasing counters"""
+        job_stats = []
+        for job_id, stats in self.job_stats.items():
+            job_stats.append({'job_id': job_id,
+                              'snapshot_time': 0,
+                              'read': {'sum': stats['read'], 'samples': stats['read'] / 100},
+                              'write': {'sum': stats['write'], 'samples': stats['write'] / 100},
+                              'open': {'samples': stats['open']}})
+        return job_stats
 
     def create_entity(self, fs):
         self.create_volume()
@@ -157,10 +176,22 @@ class LazyStruct(object):
 options = None
 
 
+class DirectStatsQueue(object):
+    """Stand-in for StatsQueue which inserts samples directly, so that the inserts are timed"""
+    def put(self, samples):
+        Stats.insert(samples)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round((len(values) - 1) * fraction))]
+
+
 class Benchmark(GenericBenchmark):
     def __init__(self, *args, **kwargs):
         global options
         options = LazyStruct(**kwargs)
+        random.seed(options.seed)
         self.test_runner = DjangoTestSuiteRunner()
         self.prepare()
 
@@ -188,6 +219,9 @@ class Benchmark(GenericBenchmark):
                 stats['lustre']['target'][target.name] = {}
                 for target_stat in target.stats.keys():
                     stats['lustre']['target'][target.name][target_stat] = target.stats[target_stat]
+                if options.job_ids and isinstance(target, OstGenerator):
+                    stats['lustre']['jobid_var'] = 'procname_uid'
+                    stats['lustre']['target'][target.name]['job_stats'] = target.step_job_stats()
             update_servers.append([server.entity, stats])
 
         return update_servers
@@ -221,6 +255,7 @@ class Benchmark(GenericBenchmark):
                                   primary = True,
                                   use = True,
                                   volume = mgs_vol)
+        update_scan.StatsQueue = DirectStatsQueue
         self.mgs, mounts = ManagedMgs.create_for_volume(mgs_vol.pk, name="MGS")
         self.fs_entity = ManagedFilesystem.objects.create(name=options.fsname,
                                                           mgs=self.mgs)
@@ -236,6 +271,7 @@ class Benchmark(GenericBenchmark):
         cursor = connection.cursor()
         if 'postgres' in connection.settings_dict['ENGINE']:
             stats_size.row_count = stats_size.data = stats_size.index = 0
+            stats_size.tables = {}
 
             for model in Stats:
                 cursor.execute("select count(id) as rows, pg_relation_size('{0}') as data_length, pg_total_relation_size('{0}') - pg_relation_size('{0}') as index_length from {0}".format(model._meta.db_table))
@@ -243,6 +279,7 @@ class Benchmark(GenericBenchmark):
                 stats_size.row_count += rows
                 stats_size.data += data
                 stats_size.index += index
+                stats_size.tables[model._meta.db_table] = {'rows': rows, 'data': data, 'index': index}
         else:
             raise RuntimeError("Unsupported DB: %s" % connection.settings_dict['ENGINE'])
         return stats_size
@@ -344,6 +381,66 @@ class Benchmark(GenericBenchmark):
 
         self.print_report(run_info)
 
+        if options.json:
+            report = {'options': options.__dict__,
+                      'insert': {'samples': run_count - create_count,
+                                 'seconds': run_info.run_interval,
+                                 'rate': run_info.run_rate},
+                      'tables': stats_size_end.tables,
+                      'queries': self.run_queries(datetime.fromtimestamp(run_start, utc),
+                                                  datetime.fromtimestamp(run_start + options.duration, utc))}
+            with open(options.json, 'w') as fh:
+                json.dump(report, fh, indent=2, sort_keys=True)
+
+    def query_scenarios(self, begin, end):
+        """Generate (name, max_points, num_points, calls) for each query workload"""
+        targets = [target.entity for server in self.oss_list for target in server.target_list]
+        names = ["ost_stat_%d" % idx for idx in range(0, options.ost_stats)]
+        max_points_list = [int(value) for value in options.max_points.split(',')]
+        num_points_list = [int(value) for value in options.num_points.split(',')]
+
+        yield 'fetch_last', None, None, [functools.partial(target.metrics.fetch_last, names) for target in targets]
+        yield 'filesystem_fetch_last', None, None, [functools.partial(self.fs_entity.metrics.fetch_last, ManagedOst, names)]
+        for max_points in max_points_list:
+            for num_points in num_points_list:
+                args = begin, end, max_points, num_points
+                yield 'fetch', max_points, num_points, [functools.partial(target.metrics.fetch, names, *args) for target in targets]
+                if options.job_ids:
+                    yield 'fetch_jobs', max_points, num_points, [functools.partial(target.metrics.fetch_jobs, 'read_bytes', begin, end, 'id', max_points, num_points)
+                                                                 for target in targets]
+                yield 'list', max_points, num_points, [functools.partial(MetricStore.fetch_many, targets, names, *args)]
+                if not num_points:
+                    yield 'reduce', max_points, num_points, [functools.partial(MetricStore.reduce_many, {self.fs_entity.id: targets}, names, begin, end, 'sum', max_points)]
+
+    def run_queries(self, begin, end):
+        """Time each query workload, returning latencies, throughput and query counts"""
+        results = []
+        db.connection.use_debug_cursor = True
+        try:
+            for name, max_points, num_points, calls in self.query_scenarios(begin, end):
+                sys.stderr.write("\rQuerying %s..." % name)
+                latencies, query_count = [], 0
+                for call in calls:
+                    for model in Stats:
+                        model.cache.clear()
+                    db.reset_queries()
+                    start = time.time()
+                    call()
+                    latencies.append(time.time() - start)
+                    query_count += len(db.connection.queries)
+                results.append({'name': name,
+                                'max_points': max_points,
+                                'num_points': num_points,
+                                'calls': len(calls),
+                                'throughput': len(calls) / sum(latencies),
+                                'p50': percentile(latencies, 0.5),
+                                'p99': percentile(latencies, 0.99),
+                                'queries_per_call': float(query_count) / len(calls)})
+        finally:
+            db.connection.use_debug_cursor = False
+        sys.stderr.write("\rQuerying... Done.\n")
+        return results
+
     def profile_system(self):
         def _read_lines(filename):
             fh = open(filename)
@@ -0,0 +1,46 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import time
+
+from chroma_core.services import _amqp_connection
+from chroma_core.services.queue import ServiceQueue
+from benchmark.generic import GenericBenchmark
+
+
+class BenchmarkQueue(ServiceQueue):
+    name = 'benchmark_publish'
+
+
+class Benchmark(GenericBenchmark):
+    """Compare the rate of ServiceQueue.put with declaring a SimpleQueue for every
+    message, as put used to.  Needs a running broker."""
+
+    def __init__(self, *args, **kwargs):
+        self.count = kwargs['count']
+        self.queue = BenchmarkQueue()
+        self.body = {'fqdn': 'oss1.example.com', 'type': 'DATA', 'plugin': 'lustre', 'session_id': 'abc',
+                     'body': {'target': 'testfs-OST0000', 'stats': range(50)}}
+
+    def _simple_queue_put(self):
+        with _amqp_connection() as conn:
+            q = conn.SimpleQueue(self.queue.name, serializer = 'json',
+                                 exchange_opts={'durable': False}, queue_opts={'durable': False})
+            q.put(self.body)
+
+    def _rate(self, put):
+        started = time.time()
+        for i in xrange(self.count):
+            put()
+        return self.count / (time.time() - started)
+
+    def run(self):
+        self.queue.purge()
+        simple = self._rate(self._simple_queue_put)
+        pooled = self._rate(lambda: self.queue.put(self.body))
+        print "SimpleQueue per message: %.0f msg/s, pooled producer: %.0f msg/s" % (simple, pooled)
+
+    def cleanup(self):
+        self.queue.purge()
@@ -0,0 +1,55 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import time
+import uuid
+
+import settings
+from chroma_core.services import rpc
+from benchmark.generic import GenericBenchmark
+
+
+class Benchmark(GenericBenchmark):
+    """Time the validation of typical RPC requests and responses, with the fast
+    checks and with full jsonschema validation."""
+
+    def __init__(self, *args, **kwargs):
+        self.count = kwargs['count']
+
+        request_id = str(uuid.uuid4())
+        self.messages = [
+            ('wait_table_change request', rpc.REQUEST_VALIDATOR, {
+                'request_id': request_id,
+                'method': 'wait_table_change',
+                'args': [{'chroma_core_managedhost': 1234}, ['chroma_core_managedhost'], 60],
+                'kwargs': {},
+                'response_routing_key': "JobSchedulerRpc.responses_manager_1234"}),
+            ('get_locks response', rpc.RESPONSE_VALIDATOR, {
+                'request_id': request_id,
+                'result': {'read': [1, 2, 3], 'write': [4]},
+                'exception': None})
+        ]
+
+    def _time(self, validator, message):
+        started = time.time()
+        for i in xrange(self.count):
+            validator.validate(message)
+        return (time.time() - started) / self.count
+
+    def run(self):
+        full_validation = settings.RPC_FULL_VALIDATION
+        try:
+            for name, validator, message in self.messages:
+                settings.RPC_FULL_VALIDATION = True
+                full = self._time(validator, message)
+                settings.RPC_FULL_VALIDATION = False
+                fast = self._time(validator, message)
+                print "%s: jsonschema %.1fus, fast %.1fus per message (%.0fx)" % (
+                    name, full * 1000000, fast * 1000000, full / max(fast, 1e-9))
+        finally:
+            settings.RPC_FULL_VALIDATION = full_validation
+
+    def cleanup(self):
+        pass
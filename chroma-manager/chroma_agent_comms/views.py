@@ -7,6 +7,7 @@ import Queue
 import json
 import traceback
 import time
+import zlib
 
 from django.db import transaction
 from django.http import HttpResponseNotAllowed, HttpResponse, HttpResponseBadRequest
@@ -42,6 +43,48 @@ def log_exception(f):
     return wrapped
 
 
+# Encodings accepted for message POSTs, advertised to agents in the Accept-Encoding header
+# of message responses
+CONTENT_ENCODING_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+# GET responses at least this long are gzipped for agents which accept it
+COMPRESS_MIN_BYTES = 1024
+COMPRESSION_LEVEL = 1
+
+
+def decode_body(request, max_length):
+    """Return the request body, decompressed according to its Content-Encoding.  Raise ValueError
+    if the encoding is not one we accept, or the decompressed body would exceed max_length"""
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', 'identity')
+    if encoding == 'identity':
+        return request.body
+
+    try:
+        decompressor = zlib.decompressobj(CONTENT_ENCODING_WBITS[encoding])
+    except KeyError:
+        raise ValueError("Unsupported Content-Encoding '%s'" % encoding)
+    try:
+        body = decompressor.decompress(request.body, max_length)
+    except zlib.error as e:
+        raise ValueError("Bad %s body: %s" % (encoding, e))
+    if decompressor.unconsumed_tail:
+        raise ValueError("Body exceeds %s bytes when decompressed" % max_length)
+    return body
+
+
+def encoded_response(request, content):
+    """Return an HttpResponse of JSON content, gzipped if it is worth it and the agent accepts it"""
+    if len(content) >= COMPRESS_MIN_BYTES and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        response = HttpResponse(compressor.compress(content) + compressor.flush(), mimetype = "application/json")
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(content, mimetype = "application/json")
+    response['Vary'] = 'Accept-Encoding'
+    response['Accept-Encoding'] = ", ".join(sorted(CONTENT_ENCODING_WBITS.keys()))
+    return response
+
+
 class ValidatedClientView(View):
     @classmethod
     def valid_fqdn(cls, request):
@@ -151,6 +194,9 @@ class MessageView(ValidatedClientView):
     hosts = None
 
     LONG_POLL_TIMEOUT = 30
+    MAX_BYTES_PER_GET = settings.HTTP_AGENT_MAX_BYTES_PER_GET
+    # Limit on the decompressed size of a POST, which is at most 8MiB compressed
+    MAX_DECODED_BYTES_PER_POST = 256 * 1024 ** 2
 
     @log_exception
     def post(self, request):
@@ -159,7 +205,11 @@ class MessageView(ValidatedClientView):
         Handle a POST containing messages from the agent
         """
 
-        body = json.loads(request.body)
+        try:
+            body = decode_body(request, self.MAX_DECODED_BYTES_PER_POST)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        body = json.loads(body)
         fqdn = self.valid_fqdn(request)
         if not fqdn:
             return HttpForbidden()
@@ -222,7 +272,9 @@ class MessageView(ValidatedClientView):
                     'body': None
                 })
 
-        return HttpResponse()
+        response = HttpResponse()
+        response['Accept-Encoding'] = ", ".join(sorted(CONTENT_ENCODING_WBITS.keys()))
+        return response
 
     def _filter_valid_messages(self, fqdn, messages):
         plugin_to_session_id = {}
@@ -283,6 +335,16 @@ class MessageView(ValidatedClientView):
         log.debug("MessageView.get: composing messages for %s" % fqdn)
         queues = self.queues.get(fqdn)
 
+        # Messages are encoded as they are taken from the queue, to keep the response
+        # within MAX_BYTES_PER_GET, and the response is assembled from those encodings.
+        encoded = {}
+
+        def encoded_length(message):
+            encoded[id(message)] = json.dumps(message)
+            return len(encoded[id(message)])
+
+        messages_bytes = sum(encoded_length(m) for m in messages)
+
         # If this handler is sitting on the TX queue, draining messages, then
         # when a new session starts, *before* sending any TX messages, we have to
         # make sure it has been disconnected, to avoid the TX messages being sent
@@ -297,26 +359,33 @@ class MessageView(ValidatedClientView):
                         return HttpResponse(json.dumps({'messages': []}), mimetype="application/json")
                 else:
                     messages.append(first_message)
+                    messages_bytes += encoded_length(first_message)
             except Queue.Empty:
                 pass
             else:
-                # TODO: limit number of messages per response
-                while True:
+                while messages_bytes < self.MAX_BYTES_PER_GET:
                     try:
                         message = queues.tx.get(block=False)
-                        if message['type'] == 'TX_BARRIER':
-                            if message['client_start_time'] != request.GET['client_start_time']:
-                                log.warning("Cancelling GET due to barrier %s %s" % (message['client_start_time'], request.GET['client_start_time']))
-                                return HttpResponse(json.dumps({'messages': []}), mimetype="application/json")
-                        else:
-                            messages.append(message)
                     except Queue.Empty:
                         break
 
+                    if message['type'] == 'TX_BARRIER':
+                        if message['client_start_time'] != request.GET['client_start_time']:
+                            log.warning("Cancelling GET due to barrier %s %s" % (message['client_start_time'], request.GET['client_start_time']))
+                            return HttpResponse(json.dumps({'messages': []}), mimetype="application/json")
+                    else:
+                        message_bytes = encoded_length(message)
+                        if messages and messages_bytes + message_bytes > self.MAX_BYTES_PER_GET:
+                            # This message will not fit into this response: leave it for the next GET
+                            queues.tx.put_front(message)
+                            break
+                        messages.append(message)
+                        messages_bytes += message_bytes
+
         messages = self._filter_valid_messages(fqdn, messages)
 
         log.debug("MessageView.get: responding to %s with %s messages (%s)" % (fqdn, len(messages), client_start_time))
-        return HttpResponse(json.dumps({'messages': messages}), mimetype = "application/json")
+        return encoded_response(request, '{"messages": [%s]}' % ", ".join(encoded[id(m)] for m in messages))
 
 
 def validate_token(key, credits=1):
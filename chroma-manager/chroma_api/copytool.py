@@ -15,7 +15,7 @@ from tastypie.authorization import DjangoAuthorization
 
 from chroma_core.models import Copytool, CopytoolOperation, ManagedHost, ManagedFilesystem
 from chroma_core.models.copytool import resolve_key
-from chroma_api.utils import StatefulModelResource, MetricResource, custom_response
+from chroma_api.utils import StatefulModelResource, MetricResource, custom_response, fill_nested_locks
 from chroma_api.authentication import AnonymousAuthentication
 from chroma_api.host import HostResource
 from chroma_api.filesystem import FilesystemResource
@@ -56,6 +56,14 @@ class CopytoolOperationResource(ChromaModelResource):
     def dehydrate_type(self, bundle):
         return resolve_key('type', bundle.obj.type)
 
+    def alter_list_data_to_serialize(self, request, to_be_serialized):
+        fill_nested_locks(to_be_serialized['objects'])
+        return to_be_serialized
+
+    def alter_detail_data_to_serialize(self, request, bundle):
+        fill_nested_locks([bundle])
+        return bundle
+
     def build_filters(self, filters=None):
         if filters is None:
             filters = {}
@@ -17,6 +17,7 @@ from django.http import Http404
 from django.utils import timezone
 
 from tastypie.resources import ModelDeclarativeMetaclass, Resource, ResourceOptions
+from tastypie.bundle import Bundle
 from tastypie import fields
 from tastypie import http
 from tastypie.http import HttpBadRequest, HttpMethodNotAllowed
@@ -60,6 +61,44 @@ def dehydrate_command(command):
         return None
 
 
+def stateful_object_key(obj):
+    """Return the content type natural key of a StatefulObject, as used by the JobScheduler"""
+    # The content type is known without downcasting, which would be a query per object
+    content_type_id = getattr(obj, 'content_type_id', None)
+    if content_type_id:
+        return ContentType.objects.get_for_id(content_type_id).natural_key()
+    else:
+        return ContentType.objects.get_for_model(obj.downcast()).natural_key()
+
+
+def _nested_stateful_bundles(bundles):
+    for bundle in bundles:
+        for value in bundle.data.values():
+            nested = [b for b in (value if isinstance(value, list) else [value]) if isinstance(b, Bundle)]
+            for nested_bundle in nested:
+                if nested_bundle.data.get('locks', False) is None:
+                    yield nested_bundle
+            for nested_bundle in _nested_stateful_bundles(nested):
+                yield nested_bundle
+
+
+def fill_nested_locks(bundles):
+    """Fill in the locks of StatefulModelResource bundles nested in these ones by
+    full = True related fields.  Nested bundles are not passed to their own resource's
+    alter_list_data_to_serialize, so would otherwise be left with locks of None.
+
+    One JobScheduler call is made for each content type of nested object.
+    """
+    nested_by_key = defaultdict(list)
+    for nested_bundle in _nested_stateful_bundles(bundles):
+        nested_by_key[stateful_object_key(nested_bundle.obj)].append(nested_bundle)
+
+    for so_ct_key, nested_bundles in nested_by_key.items():
+        summary = JobSchedulerClient.object_state_summary([(so_ct_key, b.obj.id) for b in nested_bundles])
+        for nested_bundle in nested_bundles:
+            nested_bundle.data['locks'] = summary[str(nested_bundle.obj.id)]['locks']
+
+
 # Given a dict of queries, turn the variables into the correct format for a django filter.
 def filter_fields_to_type(klass, query_dict):
     reserved_fields = ['order_by', 'format', 'limit', 'offset']
@@ -182,12 +221,6 @@ class StatefulModelResource(CustomModelResource):
     def dehydrate_label(self, bundle):
         return bundle.obj.get_label()
 
-    def dehydrate_locks(self, bundle):
-        obj = bundle.obj
-        obj_key = ContentType.objects.get_for_model(obj.downcast()).natural_key()
-
-        return JobSchedulerClient.get_locks(obj_key, obj.id)
-
     def alter_detail_data_to_serialize(self, request, bundle):
         """Add post dehydrate data to a single bundle
 
@@ -229,9 +262,9 @@ class StatefulModelResource(CustomModelResource):
         """Post process available jobs and state transitions
 
         This method is a TastyPie hook that is called after all fields
-        have been dehydrated.  The available_* methods are no longer
-        dehydrated one at a time.  Instead, they are all done in two batched
-        calls, and set in the return datastructure here.
+        have been dehydrated.  The available_* and locks fields are no longer
+        dehydrated one at a time.  Instead, they are all done in one batched
+        call, and set in the return datastructure here.
 
         to_be_serialized is a list of TastyPie Bundles composing some
         subclass of StatefulObjects under the key 'objects.
@@ -241,18 +274,17 @@ class StatefulModelResource(CustomModelResource):
 
         batch = []
         for bundle in to_be_serialized['objects']:
-            so_ct_key = ContentType.objects.get_for_model(bundle.obj.downcast()).natural_key()
-            batch.append((so_ct_key, bundle.obj.id,))
+            batch.append((stateful_object_key(bundle.obj), bundle.obj.id,))
 
-        computed_transitions = JobSchedulerClient.available_transitions(batch)
-        computed_jobs = JobSchedulerClient.available_jobs(batch)
+        summary = JobSchedulerClient.object_state_summary(batch)
 
-        #  decorate the transition lists with verbs
-        #  and install in the bundle for return
+        #  install the transition lists decorated with verbs, jobs and locks
+        #  in the bundle for return
         for idx, bundle in enumerate(to_be_serialized['objects']):
-            obj_transitions_states_and_verbs = computed_transitions[str(bundle.obj.id)]
-
-            obj_jobs = computed_jobs[str(bundle.obj.id)]
+            obj_summary = summary[str(bundle.obj.id)]
+            obj_transitions_states_and_verbs = obj_summary['transitions']
+            obj_jobs = obj_summary['jobs']
+            bundle.data['locks'] = obj_summary['locks']
 
             # TODO: available_transitions is deprecated, use available_actions
             bundle.data['available_transitions'] = obj_transitions_states_and_verbs
@@ -264,6 +296,8 @@ class StatefulModelResource(CustomModelResource):
                                        key=lambda action: action['display_order'])
             bundle.data['available_actions'] = available_actions
 
+        fill_nested_locks(to_be_serialized['objects'])
+
         return to_be_serialized
 
     # PUT handler for accepting {'state': 'foo', 'dry_run': <true|false>}
@@ -499,6 +533,23 @@ class MetricResource:
                     counter[name] /= len(results)
         return result
 
+    def _get_metric_reduced(self, request, objs, metrics, begin, end, max_points, reduce_fn, group_by):
+        # Reduce date ranges in the database, so that only the reduced series are returned
+        if not group_by:
+            stats = MetricStore.reduce_many({None: objs}, metrics, begin, end, reduce_fn, max_points)[None]
+            return self.create_response(request, self._format(stats))
+        groups = defaultdict(list)
+        for obj in objs:
+            if hasattr(obj, 'content_type'):
+                obj = obj.downcast()
+            if hasattr(obj, group_by):
+                group_val = getattr(obj, group_by)
+                groups[getattr(group_val, 'id', group_val)].append(obj)
+        groups = MetricStore.reduce_many(groups, metrics, begin, end, reduce_fn, max_points)
+        for key in groups:
+            groups[key] = self._format(groups[key])
+        return self.create_response(request, groups)
+
     def get_metric_list(self, request, metrics, begin, end, job, max_points, num_points, **kwargs):
         errors = {}
         reduce_fn, group_by = map(request.GET.get, ('reduce_fn', 'group_by'))
@@ -513,7 +564,12 @@ class MetricResource:
             raise custom_response(self, request, http.HttpNotFound, {'metrics': exc})
         metrics = metrics or set(itertools.chain.from_iterable(MetricStore(obj).names for obj in objs))
 
-        result = dict((obj.id, self._fetch(MetricStore(obj), metrics, begin, end, job, max_points, num_points)) for obj in objs)
+        if reduce_fn and begin and end and not (job or num_points):
+            return self._get_metric_reduced(request, objs, metrics, begin, end, max_points, reduce_fn, group_by)
+        if begin and end and not job:
+            result = MetricStore.fetch_many(objs, metrics, begin, end, max_points, num_points)
+        else:
+            result = dict((obj.id, self._fetch(MetricStore(obj), metrics, begin, end, job, max_points, num_points)) for obj in objs)
         if not reduce_fn:
             for obj_id, stats in result.items():
                 result[obj_id] = self._format(stats)
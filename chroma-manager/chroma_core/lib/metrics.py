@@ -5,9 +5,12 @@
 
 import time
 import heapq
+import itertools
 import collections
 from datetime import datetime
 from chroma_core.services import log_register
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
 from django.utils.timezone import utc
 from chroma_core.models import Point, Series, Stats, ManagedHost, ManagedTarget, ManagedFilesystem
 from chroma_core.lib.storage_plugin.api import statistics
@@ -26,6 +29,49 @@ class Counter(dict):
             self[key] += other[key]
 
 
+# Reduce series of many objects in the database.  Points are floored to the sample step and converted to
+# values as in MetricStore.fetch, then each object's latest values (or earliest, if it has none yet) are carried
+# forward to every timestamp in its group and summed.  Parameters are the series rows, sample step, begin and end
+# datetimes, and the number of requested metrics.
+REDUCE_SQL = """
+WITH series (id, grp, obj, name, kind, mixed) AS (VALUES {values}),
+raw AS (
+    SELECT s.id, s.grp, s.obj, s.name, s.kind, s.mixed,
+           to_timestamp(floor(extract(epoch FROM t.dt) / %s) * %s) AS dt,
+           CASE WHEN sum(t.len) = 0 THEN 0.0 ELSE sum(t.sum) / sum(t.len) END AS mean
+    FROM {table} t JOIN series s ON s.id = t.id
+    WHERE t.dt >= %s AND t.dt < %s
+    GROUP BY s.id, s.grp, s.obj, s.name, s.kind, s.mixed, 7
+),
+rated AS (
+    SELECT grp, obj, name, kind, mixed, dt,
+           CASE WHEN kind = 0 THEN mean
+                ELSE (mean - lag(mean) OVER w) / extract(epoch FROM dt - lag(dt) OVER w) END AS value,
+           kind = 0 OR lag(dt) OVER w IS NOT NULL AS valid
+    FROM raw WINDOW w AS (PARTITION BY id ORDER BY dt)
+),
+points AS (
+    SELECT grp, obj, name, dt, CASE WHEN kind = 1 THEN greatest(value, 0.0) ELSE value END AS value,
+           mixed AND dt = min(dt) OVER (PARTITION BY obj) AND count(*) OVER (PARTITION BY obj, dt) < %s AS incomplete
+    FROM rated WHERE valid
+),
+dts AS (SELECT DISTINCT grp, obj, dt FROM points WHERE NOT incomplete),
+grid AS (
+    SELECT g.grp, g.dt, o.obj
+    FROM (SELECT DISTINCT grp, dt FROM dts) g JOIN (SELECT DISTINCT grp, obj FROM dts) o ON o.grp = g.grp
+),
+carry AS (
+    SELECT grid.grp, grid.dt, grid.obj,
+           coalesce(max(dts.dt) OVER (PARTITION BY grid.obj ORDER BY grid.dt),
+                    min(dts.dt) OVER (PARTITION BY grid.obj)) AS source
+    FROM grid LEFT JOIN dts ON dts.obj = grid.obj AND dts.dt = grid.dt
+)
+SELECT carry.grp, carry.dt, points.name, sum(points.value)
+FROM carry JOIN points ON points.obj = carry.obj AND points.dt = carry.source AND NOT points.incomplete
+GROUP BY carry.grp, carry.dt, points.name
+"""
+
+
 class MetricStore(object):
     """
     Base class for metric stores.
@@ -43,38 +89,106 @@ class MetricStore(object):
 
     def serialize(self, update):
         "Generate serialized samples (id, dt, value) from a timestamped update dict."
+        types = dict((name, item['type']) for data in update.values() for name, item in data.items())
+        series = Series.get_many(self.measured_object, types)
         for ts, data in update.items():
             dt = datetime.fromtimestamp(ts, utc)
             for name, item in data.items():
-                series = Series.get(self.measured_object, name, item['type'])
-                yield series.id, dt, item['value']
+                yield series[name].id, dt, item['value']
 
     def clear(self):
         "Remove all associated series."
         for series in Series.filter(self.measured_object):
             series.delete()
             Stats.delete(series.id)
+        Series.forget(self.measured_object)
 
     @property
     def names(self):
         "names of all available data series"
         return set(Series.filter(self.measured_object, type__in=Series.DATA_TYPES).values_list('name', flat=True))
 
-    def fetch(self, fetch_metrics, begin, end, max_points=float('inf'), num_points=0):
-        "Return datetimes with dicts of field names and values."
+    @staticmethod
+    def _select(series, begin, end, max_points=float('inf'), num_points=0):
+        "Return mapping of series ids to points, with rates derived for Counter and Derive series."
+        ids = collections.defaultdict(list)
+        for item in series:
+            ids[item.type in ('Counter', 'Derive')].append(item.id)
+        points = {}
+        for rate in ids:
+            points.update(Stats.select_many(ids[rate], begin, end, rate=rate, maxlen=max_points, fixed=num_points))
+        return points
+
+    @staticmethod
+    def _collect(series, points, fetch_metrics):
+        "Return datetimes with dicts of field names and values for one measured object."
         result = collections.defaultdict(dict)
         types = set()
-        end = Stats[0].floor(end)  # exclude points from a partial sample
-        for series in Series.filter(self.measured_object, name__in=fetch_metrics):
-            types.add(series.type)
-            minimum = 0.0 if series.type == 'Counter' else float('-inf')
-            for point in Stats.select(series.id, begin, end, rate=series.type in ('Counter', 'Derive'), maxlen=max_points, fixed=num_points):
-                result[point.dt][series.name] = max(minimum, point.mean)
+        for item in series:
+            types.add(item.type)
+            minimum = 0.0 if item.type == 'Counter' else float('-inf')
+            for point in points[item.id]:
+                result[point.dt][item.name] = max(minimum, point.mean)
         # if absolute and derived values are mixed, the earliest value will be incomplete
         if result and types > set(['Gauge']) and len(result[min(result)]) < len(fetch_metrics):
             del result[min(result)]
         return dict(result)
 
+    def fetch(self, fetch_metrics, begin, end, max_points=float('inf'), num_points=0):
+        "Return datetimes with dicts of field names and values."
+        end = Stats[0].floor(end)  # exclude points from a partial sample
+        series = list(Series.filter(self.measured_object, name__in=fetch_metrics))
+        return self._collect(series, self._select(series, begin, end, max_points, num_points), fetch_metrics)
+
+    @classmethod
+    def fetch_many(cls, measured_objects, fetch_metrics, begin, end, max_points=float('inf'), num_points=0):
+        "Return mapping of measured object ids to fetch results, reading all series in bulk."
+        objs = [cls(obj).measured_object for obj in measured_objects]
+        end = Stats[0].floor(end)  # exclude points from a partial sample
+        series = collections.defaultdict(list)
+        for item in Series.filter_many(objs, name__in=fetch_metrics):
+            series[item.content_type_id, item.object_id].append(item)
+        points = cls._select(itertools.chain.from_iterable(series.values()), begin, end, max_points, num_points)
+        result = {}
+        for obj in objs:
+            key = ContentType.objects.get_for_model(obj).id, obj.id
+            result[obj.id] = cls._collect(series[key], points, fetch_metrics)
+        return result
+
+    @classmethod
+    def reduce_many(cls, groups, fetch_metrics, begin, end, reduce_fn, max_points=float('inf')):
+        """Return mapping of group keys to datetimes with dicts of field names and values,
+        reduced by 'sum' or 'average' over each group's measured objects in the database.
+        """
+        if reduce_fn not in ('sum', 'average'):
+            raise NotImplementedError
+        end = Stats[0].floor(end)  # exclude points from a partial sample
+        keys, objs = list(groups), []
+        for grp, key in enumerate(keys):
+            objs += [(grp, cls(obj).measured_object) for obj in groups[key]]
+        series = collections.defaultdict(list)
+        for item in Series.filter_many([obj for grp, obj in objs], name__in=fetch_metrics):
+            series[item.content_type_id, item.object_id].append(item)
+        rows = []
+        for index, (grp, obj) in enumerate(objs):
+            items = series[ContentType.objects.get_for_model(obj).id, obj.id]
+            types = set(item.type for item in items)
+            for item in items:
+                kind = ('Gauge', 'Counter', 'Derive').index(item.type)
+                rows.append((item.id, grp, index, item.name, kind, types > set(['Gauge'])))
+        result = dict((key, {}) for key in keys)
+        if not rows:
+            return result
+        index, model = Stats.resolve([row[0] for row in rows], begin, end, max_points)
+        sql = REDUCE_SQL.format(values=', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(rows)), table=model._meta.db_table)
+        params = list(itertools.chain.from_iterable(rows)) + [model.step, model.step, begin, end, len(fetch_metrics)]
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        for grp, dt, name, value in cursor.fetchall():
+            data = result[keys[grp]].setdefault(dt.astimezone(utc), Counter.fromkeys(fetch_metrics, 0.0))
+            data[name] = value / len(groups[keys[grp]]) if reduce_fn == 'average' else value
+        return result
+
     def fetch_last(self, fetch_metrics):
         "Return latest datetime and dict of field names and values."
         latest, data = datetime.fromtimestamp(0, utc), {}
@@ -91,9 +205,11 @@ class MetricStore(object):
         end = Stats[0].floor(end)  # exclude points from a partial sample
         series_ids = Series.filter(self.measured_object, name__startswith='job_' + metric).values('id')
         series_ids = Stats[0].objects.filter(id__in=series_ids, dt__gte=begin).values('id').distinct('id')
-        for series in Series.filter(self.measured_object, id__in=series_ids):
+        series_list = list(Series.filter(self.measured_object, id__in=series_ids))
+        points = Stats.select_many([series.id for series in series_list], begin, end, rate=True, maxlen=max_points, fixed=num_points)
+        for series in series_list:
             types.add(series.type)
-            for point in Stats.select(series.id, begin, end, rate=True, maxlen=max_points, fixed=num_points):
+            for point in points[series.id]:
                 result[point.dt][series.name.split('_', 3)[-1]] = point
         assert types.issubset(Series.JOB_TYPES)
         # translate job ids into metadata
@@ -247,24 +363,99 @@ class TargetMetricStore(MetricStore):
                 update[ds_name] = {'value': int(hsm_stats[group][stat]),
                                    'type': 'Gauge'}
 
+        if getattr(self.measured_object, 'filesystem_id', None) is not None:
+            FilesystemMetricStore.record(self.measured_object, update)
+
         return list(MetricStore.serialize(self, {update_time: update}))
 
 
 class FilesystemMetricStore(MetricStore):
     """
-    Wrapper class for Filesystem-level aggregate metrics.  Read-only.
+    Wrapper class for Filesystem-level aggregate metrics.
+
+    Totals of each kind of target's metrics are stored as filesystem series, prefixed by the kind
+    (e.g. ost_kbytesfree), so that they can be read without visiting every target.  The latest
+    values of each target are recorded as they are serialized, and summed when the filesystem is,
+    once every mounted target of the filesystem has reported.  Counter and Derive totals start
+    from the last stored total and are advanced by the targets' changes rather than summed, so
+    that targets joining or leaving, or a restart, do not make the rate of the total jump.
     """
+    targets = {}  # target id -> (filesystem id, {series name: (value, type)})
+    counters = {}  # (filesystem id, series name) -> running total of a Counter or Derive series
+
     def __init__(self, managed_object, *args, **kwargs):
-        # Override the parent __init__(), as we don't need an R3D for
-        # a Filesystem.
+        MetricStore.__init__(self, managed_object)
         self.filesystem = managed_object
 
-    def serialize(self, *args, **kwargs):
-        """Don't use this -- will raise a NotImplementedError!"""
-        raise NotImplementedError("Filesystem-level serialize() not supported!")
+    @staticmethod
+    def kind(target_class):
+        "Return series name prefix for a target class, e.g. 'ost' for ManagedOst."
+        return target_class.__name__.replace('Managed', '', 1).lower()
+
+    @classmethod
+    def record(cls, target, update):
+        "Record a target's latest values from an update dict of field names to values and types."
+        kind = cls.kind(type(target))
+        values = dict(('{0}_{1}'.format(kind, name), (item['value'], item['type']))
+                      for name, item in update.items() if item['type'] in Series.DATA_TYPES)
+
+        filesystem_id, previous = cls.targets.get(target.id, (None, {}))
+        if filesystem_id == target.filesystem_id:
+            for name, (value, data_type) in values.items():
+                key = filesystem_id, name
+                if data_type != 'Gauge' and key in cls.counters and name in previous:
+                    change = value - previous[name][0]
+                    # a Counter which goes down has been reset, and adds nothing
+                    if data_type == 'Derive' or change > 0:
+                        cls.counters[key] += change
+        cls.targets[target.id] = target.filesystem_id, values
+
+    def serialize(self, update_time=None):
+        "Return serialized samples (id, dt, value) of totals of the latest recorded target values."
+        if update_time is None:
+            update_time = time.time()
+
+        states = dict(self.filesystem.get_filesystem_targets().values_list('id', 'state'))
+        members = {}
+        for target_id, (filesystem_id, values) in self.targets.items():
+            if filesystem_id == self.filesystem.id:
+                if target_id in states:
+                    members[target_id] = values
+                else:
+                    # removed, or moved to another filesystem and not yet heard from
+                    del self.targets[target_id]
+        if any(state == 'mounted' and target_id not in members for target_id, state in states.items()):
+            # a total of some of the targets would look like a drop in the total
+            return []
+
+        update = {}
+        for values in members.values():
+            for name, (value, data_type) in values.items():
+                item = update.setdefault(name, {'value': 0, 'type': data_type})
+                item['value'] += value
+        # A new running total carries on from the last stored one, e.g. after a restart, as
+        # the sum of the targets' counters differs from it by every earlier join and reset
+        unseeded = [name for name, item in update.items()
+                    if item['type'] != 'Gauge' and (self.filesystem.id, name) not in self.counters]
+        if unseeded:
+            latest, stored = MetricStore.fetch_last(self, unseeded)
+            for name in unseeded:
+                self.counters[self.filesystem.id, name] = stored.get(name, update[name]['value'])
+
+        for name, item in update.items():
+            if item['type'] != 'Gauge':
+                item['value'] = self.counters[self.filesystem.id, name]
+        return list(MetricStore.serialize(self, {update_time: update}))
+
+    def _strip(self, kind, data):
+        return dict((name[len(kind) + 1:], value) for name, value in data.items())
 
-    def fetch(self, cfname, query_class, **kwargs):
-        raise NotImplementedError("Filesystem-level fetch() not supported!")
+    def fetch(self, target_class, fetch_metrics, begin, end, max_points=float('inf'), num_points=0):
+        "Return datetimes with dicts of field names and values, totalled over a target class."
+        kind = self.kind(target_class)
+        names = ['{0}_{1}'.format(kind, name) for name in fetch_metrics]
+        result = MetricStore.fetch(self, names, begin, end, max_points, num_points)
+        return dict((dt, self._strip(kind, data)) for dt, data in result.items())
 
     def fetch_last(self, target_class, fetch_metrics):
         """
@@ -273,6 +464,11 @@ class FilesystemMetricStore(MetricStore):
         containing a single row of aggregate datapoints taken
         from each metric's last reading.
         """
+        kind = self.kind(target_class)
+        latest, data = MetricStore.fetch_last(self, ['{0}_{1}'.format(kind, name) for name in fetch_metrics])
+        if data:
+            return latest, self._strip(kind, data)
+        # totals have not been stored yet, so sum each target's latest values
         latest, counter = datetime.fromtimestamp(0, utc), Counter()
         for target in target_class.objects.filter(filesystem=self.filesystem):
             dt, data = target.metrics.fetch_last(fetch_metrics)
@@ -40,6 +40,7 @@ class StatefulObject(models.Model):
     route_map = None
     transition_map = None
     job_class_map = None
+    advertised_transition_map = None
 
     reverse_deps = {}
 
@@ -198,6 +199,33 @@ class StatefulObject(models.Model):
 
             return list(set(self.transition_map[begin_state]))
 
+    @classmethod
+    def get_advertised_transitions(cls, begin_state):
+        """Return a list of (end_state, job_class) for the states which should be advertised
+        from begin_state, where job_class is the last job in the route and has a state_verb (a
+        None verb means an internal transition).
+
+        This depends only on the class, so it is built once per class: callers must still check
+        job_class.can_run and the immutable_state of a particular instance.
+        """
+        if not begin_state in cls.states:
+            raise SchedulingError("%s not legal state for %s, legal states are %s" % (begin_state, cls, cls.states))
+
+        cls._build_maps()
+
+        cls_ = StatefulObject.so_root(cls)
+        if cls_.advertised_transition_map is None:
+            advertised_transition_map = defaultdict(list)
+            for state, end_states in cls_.transition_map.items():
+                for end_state in set(end_states):
+                    route = cls_.route_map[(state, end_state)]
+                    job_class = cls_.job_class_map[(route[-2], route[-1])]
+                    if job_class.state_verb:
+                        advertised_transition_map[state].append((end_state, job_class))
+            cls_.advertised_transition_map = advertised_transition_map
+
+        return cls_.advertised_transition_map[begin_state]
+
     def get_verb(self, begin_state, end_state):
         """Return the GUI short (verb) and long description of the Job that is last in the route between the states
 
@@ -527,6 +555,9 @@ class AdvertisedJob(Job):
     # this job on N objects is one job.
     plural = False
 
+    # Memo of get_advertised_for
+    _advertised_by_class = {}
+
     @classmethod
     def get_args(cls, objects):
         """
@@ -540,3 +571,22 @@ class AdvertisedJob(Job):
     def get_confirmation(cls, instance):
         """Return a string for the confirmation prompt, or None if no confirmation is needed"""
         return None
+
+    @staticmethod
+    def get_advertised_for(klass):
+        """Return the AdvertisedJob classes (other than plural ones) which are offered for
+        instances of klass.  Built once per class: callers must still check can_run for a
+        particular instance.
+        """
+        try:
+            return AdvertisedJob._advertised_by_class[klass]
+        except KeyError:
+            job_classes = []
+            for job_class in all_subclasses(AdvertisedJob):
+                if not job_class.plural:
+                    for class_name in job_class.classes:
+                        ct = ContentType.objects.get_by_natural_key('chroma_core', class_name.lower())
+                        if issubclass(klass, ct.model_class()):
+                            job_classes.append(job_class)
+            AdvertisedJob._advertised_by_class[klass] = job_classes
+            return job_classes
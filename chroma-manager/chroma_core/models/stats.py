@@ -3,13 +3,15 @@
 # license that can be found in the LICENSE file.
 
 
+import array
 import itertools
 import collections
 import calendar
 import operator
 import functools
 from datetime import datetime, timedelta
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Max
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.utils.timezone import utc
@@ -27,15 +29,16 @@ def total_seconds(td):
 
 
 class SampleInfo(object):
-    def __init__(self, sample_rate, expiration_time):
+    def __init__(self, sample_rate, expiration_time, cache_size):
         self.sample_rate = int(total_seconds(timedelta(**sample_rate)))
         self.expiration_time = timedelta(**expiration_time)
+        self.cache_size = cache_size
 
-SAMPLES = [SampleInfo({'seconds': 10}, settings.STATS_10_SECOND_EXPIRATION),
-           SampleInfo({'minutes': 1}, settings.STATS_1_MINUTE_EXPIRATION),
-           SampleInfo({'minutes': 5}, settings.STATS_5_MINUTE_EXPIRATION),
-           SampleInfo({'hours': 1}, settings.STATS_1_HOUR_EXPIRATION),
-           SampleInfo({'days': 1}, settings.STATS_1_DAY_EXPIRATION)]
+SAMPLES = [SampleInfo({'seconds': 10}, settings.STATS_10_SECOND_EXPIRATION, settings.STATS_10_SECOND_CACHE_SIZE),
+           SampleInfo({'minutes': 1}, settings.STATS_1_MINUTE_EXPIRATION, settings.STATS_1_MINUTE_CACHE_SIZE),
+           SampleInfo({'minutes': 5}, settings.STATS_5_MINUTE_EXPIRATION, settings.STATS_5_MINUTE_CACHE_SIZE),
+           SampleInfo({'hours': 1}, settings.STATS_1_HOUR_EXPIRATION, settings.STATS_1_HOUR_CACHE_SIZE),
+           SampleInfo({'days': 1}, settings.STATS_1_DAY_EXPIRATION, settings.STATS_1_DAY_CACHE_SIZE)]
 
 
 def div_samplerate(x, y):
@@ -72,14 +75,75 @@ epoch = datetime.fromtimestamp(0, utc)
 Point.zero = Point(epoch, 0.0, 0)
 
 
-class Cache(collections.defaultdict):
-    "Simple cache of limited size;  doesn't need to be LRU yet."
+class Cache(dict):
+    """Bounded LRU cache, optionally creating missing values from a default factory.
+    Hits, misses and evictions are counted to help size it for the number of series.
+    """
     SIZE = 1e5
 
+    def __init__(self, default_factory=None, size=None):
+        dict.__init__(self)
+        self.default_factory = default_factory
+        if size is not None:
+            self.SIZE = size
+        self.hits = self.misses = self.evictions = 0
+        self.order = collections.OrderedDict()  # keys from least to most recently used
+
+    def __getitem__(self, key):
+        try:
+            value = dict.__getitem__(self, key)
+        except KeyError:
+            self.misses += 1
+            if self.default_factory is None:
+                raise
+            value = self.default_factory()
+        else:
+            self.hits += 1
+        self[key] = value
+        return value
+
     def __setitem__(self, key, value):
-        collections.defaultdict.__setitem__(self, key, value)
-        if len(self) > self.SIZE:
-            self.clear()
+        self.order.pop(key, None)  # move to most recently used
+        self.order[key] = None
+        dict.__setitem__(self, key, value)
+        while len(self) > self.SIZE:
+            dict.__delitem__(self, self.order.popitem(last=False)[0])
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        del self.order[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self.misses += 1
+        self[key] = default
+        return default
+
+    def pop(self, key, *default):
+        self.order.pop(key, None)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        "Remove and return the least recently used item."
+        key = self.order.popitem(last=False)[0]
+        return key, dict.pop(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self.order.clear()
+
+    def info(self):
+        "Return dict of size, capacity and counters."
+        return {'size': len(self), 'capacity': self.SIZE, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
 
 
 class Series(models.Model):
@@ -98,22 +162,60 @@ class Series(models.Model):
         app_label = 'chroma_core'
         unique_together = ('content_type', 'object_id', 'name'),
 
-    cache = Cache(None)
+    cache = Cache(size=settings.STATS_SERIES_CACHE_SIZE)  # (content type id, object id, name) -> series
+    loaded = set()  # (content type id, object id) of measured objects whose series have all been cached
 
     @classmethod
     def get(cls, obj, name, type=''):
         "Return cached series for measured object and field, optionally creating it with given type."
-        try:
-            return cls.cache[obj, name]
-        except KeyError:
-            ct = ContentType.objects.get_for_model(obj)
-        if type:
-            assert type in cls.DATA_TYPES + cls.JOB_TYPES
-            series, created = cls.objects.get_or_create(content_type=ct, object_id=obj.id, name=name, type=type)
+        return cls.get_many(obj, {name: type})[name]
+
+    @classmethod
+    def get_many(cls, obj, types):
+        """Return mapping of field names to cached series for measured object, optionally creating them with given types.
+        The first cache miss for an object loads all of its series in one query;  missing series are created in bulk.
+        """
+        ct = ContentType.objects.get_for_model(obj).id
+        result, missing = {}, []
+        for name in types:
+            try:
+                result[name] = cls.cache[ct, obj.id, name]
+            except KeyError:
+                missing.append(name)
+        if not missing:
+            return result
+        query = cls.objects.filter(content_type=ct, object_id=obj.id)
+        if (ct, obj.id) in cls.loaded:
+            query = query.filter(name__in=missing)
         else:
-            series = cls.objects.get(content_type=ct, object_id=obj.id, name=name)
-        cls.cache[obj, name] = series
-        return series
+            cls.loaded.add((ct, obj.id))
+        series = dict((item.name, item) for item in query)
+        create = [name for name in missing if name not in series]
+        if create:
+            for name in create:
+                if not types[name]:
+                    raise cls.DoesNotExist("Series {0} does not exist".format(name))
+                assert types[name] in cls.DATA_TYPES + cls.JOB_TYPES
+            sid = transaction.savepoint()
+            try:
+                cls.objects.bulk_create(cls(content_type_id=ct, object_id=obj.id, name=name, type=types[name]) for name in create)
+            except IntegrityError:
+                # Collided with another creator, so use theirs
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+            series.update((item.name, item) for item in cls.objects.filter(content_type=ct, object_id=obj.id, name__in=create))
+        for name in missing:
+            result[name] = cls.cache[ct, obj.id, name] = series[name]
+        return result
+
+    @classmethod
+    def forget(cls, obj):
+        "Remove cached series for measured object."
+        ct = ContentType.objects.get_for_model(obj).id
+        cls.loaded.discard((ct, obj.id))
+        for key in [key for key in cls.cache if key[:2] == (ct, obj.id)]:
+            del cls.cache[key]
 
     @classmethod
     def filter(cls, obj, **kwargs):
@@ -121,12 +223,25 @@ class Series(models.Model):
         ct = ContentType.objects.get_for_model(obj)
         return cls.objects.filter(content_type=ct, object_id=obj.id, **kwargs)
 
+    @classmethod
+    def filter_many(cls, objs, **kwargs):
+        "Return queryset filtered for multiple measured objects, possibly of different types."
+        ids = collections.defaultdict(list)
+        for obj in objs:
+            ids[ContentType.objects.get_for_model(obj).id].append(obj.id)
+        if not ids:
+            return cls.objects.none()
+        query = reduce(operator.or_, (models.Q(content_type=ct, object_id__in=ids[ct]) for ct in ids))
+        return cls.objects.filter(query, **kwargs)
+
 
 class Sample(models.Model):
     """Abstract model for Sample tables.
     Only used for query generation.
     Subclasses require 'step', 'expiration_time', and 'cache' attributes.
     """
+    SELECT_CHUNK = 1000  # maximum number of series ids per query
+
     id = models.IntegerField(primary_key=True)  # for django only, not really the primary key
     dt = models.DateTimeField(db_index=True)
     sum = models.FloatField()
@@ -141,6 +256,32 @@ class Sample(models.Model):
         "Return most recent data point for series."
         return (cls.cache[id] or list(cls.select(id, order_by='-dt', limit=1)) or [Point.zero])[-1]
 
+    @classmethod
+    def latest_dt(cls, ids):
+        "Return most recent datetime across multiple series, querying only for uncached ids."
+        latest, missing = epoch, []
+        for id in ids:
+            cache = cls.cache.get(id)
+            if cache:
+                latest = max(latest, cache[-1].dt)
+            else:
+                missing.append(id)
+        for index in range(0, len(missing), cls.SELECT_CHUNK):
+            dt = cls.objects.filter(id__in=missing[index:index + cls.SELECT_CHUNK]).aggregate(Max('dt'))['dt__max']
+            latest = max(latest, dt or epoch)
+        return latest
+
+    @classmethod
+    def prefetch(cls, ids):
+        "Cache most recent data points of uncached series in bulk;  series without points cache the zero point."
+        missing = [id for id in ids if not cls.cache.get(id)]
+        for index in range(0, len(missing), cls.SELECT_CHUNK):
+            chunk = missing[index:index + cls.SELECT_CHUNK]
+            query = cls.objects.filter(id__in=chunk).order_by('id', '-dt').distinct('id')
+            latest = dict((row[0], Point(*row[1:])) for row in query.values_list('id', *Point._fields))
+            for id in chunk:
+                cls.cache[id].append(latest.get(id, Point.zero))
+
     @classmethod
     def start(cls, id):
         "Return earliest datetime that should be stored for series."
@@ -166,6 +307,16 @@ class Sample(models.Model):
         query = cls.objects.filter(id=id, **filters).order_by(order_by)[:limit]
         return itertools.starmap(Point, query.values_list(*Point._fields))
 
+    @classmethod
+    def select_many(cls, ids, **filters):
+        "Generate (id, points) for multiple series, in chunked id__in queries."
+        ids = sorted(set(ids))
+        for index in range(0, len(ids), cls.SELECT_CHUNK):
+            query = cls.objects.filter(id__in=ids[index:index + cls.SELECT_CHUNK], **filters).order_by('id', 'dt')
+            rows = query.values_list('id', *Point._fields)
+            for id, group in itertools.groupby(rows, key=operator.itemgetter(0)):
+                yield id, [Point(*row[1:]) for row in group]
+
     @classmethod
     def insert(cls, stats):
         "Bulk insert mapping of series ids to points."
@@ -182,17 +333,86 @@ class Sample(models.Model):
         models.sql.DeleteQuery(cls).do_query(cls._meta.db_table, query.query.where, query.db)
 
     @classmethod
-    def expire(cls, ids):
-        if settings.STATS_SIMPLE_WIPE:
-            "We also have a general flush added in for 2.2 which just clears everything old every so often!"
-            now = datetime.now(utc)
-            if now > cls.next_flush_orphans_time:
-                cls.delete(dt__lt=now - cls.expiration_time)
-                cls.next_flush_orphans_time = now + cls.flush_orphans_interval
-        else:
-            "Delete earliest points from multiple series."
-            if ids:
-                cls.delete(id__in=ids, dt__lt=min(map(cls.start, ids)))
+    def delete_expired(cls, cutoff, limit):
+        "Delete up to limit points older than cutoff;  return the number of points deleted."
+        cursor = connection.cursor()
+        table = connection.ops.quote_name(cls._meta.db_table)
+        cursor.execute("DELETE FROM {0} WHERE ctid = ANY(ARRAY(SELECT ctid FROM {0} WHERE dt < %s LIMIT %s))".format(table),
+                       [cutoff, limit])
+        transaction.commit_unless_managed()
+        return cursor.rowcount
+
+
+class Rollup(object):
+    """Aggregate points into coarser samples for batches of series at once.
+    Points are gathered into columns of ids, integer timestamps, sums and lens, which are floored, grouped and summed
+    in a single pass.  Conversions between datetimes and timestamps are shared across series and tiers.
+    """
+    def __init__(self):
+        self.timestamps, self.datetimes = {}, {}
+
+    def timestamp(self, dt):
+        try:
+            return self.timestamps[dt]
+        except KeyError:
+            value = self.timestamps[dt] = timestamp(dt)
+            return value
+
+    def datetime(self, ts):
+        try:
+            return self.datetimes[ts]
+        except KeyError:
+            value = self.datetimes[ts] = epoch + timedelta(seconds=ts)
+            return value
+
+    def columns(self, stats):
+        "Return arrays of ids, timestamps, sums and lens from mapping of series ids to sorted points."
+        ids, timestamps, sums, lens = array.array('l'), array.array('l'), array.array('d'), array.array('l')
+        for id in stats:
+            points = stats[id]
+            ids.extend([id] * len(points))
+            timestamps.extend(self.timestamp(point.dt) for point in points)
+            sums.extend(point.sum for point in points)
+            lens.extend(point.len for point in points)
+        return ids, timestamps, sums, lens
+
+    def reduce(self, step, columns):
+        "Return mapping of series ids to points grouped and summed by sample size."
+        ids, timestamps, sums, lens = columns
+        floors = array.array('l', (ts - ts % step for ts in timestamps))
+        result, key = {}, None
+        for index in xrange(len(ids)):
+            if (ids[index], floors[index]) != key:
+                if key is not None:
+                    result.setdefault(key[0], []).append(Point(self.datetime(key[1]), total, count))
+                key, total, count = (ids[index], floors[index]), 0.0, 0
+            total += sums[index]
+            count += lens[index]
+        if key is not None:
+            result.setdefault(key[0], []).append(Point(self.datetime(key[1]), total, count))
+        return result
+
+    def __call__(self, previous, model, stats):
+        "Return mapping of series ids to new points for model, aggregated from previous Sample as necessary."
+        model.prefetch(stats)
+        step, points, missing = model.step, {}, {}
+        for id in stats:
+            start = self.timestamp(model.latest(id).dt) + step
+            stop = self.timestamp(max(stats[id]).dt)
+            stop -= stop % step
+            if start >= stop:
+                continue
+            cache = previous.cache[id]
+            if cache and self.datetime(start) >= cache[0].dt and self.datetime(stop) <= cache[-1].dt:  # use cache if full
+                points[id] = [point for point in cache if start <= self.timestamp(point.dt) < stop and point.len]
+            else:
+                missing[id] = start, stop
+        if missing:
+            begin, end = min(missing.values())[0], max(stop for start, stop in missing.values())
+            for id, selected in previous.select_many(missing, dt__gte=self.datetime(begin), dt__lt=self.datetime(end)):
+                start, stop = missing[id]
+                points[id] = [point for point in selected if start <= self.timestamp(point.dt) < stop]
+        return self.reduce(step, self.columns(points))
 
 
 class Stats(list):
@@ -200,7 +420,7 @@ class Stats(list):
     def __init__(self, samples):
         maxlen = max(map(div_samplerate, samples[1:], samples[:-1]))
         for sample in samples:
-            cache = Cache(functools.partial(collections.deque, maxlen=maxlen))
+            cache = Cache(functools.partial(collections.deque, maxlen=maxlen), sample.cache_size)
             namespace = {'__module__': 'chroma_core.models',
                          'step': sample.sample_rate,
                          'expiration_time': sample.expiration_time,
@@ -211,6 +431,8 @@ class Stats(list):
 
     def insert(self, samples):
         "Bulk insert new samples (id, dt, value).  Skip and return outdated samples."
+        samples = list(samples)
+        self[0].prefetch(set(sample[0] for sample in samples))
         # keep stats as Points grouped by id
         outdated, stats = [], collections.defaultdict(list)
         for id, dt, value in samples:
@@ -218,28 +440,37 @@ class Stats(list):
                 stats[id].append(Point(dt, value, 1))
             else:
                 outdated.append((id, dt, value))
-        # insert stats into first Sample and check the rest
+        # insert stats into first Sample and roll up the rest;  expired points are left to Stats.retain
         self[0].insert(stats)
+        rollup = Rollup()
         for previous, model in zip(self, self[1:]):
-            step = timedelta(seconds=model.step)
-            for id in list(stats):
-                start = model.latest(id).dt + step
-                stop = model.floor(max(stats.pop(id)).dt)
-                cache = previous.cache[id]
-                # aggregate from previous Sample as necessary
-                if start < stop:
-                    if cache and start >= cache[0].dt and stop <= cache[-1].dt:  # use cache if full
-                        points = (point for point in cache if start <= point.dt < stop and point.len)
-                    else:
-                        points = previous.select(id, dt__gte=start, dt__lt=stop)
-                    points = list(model.reduce(points))
-                    if points:
-                        stats[id] = points
-            previous.expire(stats)
+            stats = rollup(previous, model, stats)
             model.insert(stats)
-        model.expire(stats)
         return outdated
 
+    def retain(self, now, limit, chunks=float('inf')):
+        """Delete points older than each Sample's expiration time, for those Samples which are due.
+        Deletes are done in chunks of limit points, up to the given number of chunks per Sample.
+        Return the number of points deleted.
+        """
+        deleted = 0
+        for model in self:
+            if now < model.next_flush_orphans_time:
+                continue
+            count, cutoff = 0, now - model.expiration_time
+            while count < chunks:
+                rows = model.delete_expired(cutoff, limit)
+                deleted += rows
+                count += 1
+                if rows < limit:
+                    model.next_flush_orphans_time = now + model.flush_orphans_interval
+                    break
+        return deleted
+
+    def next_retention(self):
+        "Return datetime at which the next Sample is due for retention."
+        return min(model.next_flush_orphans_time for model in self)
+
     def select(self, id, start, stop, rate=False, maxlen=float('inf'), fixed=0):
         """Return points for a series within inclusive interval of most granular samples.
         Optionally derive the rate of change of points.
@@ -251,6 +482,36 @@ class Stats(list):
             if start >= model.start(id) and model.step >= minstep:
                 break
         points = model.select(id, dt__gte=start, dt__lt=stop)
+        return self._process(points, index, model, start, stop, rate, fixed)
+
+    def resolve(self, ids, start, stop, maxlen=float('inf')):
+        "Return index and Sample model of the single resolution to use for selecting multiple series."
+        minstep = total_seconds(stop - start) / maxlen
+        for index, model in enumerate(self):
+            try:
+                first = model.latest_dt(ids) - model.expiration_time
+            except OverflowError:
+                first = epoch
+            if start >= first and model.step >= minstep:
+                break
+        return index, model
+
+    def select_many(self, ids, start, stop, rate=False, maxlen=float('inf'), fixed=0):
+        """Return mapping of series ids to points within inclusive interval of most granular samples.
+        A single resolution is chosen for all series, and points are read in bulk.
+        Options are as for select.
+        """
+        ids = list(ids)
+        if not ids:
+            return {}
+        index, model = self.resolve(ids, start, stop, maxlen)
+        result = dict.fromkeys(ids, ())
+        result.update(model.select_many(ids, dt__gte=start, dt__lt=stop))
+        return dict((id, self._process(result[id], index, model, start, stop, rate, fixed)) for id in result)
+
+    @staticmethod
+    def _process(points, index, model, start, stop, rate, fixed):
+        "Return selected points, reduced, derived and padded as requested."
         points = list(points if index else model.reduce(points))
         if rate:
             points = map(operator.sub, points[1:], points[:-1])
@@ -262,6 +523,13 @@ class Stats(list):
             points = intervals
         return points
 
+    def cache_info(self):
+        "Return cache sizes and counters for series and each Sample model."
+        info = {'series': Series.cache.info()}
+        for model in self:
+            info[model.__name__] = model.cache.info()
+        return info
+
     def latest(self, id):
         "Return most recent data point."
         point = self[0].latest(id)
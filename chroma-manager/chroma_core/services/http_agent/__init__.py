@@ -22,7 +22,7 @@ log = log_register(__name__)
 
 
 class HttpAgentRpc(ServiceRpcInterface):
-    methods = ['reset_session', 'remove_host', 'reset_plugin_sessions']
+    methods = ['reset_session', 'remove_host', 'reset_plugin_sessions', 'get_queue_stats']
 
 
 # TODO: interesting tests:
@@ -40,6 +40,21 @@ class Service(ChromaService):
     def reset_plugin_sessions(self, plugin):
         return self.sessions.reset_plugin_sessions(plugin)
 
+    def get_queue_stats(self):
+        """Return the depth of each host's queue of messages waiting to be sent, and
+        how many have been discarded because the queue was full"""
+        return self.queues.stats()
+
+    def _tx_overflow(self, fqdn, plugin, session_id):
+        # The agent will never see the discarded message, so end the session
+        # unless it has already been replaced
+        try:
+            self.sessions.get(fqdn, plugin, session_id)
+        except KeyError:
+            pass
+        else:
+            self.sessions.reset_session(fqdn, plugin, session_id)
+
     def remove_host(self, fqdn):
         log.info("remove_host: %s" % fqdn)
 
@@ -59,7 +74,7 @@ class Service(ChromaService):
     def __init__(self):
         super(Service, self).__init__()
 
-        self.queues = HostQueueCollection()
+        self.queues = HostQueueCollection(overflow_callback = self._tx_overflow)
         self.sessions = SessionCollection(self.queues)
         self.hosts = HostStateCollection()
         self.valid_certs = dict(ClientCertificate.objects.filter(revoked=False).values_list('serial', 'host__fqdn'))
@@ -4,9 +4,16 @@
 
 
 import Queue
+import collections
 import threading
+import time
+
+from kombu.pools import producers
+
 from chroma_core.services import _amqp_connection, log_register
-from chroma_core.services.queue import ServiceQueue
+from chroma_core.services.queue import ServiceQueue, publish
+
+import settings
 
 
 class AgentTxQueue(ServiceQueue):
@@ -17,8 +24,13 @@ log = log_register(__name__)
 
 
 class HostQueueCollection(object):
-    def __init__(self):
+    def __init__(self, overflow_callback = None):
+        """
+        :param overflow_callback: Called with (fqdn, plugin, session_id) when a DATA message
+        for a session has been discarded because the host's TX queue was full
+        """
         self._host_queues = {}
+        self._overflow_callback = overflow_callback
 
         # A queue for all plugin RX messages, will be fanned
         # out to an AMQP queue per plugin
@@ -41,18 +53,110 @@ class HostQueueCollection(object):
 
     def send(self, message):
         queues = self.get(message['fqdn'])
-        queues.tx.put(message)
+        dropped = queues.tx.put(message)
+        if dropped is not None:
+            log.warning("TX queue for %s full, discarded message for %s/%s" % (dropped['fqdn'], dropped['plugin'], dropped['session_id']))
+            if self._overflow_callback:
+                self._overflow_callback(dropped['fqdn'], dropped['plugin'], dropped['session_id'])
+
+    def stats(self):
+        """Return {fqdn: TxQueue.stats()} for each host"""
+        with self._lock:
+            host_queues = self._host_queues.items()
+        return dict((fqdn, queues.tx.stats()) for fqdn, queues in host_queues)
 
     def receive(self, message):
         self.plugin_rx_queue.put(message)
 
 
+class TxQueue(object):
+    """FIFO of messages waiting to be sent to a host, holding at most
+    settings.HTTP_AGENT_TX_QUEUE_LIMIT DATA messages.
+
+    Other (session control and barrier) messages are few and always accepted.  When
+    a DATA message arrives at a full queue, either the oldest queued DATA message or
+    the new one is discarded, according to settings.HTTP_AGENT_TX_QUEUE_OVERFLOW
+    ('drop_oldest' or 'drop_newest').
+
+    get() raises Queue.Empty like Queue.Queue.get.
+    """
+    def __init__(self):
+        self._messages = collections.deque()
+        self._data_count = 0
+        self._condition = threading.Condition()
+
+        self.dropped = 0
+        self.max_depth = 0
+
+    def put(self, message):
+        """Queue a message, and return any message which was discarded to make room or None"""
+        dropped = None
+        with self._condition:
+            if message['type'] == 'DATA':
+                if self._data_count >= settings.HTTP_AGENT_TX_QUEUE_LIMIT:
+                    self.dropped += 1
+                    if settings.HTTP_AGENT_TX_QUEUE_OVERFLOW == 'drop_newest':
+                        return message
+                    for i, queued in enumerate(self._messages):
+                        if queued['type'] == 'DATA':
+                            dropped = queued
+                            del self._messages[i]
+                            break
+                else:
+                    self._data_count += 1
+
+            self._messages.append(message)
+            self.max_depth = max(self.max_depth, len(self._messages))
+            self._condition.notify()
+
+        return dropped
+
+    def put_front(self, message):
+        """Return a message taken by get() to the head of the queue"""
+        with self._condition:
+            self._messages.appendleft(message)
+            if message['type'] == 'DATA':
+                self._data_count += 1
+            self._condition.notify()
+
+    def get(self, block = True, timeout = None):
+        with self._condition:
+            if block:
+                deadline = None if timeout is None else time.time() + timeout
+                while not self._messages:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+            if not self._messages:
+                raise Queue.Empty()
+
+            message = self._messages.popleft()
+            if message['type'] == 'DATA':
+                self._data_count -= 1
+            return message
+
+    def qsize(self):
+        with self._condition:
+            return len(self._messages)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'depth': len(self._messages),
+                'data_depth': self._data_count,
+                'max_depth': self.max_depth,
+                'dropped': self.dropped
+            }
+
+
 class HostQueues(object):
     """Both directions of messages for a single host"""
     def __init__(self, fqdn):
         self.fqdn = fqdn
         self.rx = Queue.Queue()
-        self.tx = Queue.Queue()
+        self.tx = TxQueue()
         self.tx_lock = threading.Lock()
 
 
@@ -62,21 +166,27 @@ class AmqpRxForwarder(object):
         self._queue_collection = queue_collection
 
     def run(self):
-        with _amqp_connection() as conn:
-            while not self._stopping.is_set():
-                try:
-                    msg = self._queue_collection.plugin_rx_queue.get(block = True, timeout = 1)
-                except Queue.Empty:
-                    pass
-                else:
-                    plugin_name = msg['plugin']
-                    rx_queue_name = "agent_%s_rx" % plugin_name
-                    q = conn.SimpleQueue(rx_queue_name, serializer = 'json',
-                                         exchange_opts={'durable': False}, queue_opts={'durable': False})
-                    q.put(msg)
+        rx_queue = self._queue_collection.plugin_rx_queue
+        while not self._stopping.is_set():
+            # Blocks until there is a message, or stop() wakes us with None
+            msg = rx_queue.get(block = True)
+            if msg is None:
+                continue
+
+            # Forward everything that has queued up while holding one producer
+            with producers[_amqp_connection()].acquire(block = True) as producer:
+                while msg is not None:
+                    publish(producer, "agent_%s_rx" % msg['plugin'], msg, serializer = 'json')
+                    if self._stopping.is_set():
+                        break
+                    try:
+                        msg = rx_queue.get_nowait()
+                    except Queue.Empty:
+                        msg = None
 
     def stop(self):
         self._stopping.set()
+        self._queue_collection.plugin_rx_queue.put(None)
 
 
 class AmqpTxForwarder(object):
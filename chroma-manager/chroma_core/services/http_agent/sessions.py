@@ -18,8 +18,22 @@ class SessionCollection(object):
         self._queues = queues
 
     def remove_host(self, fqdn):
+        """
+        Forget the sessions of a host which has been removed, telling services
+        that they are over.
+        """
         with self._lock:
-            self._sessions.pop(fqdn, None)
+            for (session_fqdn, plugin), session in self._sessions.items():
+                if session_fqdn == fqdn:
+                    self._queues.receive({
+                        'fqdn': fqdn,
+                        'type': 'SESSION_TERMINATE',
+                        'plugin': plugin,
+                        'session_id': session.id,
+                        'session_seq': None,
+                        'body': None
+                    })
+                    del self._sessions[(session_fqdn, plugin)]
 
     def get(self, fqdn, plugin, id = None):
         with self._lock:
@@ -70,13 +84,19 @@ class SessionCollection(object):
 
     def reset_session(self, fqdn, plugin, session_id):
         """
-        This is a reset in the TX direction, to tell the agent that a session has gone away
+        This is a reset in the TX direction, to tell the agent that a session has gone away.
+
+        If session_id is given, the session is only reset if it is still the current one, as
+        a request about a session which has since been replaced must not end its successor.
         """
         with self._lock:
-            if (fqdn, plugin) in self._sessions:
-                self._reset_session(fqdn, plugin, session_id)
-            else:
+            session = self._sessions.get((fqdn, plugin))
+            if session is None:
                 log.warning("Ignoring request to terminate unknown session %s/%s/%s" % (fqdn, plugin, session_id))
+            elif session_id is not None and session.id != session_id:
+                log.info("Ignoring request to terminate replaced session %s/%s/%s" % (fqdn, plugin, session_id))
+            else:
+                self._reset_session(fqdn, plugin, session_id)
 
     def reset_plugin_sessions(self, victim_plugin):
         """
@@ -16,7 +16,6 @@ import itertools
 from collections import defaultdict
 import Queue
 from copy import deepcopy
-from chroma_core.lib.util import all_subclasses
 
 
 from django.contrib.contenttypes.models import ContentType
@@ -46,6 +45,7 @@ from chroma_core.services.job_scheduler.dep_cache import DepCache
 from chroma_core.services.job_scheduler.lock_cache import LockCache
 from chroma_core.services.job_scheduler.command_plan import CommandPlan
 from chroma_core.services.job_scheduler.agent_rpc import AgentException
+from chroma_core.services.worker_pool import WorkerPool
 from chroma_core.services.plugin_runner.agent_daemon_interface import AgentDaemonRpcInterface
 from chroma_core.services.rpc import RpcError
 from chroma_core.services.log import log_register
@@ -57,6 +57,8 @@ from chroma_help.help import help_text
 import chroma_core.lib.conf_param
 from chroma_core.lib.long_polling import long_polling
 
+import settings
+
 log = log_register(__name__.split('.')[-1])
 
 
@@ -238,15 +240,16 @@ class JobProgress(threading.Thread, Queue.Queue):
             result.save()
 
 
-class RunJobThread(threading.Thread):
+class RunJobThread(object):
+    """Run the steps of a job, on a thread from the JobScheduler's worker pool"""
     CANCEL_TIMEOUT = 30
 
     def __init__(self, job_progress, connection_quota, job, steps):
-        super(RunJobThread, self).__init__()
         self.job = job
         self._job_progress = job_progress
         self._connection_quota = connection_quota
         self._cancel = threading.Event()
+        self._started = False
         self._complete = threading.Event()
         self.steps = steps
 
@@ -256,6 +259,11 @@ class RunJobThread(threading.Thread):
         log.info("Job %s: waiting %ss for run to complete" % (self.job.id, self.CANCEL_TIMEOUT))
 
     def cancel_complete(self):
+        if not self._started:
+            # Still waiting for a thread, it will return as soon as it gets one
+            log.info("Job %s: cancelled before starting" % self.job.id)
+            return
+
         self._complete.wait(self.CANCEL_TIMEOUT)
         if self._complete.is_set():
             log.info("Job %s: cancel completed" % self.job.id)
@@ -264,6 +272,8 @@ class RunJobThread(threading.Thread):
             log.error("Job %s: cancel timed out, will continue as zombie thread!" % self.job.id)
 
     def run(self):
+        self._started = True
+
         if django.db.connection.connection:
             log.error("RunJobThread started with a DB connection!")
 
@@ -364,10 +374,48 @@ class JobCollection(object):
         self._command_to_jobs = defaultdict(set)
         self._job_to_commands = defaultdict(set)
 
+        # Readiness of pending jobs is tracked as jobs are added and complete, rather than
+        # by rescanning every pending job: the number of incomplete jobs each pending job
+        # waits for, the pending jobs waiting for each job, and the pending jobs waiting for none.
+        self._wait_counts = {}
+        self._waiters = defaultdict(set)
+        self._ready = {}
+
     def add(self, job):
+        if job.id not in self._jobs:
+            if job.state == 'pending':
+                wait_for_ids = set(json.loads(job.wait_for_json)) - set(self._state_jobs['complete'])
+                self._wait_counts[job.id] = len(wait_for_ids)
+                for wait_for_id in wait_for_ids:
+                    self._waiters[wait_for_id].add(job.id)
+                if not wait_for_ids:
+                    self._ready[job.id] = job
+            elif job.state == 'complete':
+                self._release_waiters(job.id)
+
         self._jobs[job.id] = job
         self._state_jobs[job.state][job.id] = job
 
+    def _release_waiters(self, job_id):
+        """Count job_id as complete for the jobs waiting for it, making ready any with nothing left to wait for"""
+        for waiter_id in self._waiters.pop(job_id, ()):
+            if waiter_id not in self._wait_counts:
+                # No longer pending (e.g. cancelled), so no longer waiting
+                continue
+            self._wait_counts[waiter_id] -= 1
+            if self._wait_counts[waiter_id] == 0:
+                del self._wait_counts[waiter_id]
+                waiter = self._jobs[waiter_id]
+                if waiter.state == 'pending':
+                    self._ready[waiter_id] = waiter
+
+    def _state_changed(self, job):
+        if job.state != 'pending':
+            self._ready.pop(job.id, None)
+            self._wait_counts.pop(job.id, None)
+            if job.state == 'complete':
+                self._release_waiters(job.id)
+
     def add_command(self, command, jobs):
         """Add command if it doesn't already exist, and ensure that all
         of `jobs` are associated with it
@@ -398,6 +446,8 @@ class JobCollection(object):
         else:
             self._state_jobs[job.state][job.id] = job
 
+        self._state_changed(job)
+
     def update_commands(self, job):
         """
         Update any commands which relate to this job (complete the command if all its jobs are complete)
@@ -421,17 +471,14 @@ class JobCollection(object):
             del self._state_jobs[job.state][job.id]
             job.state = new_state
             self._state_jobs[job.state][job.id] = job
+            self._state_changed(job)
 
         Job.objects.filter(id__in = [j.id for j in jobs]).update(state = new_state)
 
     @property
     def ready_jobs(self):
-        result = []
-        for job in self._state_jobs['pending'].values():
-            wait_for_ids = json.loads(job.wait_for_json)
-            complete_job_ids = [j.id for j in self._state_jobs['complete'].values()]
-            if not set(wait_for_ids) - set(complete_job_ids):
-                result.append(job)
+        """Pending jobs whose wait_for jobs are all complete, in job id order"""
+        result = sorted(self._ready.values(), key = lambda job: job.id)
 
         if len(result) == 0 and len(self.pending_jobs) == 0 and len(self.tasked_jobs) == 0:
             # A quiescent state, flush the collection (avoid building up an indefinitely
@@ -474,6 +521,7 @@ class JobScheduler(object):
         self._notification_buffer = NotificationBuffer()
 
         self._db_quota = SimpleConnectionQuota(self.MAX_STEP_DB_CONNECTIONS)
+        self._job_pool = WorkerPool('job_scheduler', settings.JOB_SCHEDULER_WORKERS)
         self._run_threads = {}  # Map of job ID to RunJobThread
 
         self.progress = JobProgress(self)
@@ -483,31 +531,34 @@ class JobScheduler(object):
         self.completion_hooks = []
 
     def join_run_threads(self):
-        for job_id, thread in self._run_threads.items():
-            log.info("Joining thread for job %s" % job_id)
-            thread.join()
+        log.info("Joining threads for jobs %s" % self._run_threads.keys())
+        self._job_pool.stop()
+        self._job_pool.join()
 
     def _run_next(self):
-        ready_jobs = self._job_collection.ready_jobs
+        while True:
+            ready_jobs = self._job_collection.ready_jobs
 
-        log.info("run_next: %d runnable jobs of (%d pending, %d tasked)" % (
-            len(ready_jobs),
-            len(self._job_collection.pending_jobs),
-            len(self._job_collection.tasked_jobs)))
+            log.info("run_next: %d runnable jobs of (%d pending, %d tasked)" % (
+                len(ready_jobs),
+                len(self._job_collection.pending_jobs),
+                len(self._job_collection.tasked_jobs)))
 
-        dep_cache = DepCache()
-        ok_jobs, cancel_jobs = self._check_jobs(ready_jobs, dep_cache)
+            # Dependencies are cached for this pass only: they are computed from other objects
+            # (target mounts, host configurations, the MGS) which may change between passes
+            dep_cache = DepCache()
+            ok_jobs, cancel_jobs = self._check_jobs(ready_jobs, dep_cache)
 
-        for job in cancel_jobs:
-            self._complete_job(job, False, True)
+            for job in cancel_jobs:
+                self._complete_job(job, False, True)
 
-        self._job_collection.update_many(ok_jobs, 'tasked')
-        for job in ok_jobs:
-            self._spawn_job(job)
+            self._job_collection.update_many(ok_jobs, 'tasked')
+            for job in ok_jobs:
+                self._spawn_job(job)
 
-        if cancel_jobs:
-            # Cancellations may have made some jobs ready, run me again
-            self._run_next()
+            # Cancellations may have made some jobs ready, check those
+            if not cancel_jobs:
+                break
 
     def _check_jobs(self, jobs, dep_cache):
         """Return the list of jobs which pass their checks"""
@@ -549,8 +600,10 @@ class JobScheduler(object):
             assert job.id not in self._run_threads
             self._run_threads[job.id] = thread
 
-            thread.start()
-            log.debug('_spawn_job: %s threads in flight' % len(self._run_threads))
+            # Jobs are taken from the pool's queue by class in turn, so that a burst of one kind of
+            # job (e.g. setting up many hosts) does not hold up the rest
+            self._job_pool.submit(job.__class__.__name__, thread.run)
+            log.debug('_spawn_job: %s jobs in flight, pool %s' % (len(self._run_threads), self._job_pool.stats()))
         else:
             log.debug('_spawn_job: No steps for %s, completing' % job.pk)
             # No steps: skip straight to completion
@@ -920,6 +973,7 @@ class JobScheduler(object):
 
                             ObjectCache.update(lock.locked_item)
 
+
                 if job.state != 'tasked':
                     # This happens if a Job is cancelled while it's calling this
                     log.info("Job %s has state %s in complete_job" % (job.id, job.state))
@@ -1396,12 +1450,8 @@ class JobScheduler(object):
                         # which will
                         # be available when current jobs are complete)
                         #  See method self.get_expected_state(stateful_object)
-                        from_state = stateful_object.state
-                        available_states = stateful_object.get_available_states(from_state)
-                        log.debug("available_transitions from_state: %s, states: %s" % (from_state, available_states))
-
                         # Add the job verbs to the possible state transitions for displaying as a choice.
-                        transitions[obj_id] = self._add_verbs(stateful_object, available_states)
+                        transitions[obj_id] = self._advertised_transitions(stateful_object)
 
             return transitions
 
@@ -1438,27 +1488,42 @@ class JobScheduler(object):
 
         return transitions
 
+    def _advertised_transitions(self, stateful_object):
+        """Equivalent to _add_verbs on the available states of stateful_object, using the
+        per class advertisement table so that only can_run is checked for each transition.
+        """
+
+        if stateful_object.immutable_state:
+            return []
+
+        transitions = []
+        for to_state, job_class in stateful_object.get_advertised_transitions(stateful_object.state):
+            if job_class.can_run(stateful_object):
+                transitions.append({
+                    'state': to_state,
+                    'verb': job_class.state_verb,
+                    'long_description': job_class.long_description(stateful_object),
+                    'display_group': job_class.display_group,
+                    'display_order': job_class.display_order
+                })
+
+        return transitions
+
     def _fetch_jobs(self, stateful_object):
         from chroma_core.models import AdvertisedJob
 
         available_jobs = []
-        for job_class in all_subclasses(AdvertisedJob):
-            if not job_class.plural:
-                for class_name in job_class.classes:
-                    ct = ContentType.objects.get_by_natural_key(
-                        'chroma_core', class_name.lower())
-                    klass = ct.model_class()
-                    if isinstance(stateful_object, klass):
-                        if job_class.can_run(stateful_object):
-                            available_jobs.append({
-                                'verb': job_class.verb,
-                                'long_description': job_class.long_description(stateful_object),
-                                'display_group': job_class.display_group,
-                                'display_order': job_class.display_order,
-                                'confirmation': job_class.get_confirmation(
-                                    stateful_object),
-                                'class_name': job_class.__name__,
-                                'args': job_class.get_args(stateful_object)})
+        for job_class in AdvertisedJob.get_advertised_for(stateful_object.__class__):
+            if job_class.can_run(stateful_object):
+                available_jobs.append({
+                    'verb': job_class.verb,
+                    'long_description': job_class.long_description(stateful_object),
+                    'display_group': job_class.display_group,
+                    'display_order': job_class.display_order,
+                    'confirmation': job_class.get_confirmation(
+                        stateful_object),
+                    'class_name': job_class.__name__,
+                    'args': job_class.get_args(stateful_object)})
         return available_jobs
 
     def available_jobs(self, object_list):
@@ -1503,13 +1568,55 @@ class JobScheduler(object):
 
         try:
             object = JobScheduler._retrieve_stateful_object(obj_key, obj_id)
-            locks['read'] = list(set([x.job.id for x in self._lock_cache.read_by_item[object]]))
-            locks['write'] = list(set([x.job.id for x in self._lock_cache.write_by_item[object]]))
+            locks['read'] = list(set([x.job.id for x in self._lock_cache.read_by_item.get(object, [])]))
+            locks['write'] = list(set([x.job.id for x in self._lock_cache.write_by_item.get(object, [])]))
         except ObjectDoesNotExist:
             pass
 
         return locks
 
+    def object_state_summary(self, object_list):
+        """Compute the available transitions, available jobs and locks for each stateful object
+
+        Equivalent to calling available_transitions, available_jobs and get_locks for every
+        object in object_list, for use by API list views.  The objects are read from the DB
+        (for the same reason as available_transitions) with one query per model class, before
+        taking the scheduler lock, which is then taken once for the whole list.
+
+        An object which does not exist has no transitions, jobs or locks, and an object which
+        is locked by an incomplete job has no transitions or jobs.
+
+        :param object_list: list of serialized tuples: [(obj_key, obj_id), ...]
+        :return: dict like {obj_id: {'transitions': [...], 'jobs': [...], 'locks': {'read': [...], 'write': [...]}}, }
+        """
+
+        ids_by_key = defaultdict(set)
+        for obj_key, obj_id in object_list:
+            ids_by_key[tuple(obj_key)].add(obj_id)
+
+        stateful_objects = {}
+        for obj_key, obj_ids in ids_by_key.items():
+            model_klass = ContentType.objects.get_by_natural_key(*obj_key).model_class()
+            for stateful_object in model_klass.objects.filter(id__in=obj_ids):
+                stateful_objects[(obj_key, stateful_object.id)] = stateful_object
+
+        with self._lock:
+            summary = {}
+            for obj_key, obj_id in object_list:
+                transitions, jobs, locks = [], [], {'read': [], 'write': []}
+                stateful_object = stateful_objects.get((tuple(obj_key), obj_id))
+                if stateful_object is not None:
+                    read_locks = self._lock_cache.read_by_item.get(stateful_object, [])
+                    write_locks = self._lock_cache.write_by_item.get(stateful_object, [])
+                    locks['read'] = list(set([x.job.id for x in read_locks]))
+                    locks['write'] = list(set([x.job.id for x in write_locks]))
+                    if not write_locks:
+                        transitions = self._advertised_transitions(stateful_object)
+                        jobs = self._fetch_jobs(stateful_object)
+                summary[obj_id] = {'transitions': transitions, 'jobs': jobs, 'locks': locks}
+
+            return summary
+
     def update_nids(self, nid_list):
         # Although this is creating/deleting a NID it actually rewrites the whole NID configuration for the node
         # this is all in here for now, but as we move to dynamic lnet it will probably get it's own file.
@@ -41,6 +41,7 @@ class JobSchedulerRpc(ServiceRpcInterface):
                'available_transitions',
                'available_jobs',
                'get_locks',
+               'object_state_summary',
                'update_corosync_configuration',
                'get_transition_consequences',
                'tables_changed',
@@ -102,6 +103,15 @@ class JobSchedulerClient(object):
 
         return JobSchedulerRpc().available_jobs(object_list)
 
+    @classmethod
+    def object_state_summary(cls, object_list):
+        """Return the transitions, jobs and locks for each object in list, in one call.
+
+        See the Job Scheduler method of the same name for details.
+        """
+
+        return JobSchedulerRpc().object_state_summary(object_list)
+
     @classmethod
     def get_transition_consequences(cls, stateful_object, new_state):
         """Query what the side effects of a state transition are.  Effectively does
@@ -3,11 +3,66 @@
 # license that can be found in the LICENSE file.
 
 
+import bisect
+import itertools
 from collections import defaultdict
 import json
 from django.db.models import Q
 
 
+class JobOrderedLocks(object):
+    """The locks on one item, ordered by job id and then by the order they were added.
+
+    Jobs are almost always added in job id order and complete roughly oldest first, so adding
+    is an append, removing the oldest lock advances a head index (the list is compacted once
+    half of it is dead), and finding a lock to remove, the latest lock or the locks after a job
+    is a bisection rather than a sort or scan of every lock on the item.
+    """
+
+    def __init__(self):
+        self._head = 0
+        self._job_ids = []
+        self._locks = []
+
+    def __iter__(self):
+        return itertools.islice(self._locks, self._head, None)
+
+    def __len__(self):
+        return len(self._locks) - self._head
+
+    def add(self, lock):
+        index = bisect.bisect_right(self._job_ids, lock.job.id, self._head)
+        self._job_ids.insert(index, lock.job.id)
+        self._locks.insert(index, lock)
+
+    def remove(self, lock):
+        index = bisect.bisect_left(self._job_ids, lock.job.id, self._head)
+        while self._locks[index] is not lock:
+            index += 1
+
+        if index == self._head:
+            self._locks[index] = None
+            self._head += 1
+            if self._head * 2 > len(self._locks):
+                del self._job_ids[:self._head]
+                del self._locks[:self._head]
+                self._head = 0
+        else:
+            del self._job_ids[index]
+            del self._locks[index]
+
+    def latest(self, not_job = None):
+        for index in xrange(len(self._locks) - 1, self._head - 1, -1):
+            lock = self._locks[index]
+            if not_job is None or lock.job != not_job:
+                return lock
+        return None
+
+    def after(self, job_id, not_job = None):
+        index = bisect.bisect_left(self._job_ids, job_id, self._head)
+        return [lock for lock in self._locks[index:] if lock.job != not_job]
+
+
 class LockCache(object):
 
     # Lock change receivers are called whenever a change occurs to the locks. It allows something to
@@ -20,12 +75,10 @@ class LockCache(object):
     def __init__(self):
         from chroma_core.models import Job, StateLock
 
-        self.write_locks = []
-        self.write_by_item = defaultdict(list)
-        self.read_locks = []
-        self.read_by_item = defaultdict(list)
+        self.write_by_item = defaultdict(JobOrderedLocks)
+        self.read_by_item = defaultdict(JobOrderedLocks)
         self.all_by_job = defaultdict(list)
-        self.all_by_item = defaultdict(list)
+        self.all_by_item = defaultdict(JobOrderedLocks)
 
         for job in Job.objects.filter(~Q(state = 'complete')):
             if job.locks_json:
@@ -37,20 +90,23 @@ class LockCache(object):
         for lock_change_receiver in self.lock_change_receivers:
             lock_change_receiver(lock, add_remove)
 
+    @staticmethod
+    def _remove_from(by_item, lock):
+        locks = by_item[lock.locked_item]
+        locks.remove(lock)
+        if not locks:
+            del by_item[lock.locked_item]
+
     def remove_job(self, job):
-        locks = list(self.all_by_job[job.id])
-        n = len(locks)
+        locks = self.all_by_job.pop(job.id, [])
         for lock in locks:
             if lock.write:
-                self.write_locks.remove(lock)
-                self.write_by_item[lock.locked_item].remove(lock)
+                self._remove_from(self.write_by_item, lock)
             else:
-                self.read_locks.remove(lock)
-                self.read_by_item[lock.locked_item].remove(lock)
-            self.all_by_job[job.id].remove(lock)
-            self.all_by_item[lock.locked_item].remove(lock)
+                self._remove_from(self.read_by_item, lock)
+            self._remove_from(self.all_by_item, lock)
             self.call_receivers(lock, self.LOCK_REMOVE)
-        return n
+        return len(locks)
 
     def add(self, lock):
         self._add(lock)
@@ -59,46 +115,40 @@ class LockCache(object):
         assert lock.job.id is not None
 
         if lock.write:
-            self.write_locks.append(lock)
-            self.write_by_item[lock.locked_item].append(lock)
+            self.write_by_item[lock.locked_item].add(lock)
         else:
-            self.read_locks.append(lock)
-            self.read_by_item[lock.locked_item].append(lock)
+            self.read_by_item[lock.locked_item].add(lock)
 
         self.all_by_job[lock.job.id].append(lock)
-        self.all_by_item[lock.locked_item].append(lock)
+        self.all_by_item[lock.locked_item].add(lock)
         self.call_receivers(lock, self.LOCK_ADD)
 
     def get_by_job(self, job):
-        return self.all_by_job[job.id]
+        return self.all_by_job.get(job.id, [])
 
     def get_all(self, locked_item):
-        return self.all_by_item[locked_item]
+        return self.all_by_item.get(locked_item, [])
 
     def get_latest_write(self, locked_item, not_job = None):
-        try:
-            if not_job != None:
-                return sorted([l for l in self.write_by_item[locked_item] if l.job != not_job], lambda a, b: cmp(a.job.id, b.job.id))[-1]
-            else:
-                return sorted(self.write_by_item[locked_item], lambda a, b: cmp(a.job.id, b.job.id))[-1]
-        except IndexError:
+        if locked_item in self.write_by_item:
+            return self.write_by_item[locked_item].latest(not_job)
+        else:
             return None
 
     def get_read_locks(self, locked_item, after, not_job):
-        return [x for x in self.read_by_item[locked_item] if after <= x.job.id and x.job != not_job]
+        if locked_item in self.read_by_item:
+            return self.read_by_item[locked_item].after(after, not_job)
+        else:
+            return []
 
     def get_write(self, locked_item):
-        return self.write_by_item[locked_item]
+        return self.write_by_item.get(locked_item, [])
 
     def get_by_locked_item(self, item):
-        return self.all_by_item[item]
+        return self.all_by_item.get(item, [])
 
     def get_write_by_locked_item(self):
-        result = {}
-        for locked_item, locks in self.write_by_item.items():
-            if locks:
-                result[locked_item] = sorted(locks, lambda a, b: cmp(a.job.id, b.job.id))[-1]
-        return result
+        return dict((locked_item, locks.latest()) for locked_item, locks in self.write_by_item.items() if locks)
 
 
 def lock_change_receiver():
@@ -5,10 +5,11 @@
 
 import traceback
 import sys
-from chroma_core.services.lustre_audit.update_scan import UpdateScan
+from chroma_core.services.lustre_audit.update_scan import UpdateScan, ScanBaselines
 from chroma_core.models import ManagedHost
 from chroma_core.services import ChromaService, log_register
 from chroma_core.services.queue import AgentRxQueue
+from chroma_core.services.http_agent import HttpAgentRpc
 from django.db import transaction
 
 
@@ -21,19 +22,37 @@ class Service(ChromaService):
     def __init__(self):
         self._queue = AgentRxQueue(Service.PLUGIN_NAME)
         self._queue.purge()
+        self._baselines = ScanBaselines()
 
     def run(self):
         super(Service, self).run()
 
-        self._queue.serve(data_callback = self.on_data)
+        self._queue.serve(session_callback = self.on_message)
 
-    def on_data(self, fqdn, data):
+    def on_message(self, message):
+        if message['type'] == 'DATA':
+            self.on_data(message['fqdn'], message['session_id'], message['body'])
+        elif message['type'] == 'SESSION_TERMINATE':
+            self._baselines.remove(message['fqdn'], message['session_id'])
+
+    def on_data(self, fqdn, session_id, data):
         with transaction.commit_manually():
             transaction.commit()
 
         try:
+            data = self._baselines.apply(fqdn, session_id, data)
+            if data is None:
+                if self._baselines.resync(fqdn, session_id):
+                    # Ask for a new session, which starts with a full scan.  This does nothing
+                    # if the session has been replaced since the message was sent.
+                    HttpAgentRpc().reset_session(fqdn, Service.PLUGIN_NAME, session_id)
+                return
+
             host = ManagedHost.objects.get(fqdn = fqdn)
             UpdateScan().run(host.id, data)
+        except ManagedHost.DoesNotExist:
+            # The host has been removed
+            self._baselines.remove(fqdn)
         except Exception:
             log.error("Error handling lustre message: %s", '\n'.join(traceback.format_exception(*(sys.exc_info()))))
 
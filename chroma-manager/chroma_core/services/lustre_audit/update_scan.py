@@ -18,6 +18,7 @@ from chroma_core.services.job_scheduler import job_scheduler_notify
 from chroma_core.services.job_scheduler.job_scheduler_client import JobSchedulerClient
 from chroma_core.models import ManagedTargetMount
 from chroma_core.chroma_common.lib.date_time import IMLDateTime
+from chroma_core.chroma_common.lib import delta
 import chroma_core.models.package
 from chroma_core.services.stats import StatsQueue
 
@@ -25,11 +26,93 @@ from chroma_core.services.stats import StatsQueue
 log = log_register(__name__)
 
 
+class ScanBaselines(object):
+    """
+    The last scan received from each host's lustre plugin session, which later scans
+    patch (see DevicePlugin._patch_result on the agent).
+    """
+
+    # Fields which UpdateScan skips when they are None, as they have not changed
+    unchanged_fields = ['capabilities', 'properties', 'mounts', 'packages', 'resource_locations']
+
+    def __init__(self):
+        self._baselines = {}  # fqdn -> (session_id, version, scan)
+        self._resyncing = {}  # fqdn -> session_id which we have asked to be reset
+
+    def apply(self, fqdn, session_id, data):
+        """
+        Return the scan data for UpdateScan from a message body, or None if it is a patch
+        against a scan that we do not have (see resync).
+        """
+        if 'version' not in data:
+            # From an agent which sends whole scans
+            return data
+
+        if 'patch' not in data:
+            started_at = data.pop('started_at')
+            self._baselines[fqdn] = (session_id, data.pop('version'), data)
+            self._resyncing.pop(fqdn, None)
+            return dict(data, started_at = started_at)
+
+        try:
+            baseline_session_id, version, scan = self._baselines[fqdn]
+        except KeyError:
+            log.debug("Patch for %s version %s with no baseline" % (fqdn, data['version']))
+            return None
+        if baseline_session_id != session_id or version != data['base_version']:
+            log.debug("Patch for %s/%s version %s does not apply to %s/%s version %s" % (
+                fqdn, session_id, data['base_version'], fqdn, baseline_session_id, version))
+            if baseline_session_id == session_id:
+                # Something was lost, so the rest of this session is no use
+                del self._baselines[fqdn]
+            return None
+
+        patch = data['patch']
+        delta.apply(scan, patch)
+        self._baselines[fqdn] = (session_id, data['version'], scan)
+
+        changed = set(patch.get('set', {})) | set(patch.get('patch', {}))
+        result = dict(scan, started_at = data['started_at'])
+        for field in self.unchanged_fields:
+            if field not in changed:
+                result[field] = None
+        return result
+
+    def resync(self, fqdn, session_id):
+        """
+        Return True if a session whose patch could not be applied should be reset, so that
+        its replacement starts with a full scan.  That is once per session, and never for a
+        session which has already been replaced by one we have a full scan from, as the
+        patches it left in the queue are simply stale.
+        """
+        baseline = self._baselines.get(fqdn)
+        if baseline is not None and baseline[0] != session_id:
+            return False
+        if self._resyncing.get(fqdn) == session_id:
+            return False
+
+        log.info("Resetting session %s/%s to get a full scan" % (fqdn, session_id))
+        self._resyncing[fqdn] = session_id
+        return True
+
+    def remove(self, fqdn, session_id = None):
+        """
+        Forget the baseline for a session which has ended, or if session_id is None, for
+        whichever session the host had.
+        """
+        baseline = self._baselines.get(fqdn)
+        if baseline is not None and session_id in (None, baseline[0]):
+            del self._baselines[fqdn]
+        if session_id in (None, self._resyncing.get(fqdn)):
+            self._resyncing.pop(fqdn, None)
+
+
 class UpdateScan(object):
     def __init__(self):
         self.audited_mountables = {}
         self.host = None
         self.host_data = None
+        self.update_time = None  # time of stored metrics, defaults to now
 
     def is_valid(self):
         try:
@@ -258,7 +341,9 @@ class UpdateScan(object):
             log.warning("Discarding metrics for unknown target: %s" % target_name)
             return []
 
-        return target.metrics.serialize(metrics, jobid_var=self.jobid_var)
+        if getattr(target, 'filesystem_id', None) is not None:
+            self.filesystem_ids.add(target.filesystem_id)
+        return target.metrics.serialize(metrics, self.update_time, jobid_var=self.jobid_var)
 
     @transaction.commit_on_success
     def store_metrics(self):
@@ -270,21 +355,27 @@ class UpdateScan(object):
         samples = []
 
         try:
-            node_metrics = raw_metrics['node']
+            # Copied, as the scan may be kept as the baseline for the next one
+            node_metrics = dict(raw_metrics['node'])
             try:
                 node_metrics['lnet'] = raw_metrics['lustre']['lnet']
             except KeyError:
                 pass
 
-            samples += self.host.metrics.serialize(node_metrics)
+            samples += self.host.metrics.serialize(node_metrics, self.update_time)
         except KeyError:
             pass
 
+        self.filesystem_ids = set()
         try:
             for target, target_metrics in raw_metrics['lustre']['target'].items():
                 samples += self.store_lustre_target_metrics(target, target_metrics)
         except KeyError:
             pass
 
+        # store filesystem totals including the updated targets
+        for filesystem in ManagedFilesystem.objects.filter(id__in=self.filesystem_ids):
+            samples += filesystem.metrics.serialize(self.update_time)
+
         StatsQueue().put(samples)
         return len(samples)
@@ -7,7 +7,12 @@
 around an AMQP queue."""
 
 
+import socket
 import threading
+import uuid
+
+from kombu.messaging import Exchange, Queue
+from kombu.pools import producers
 
 from chroma_core.services import _amqp_connection
 from chroma_core.services.log import log_register
@@ -15,6 +20,30 @@ from chroma_core.services.log import log_register
 
 log = log_register('queue')
 
+_entities = {}
+
+
+def _queue(name):
+    """The non-durable queue, bound to a direct exchange of the same name, that
+    conn.SimpleQueue(name) would declare"""
+    try:
+        return _entities[name]
+    except KeyError:
+        queue = Queue(name, Exchange(name, 'direct', durable = False), routing_key = name, durable = False)
+        _entities[name] = queue
+        return queue
+
+
+def publish(producer, name, body, **kwargs):
+    """Send to the named queue, as conn.SimpleQueue(name).put(body) would, using a pooled
+    producer: `kombu.pools.producers[_amqp_connection()].acquire()`.
+
+    The queue is declared the first time it is used on the producer's connection, rather
+    than on every message, and the producer's connection and channel are reused.
+    """
+    producer.publish(body, exchange = name, routing_key = name, declare = [_queue(name)],
+                     retry = True, retry_policy = {'max_retries': 3}, **kwargs)
+
 
 class ServiceQueue(object):
     """Simple FIFO queue, multiple senders, single receiver.  Payloads
@@ -36,11 +65,24 @@ class ServiceQueue(object):
     """
     name = None
 
+    # Messages the broker may send ahead of the consumer acknowledging them
+    prefetch_count = 200
+    # Maximum number of messages passed to a batch_callback at once
+    batch_size = 100
+    # Once a message has arrived, how long to wait for more to add to its batch
+    batch_wait = 0.01
+    # serve() checks for stop this often even if its wakeup message goes astray
+    stop_check_interval = 10
+
     def put(self, body):
-        with _amqp_connection() as conn:
-            q = conn.SimpleQueue(self.name, serializer = 'json',
-                                 exchange_opts={'durable': False}, queue_opts={'durable': False})
-            q.put(body)
+        with producers[_amqp_connection()].acquire(block = True) as producer:
+            publish(producer, self.name, body, serializer = 'json')
+
+    def put_raw(self, body):
+        """Send a byte string as is, rather than serialized as JSON.  The receiving callback
+        is passed the byte string."""
+        with producers[_amqp_connection()].acquire(block = True) as producer:
+            publish(producer, self.name, body, content_type = 'application/data', content_encoding = 'binary')
 
     def purge(self):
         with _amqp_connection() as conn:
@@ -50,26 +92,60 @@ class ServiceQueue(object):
 
     def __init__(self):
         self._stopping = threading.Event()
+        self._serving = False
+        self._wakeup_id = str(uuid.uuid4())
 
     def stop(self):
         log.info("Stopping ServiceQueue %s" % self.name)
         self._stopping.set()
 
-    def serve(self, callback):
-        from Queue import Empty as QueueEmpty
+        if self._serving:
+            # Wake serve() rather than waiting for it to check
+            with producers[_amqp_connection()].acquire(block = True) as producer:
+                publish(producer, self.name, None, serializer = 'json', headers = {'wakeup': self._wakeup_id})
+
+    def serve(self, callback = None, batch_callback = None):
+        """Call `callback` with each message, or `batch_callback` with lists of
+        up to `batch_size` messages, until `stop` is called.
+
+        Messages are consumed as the broker delivers them, and acknowledged
+        before the callbacks are invoked.
+        """
+        if (callback is None) == (batch_callback is None):
+            raise AssertionError('Set one of callback and batch_callback')
+
+        batch = []
+
+        def on_message(body, message):
+            message.ack()
+            wakeup = message.headers.get('wakeup') if message.headers else None
+            if wakeup is None:
+                batch.append(body)
+            elif wakeup != self._wakeup_id:
+                log.debug("Discarding wakeup message for another consumer of '%s'" % self.name)
+
         with _amqp_connection() as conn:
-            q = conn.SimpleQueue(self.name, serializer = 'json',
-                                 exchange_opts={'durable': False}, queue_opts={'durable': False})
-            # FIXME: it would be preferable to avoid waking up so often: really what is wanted
-            # here is to sleep on messages or a stop event.
-            while not self._stopping.is_set():
+            with conn.Consumer([_queue(self.name)], callbacks = [on_message]) as consumer:
+                consumer.qos(prefetch_count = self.prefetch_count)
+                self._serving = True
                 try:
-                    message = q.get(timeout = 1)
-                    message.ack()
-                    message = message.decode()
-                    callback(message)
-                except QueueEmpty:
-                    pass
+                    while not self._stopping.is_set():
+                        try:
+                            conn.drain_events(timeout = self.stop_check_interval)
+                            while batch and len(batch) < self.batch_size and not self._stopping.is_set():
+                                conn.drain_events(timeout = self.batch_wait)
+                        except socket.timeout:
+                            pass
+
+                        while batch:
+                            messages, batch[:] = batch[:self.batch_size], batch[self.batch_size:]
+                            if batch_callback:
+                                batch_callback(messages)
+                            else:
+                                for message in messages:
+                                    callback(message)
+                finally:
+                    self._serving = False
 
 
 class AgentRxQueue(ServiceQueue):
@@ -89,17 +165,32 @@ class AgentRxQueue(ServiceQueue):
         super(AgentRxQueue, self).__init__()
         self.name = "agent_%s_rx" % plugin
 
-    def serve(self, data_callback = None, session_callback = None):
+    def __route_batch(self, messages):
+        data = []
+        for message in messages:
+            if message['type'] == 'DATA':
+                data.append((message['fqdn'], message['body']))
+        if data:
+            self.__data_batch_callback(data)
+
+    def serve(self, data_callback = None, session_callback = None, data_batch_callback = None):
         """Data callback will receive only DATA mesages, being passed the fqdn and the body (i.e.
         the object returned by a device plugin).  Session callback will receive all messages,
-        including the outer envelope.
+        including the outer envelope.  Data batch callback is an alternative to data callback
+        which receives lists of (fqdn, body) tuples, so that they can be handled together.
 
-        Simple consumer services should just set data_callback.  Session-aware services should
-        set session_callback.
+        Simple consumer services should just set data_callback or data_batch_callback.
+        Session-aware services should set session_callback.
         """
-        if data_callback is None and session_callback is None:
+        if data_callback is None and session_callback is None and data_batch_callback is None:
             raise AssertionError('Set at least one callback')
 
+        if data_batch_callback is not None:
+            if data_callback is not None or session_callback is not None:
+                raise AssertionError('data_batch_callback may not be combined with other callbacks')
+            self.__data_batch_callback = data_batch_callback
+            return ServiceQueue.serve(self, batch_callback = self.__route_batch)
+
         self.__data_callback = data_callback
         self.__session_callback = session_callback
 
@@ -15,6 +15,7 @@ management command.
 """
 import logging
 
+import heapq
 import socket
 import threading
 import uuid
@@ -33,6 +34,9 @@ from kombu.messaging import Queue, Producer
 
 from chroma_core.services.log import log_register
 from chroma_core.services import _amqp_connection, _amqp_exchange
+from chroma_core.services.worker_pool import WorkerPool
+
+import settings
 
 
 REQUEST_SCHEMA = {
@@ -56,11 +60,62 @@ RESPONSE_SCHEMA = {
     }
 }
 
+
+class MessageValidator(object):
+    """Check RPC messages against a schema of typed, top level properties.
+
+    The messages come from our own services, so by default only the presence and
+    types of the properties are checked, using checks derived from the schema when
+    the validator is created.  With settings.RPC_FULL_VALIDATION the full jsonschema
+    validation is used instead.  Either way, failures raise jsonschema.ValidationError.
+    """
+
+    JSON_TYPES = {
+        'string': basestring,
+        'array': (list, tuple),
+        'object': dict,
+        'null': type(None)
+    }
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._checks = []
+        for name, prop in schema['properties'].items():
+            types = prop.get('type')
+            if types is not None:
+                if isinstance(types, basestring):
+                    types = [types]
+                types = tuple(self.JSON_TYPES[t] for t in types)
+            self._checks.append((name, prop.get('required', False), types))
+
+    def validate(self, body):
+        if settings.RPC_FULL_VALIDATION:
+            jsonschema.validate(body, self.schema)
+            return
+
+        if not isinstance(body, dict):
+            raise jsonschema.ValidationError("%r is not of type 'object'" % (body,))
+
+        for name, required, types in self._checks:
+            try:
+                value = body[name]
+            except KeyError:
+                if required:
+                    raise jsonschema.ValidationError("%r is a required property" % name)
+            else:
+                if types is not None and not isinstance(value, types):
+                    raise jsonschema.ValidationError("%r is not of type %s" % (value, self.schema['properties'][name]['type']))
+
+
+REQUEST_VALIDATOR = MessageValidator(REQUEST_SCHEMA)
+RESPONSE_VALIDATOR = MessageValidator(RESPONSE_SCHEMA)
+
 RESPONSE_TIMEOUT = 300
 
 """
-Max number of lightweight RPCs that can be in flight concurrently.  This must
-be well within the rabbitmq server's connection limit
+Max number of lightweight RPC requests that can be published concurrently.  This must
+be well within the rabbitmq server's connection limit.  Connections are only held while
+publishing: the responses all arrive on the process's shared response queue.
 
 """
 LIGHTWEIGHT_CONNECTIONS_LIMIT = 10
@@ -68,10 +123,23 @@ LIGHTWEIGHT_CONNECTIONS_LIMIT = 10
 
 RESPONSE_CONN_LIMIT = 10
 
+"""
+Incoming RPCs are run on a worker pool for their class of method, sized by settings.RPC_POOL_SIZES.
+Methods which do not hit the database, like long polls, get their own pool, so that they neither
+hold up nor are held up by the rest.
+
+"""
+RPC_METHOD_POOLS = {'wait_table_change': 'long_poll'}
+
 tx_connections = None
 rx_connections = None
 lw_connections = None
 
+# Guards the per-process setup of lightweight clients.  Unlike the other locks this is created
+# at import, as it must exist before any thread can race to use it, and is only held while
+# objects are created, so it never blocks for long even where gevent patches threading later.
+_lightweight_init_lock = threading.Lock()
+
 log = log_register('rpc')
 
 
@@ -90,36 +158,22 @@ class RpcTimeout(Exception):
     pass
 
 
-class RunOneRpc(threading.Thread):
-    """Handle a single incoming RPC in a new thread, and send the
-    response (result or exception) from the execution thread."""
+class RpcBusy(Exception):
+    """The remote_exception_type of an RpcError for a call refused because too many calls were queued"""
+    pass
 
-    _outstanding = 0
-    _throttle_limit = 75
-    _throttled_locks = []
+
+class RunOneRpc(object):
+    """Handle a single incoming RPC on a worker pool thread, and send the
+    response (result or exception) from the execution thread."""
 
     def __init__(self, rpc, body, response_conn_pool):
-        super(RunOneRpc, self).__init__()
         self.rpc = rpc
         self.body = body
         self._response_conn_pool = response_conn_pool
 
     def run(self):
-        # We do not throttle rpcs that do not hit the database.
-        rpc_throttle = self.body['method'] not in ['wait_table_change']
-
         try:
-            if rpc_throttle:
-                if RunOneRpc._outstanding > RunOneRpc._throttle_limit:
-                    rpc_complete_event = threading.Event()
-                    RunOneRpc._throttled_locks.append(rpc_complete_event)
-                    log.info("_throttled_locks: '%s'" % RunOneRpc._throttled_locks)
-                    log.info("Throttled rpc to %s throttled rpcs=%s" % (self.body['method'], len(RunOneRpc._throttled_locks)))
-                    rpc_complete_event.wait()
-                    log.info("Released rpc to %s throttled rpcs=%s" % (self.body['method'], len(RunOneRpc._throttled_locks)))
-
-                RunOneRpc._outstanding += 1
-
             result = {
                 'result': self.rpc._local_call(self.body['method'], *self.body['args'], **self.body['kwargs']),
                 'request_id': self.body['request_id'],
@@ -148,17 +202,22 @@ class RunOneRpc(threading.Thread):
             }
             log.error("RunOneRpc: exception calling %s: %s" % (self.body['method'], backtrace))
         finally:
-            try:
-                if rpc_throttle:
-                    try:
-                        rpc_complete_event = RunOneRpc._throttled_locks.pop(0)
-                        rpc_complete_event.set()
-                    except IndexError:
-                        pass
-                    RunOneRpc._outstanding -= 1
-            finally:
-                django.db.connection.close()
-
+            django.db.connection.close()
+
+        self.respond(result)
+
+    def refuse(self, reason):
+        """Respond with an exception without calling the method"""
+        log.warning("RunOneRpc: refusing call to %s: %s" % (self.body['method'], reason))
+        self.respond({
+            'request_id': self.body['request_id'],
+            'result': None,
+            'exception': reason,
+            'exception_type': RpcBusy.__name__,
+            'traceback': None
+        })
+
+    def respond(self, result):
         with self._response_conn_pool[_amqp_connection()].acquire(block=True) as connection:
             with Producer(connection) as producer:
                 maybe_declare(_amqp_exchange(), producer.channel)
@@ -170,7 +229,7 @@ class RpcServer(ConsumerMixin):
         """
         :param rpc: A ServiceRpcInterface instance
         :param serialize: If True, then process RPCs one after another in a single thread
-        rather than running a thread for each RPC.
+        rather than running them on worker pools.
         """
         super(RpcServer, self).__init__()
         self.serialize = serialize
@@ -179,6 +238,9 @@ class RpcServer(ConsumerMixin):
         self.queue_name = service_name
         self.request_routing_key = "%s.requests" % self.queue_name
         self._response_conn_pool = kombu.pools.Connections(limit = RESPONSE_CONN_LIMIT)
+        self._pools = {}
+        for pool_name, size in settings.RPC_POOL_SIZES.items():
+            self._pools[pool_name] = WorkerPool("%s-%s" % (service_name, pool_name), size, settings.RPC_POOL_MAX_QUEUED)
 
     def get_consumers(self, Consumer, channel):
         return [Consumer(
@@ -189,16 +251,25 @@ class RpcServer(ConsumerMixin):
         message.ack()
 
         try:
-            jsonschema.validate(body, REQUEST_SCHEMA)
+            REQUEST_VALIDATOR.validate(body)
         except jsonschema.ValidationError as e:
             # Don't even try to send an exception response, because validation failure
             # breaks our faith in request_id and response_routing_key
             log.error("Invalid RPC body: %s" % e)
         else:
-            RunOneRpc(self.rpc, body, self._response_conn_pool).start()
+            run_one = RunOneRpc(self.rpc, body, self._response_conn_pool)
+            if self.serialize:
+                run_one.run()
+                return
+
+            pool = self._pools[RPC_METHOD_POOLS.get(body['method'], 'default')]
+            if not pool.submit(body['method'], run_one.run):
+                run_one.refuse("%s has too many calls queued (%s)" % (pool.name, pool.stats()))
 
     def stop(self):
         self.should_stop = True
+        for pool in self._pools.values():
+            pool.stop()
 
 
 class ResponseWaitState(object):
@@ -212,28 +283,49 @@ class ResponseWaitState(object):
 
 
 class RpcClientResponseHandler(threading.Thread):
-    """Handle responses for a particular named RPC service.
+    """Handle responses for a particular named RPC service, or in lightweight
+    mode for all the RPCs issued by the process.
+
+    Responses are matched to their callers by request_id.  Timeouts are kept in
+    a heap ordered by expiry, so that ageing only looks at the expired states.
 
     """
-    def __init__(self, response_routing_key):
+    def __init__(self, response_routing_key, dedicated_connection = False):
         super(RpcClientResponseHandler, self).__init__()
         self._stopping = False
         self._response_states = {}
+        self._timeouts = []
+        self._lock = threading.Lock()
         self._response_routing_key = response_routing_key
+        self._dedicated_connection = dedicated_connection
 
         self._started = threading.Event()
 
+    @property
+    def response_routing_key(self):
+        return self._response_routing_key
+
     def wait_for_start(self):
         """During initialization, caller needs to be able to block
         on the handler thread starting up, to avoid attempting to issue
         RPCs before the response handler is available
 
         """
-        self._started.wait()
+        while not self._started.wait(1):
+            if not self.is_alive():
+                raise RuntimeError("%s exited before starting" % self.__class__.__name__)
 
     def start_wait(self, request_id, rpc_timeout):
         log.debug("start_wait %s" % request_id)
-        self._response_states[request_id] = ResponseWaitState(rpc_timeout)
+        state = ResponseWaitState(rpc_timeout)
+        with self._lock:
+            self._response_states[request_id] = state
+            heapq.heappush(self._timeouts, (state.timeout_at, request_id))
+
+    def cancel_wait(self, request_id):
+        """Forget a request which could not be sent"""
+        with self._lock:
+            self._response_states.pop(request_id, None)
 
     def complete_wait(self, request_id):
         log.debug("complete_wait %s" % request_id)
@@ -241,7 +333,8 @@ class RpcClientResponseHandler(threading.Thread):
         state.complete.wait()
         log.debug("complete_wait %s triggered" % request_id)
 
-        del self._response_states[request_id]
+        with self._lock:
+            del self._response_states[request_id]
 
         if state.timeout:
             raise RpcTimeout()
@@ -249,17 +342,26 @@ class RpcClientResponseHandler(threading.Thread):
             return state.result
 
     def _age_response_states(self):
-        # FIXME: keep a sorted list by insertion time to avoid
-        # the need to check all the timeouts
         t = time.time()
-        for request_id, state in self._response_states.items():
-            if not state.complete.is_set() and t > state.timeout_at:
-                log.debug("Aged out RPC %s" % request_id)
-                state.timeout = True
-                state.complete.set()
+        with self._lock:
+            while self._timeouts and self._timeouts[0][0] < t:
+                timeout_at, request_id = heapq.heappop(self._timeouts)
+                state = self._response_states.get(request_id)
+                if state is not None and not state.complete.is_set():
+                    log.debug("Aged out RPC %s" % request_id)
+                    state.timeout = True
+                    state.complete.set()
+
+            # Entries for completed requests stay in the heap until they expire: rebuild
+            # it if they come to outnumber the outstanding requests
+            if len(self._timeouts) > 2 * len(self._response_states) + 64:
+                self._timeouts = [(state.timeout_at, request_id) for request_id, state in self._response_states.items()]
+                heapq.heapify(self._timeouts)
 
     def timeout_all(self):
-        for request_id, state in self._response_states.items():
+        with self._lock:
+            states = self._response_states.values()
+        for state in states:
             state.timeout = True
             state.complete.set()
 
@@ -269,13 +371,12 @@ class RpcClientResponseHandler(threading.Thread):
         def callback(body, message):
             # log.debug(body)
             try:
-                jsonschema.validate(body, RESPONSE_SCHEMA)
+                RESPONSE_VALIDATOR.validate(body)
             except jsonschema.ValidationError as e:
                 log.debug("Malformed response: %s" % e)
             else:
-                try:
-                    state = self._response_states[body['request_id']]
-                except KeyError:
+                state = self._response_states.get(body['request_id'])
+                if state is None:
                     log.debug("Unknown request ID %s" % body['request_id'])
                 else:
                     state.result = body
@@ -283,7 +384,12 @@ class RpcClientResponseHandler(threading.Thread):
             finally:
                 message.ack()
 
-        with rx_connections[_amqp_connection()].acquire(block = True) as connection:
+        if self._dedicated_connection:
+            connection_context = _amqp_connection()
+        else:
+            connection_context = rx_connections[_amqp_connection()].acquire(block = True)
+
+        with connection_context as connection:
             # Prepare the response queue
             with connection.Consumer(
                 queues = [kombu.messaging.Queue(self._response_routing_key,
@@ -320,7 +426,7 @@ class RpcClient(object):
     that this process calls into.
 
     """
-    def __init__(self, service_name, lightweight = False):
+    def __init__(self, service_name, lightweight = False, response_thread = None):
         self._service_name = service_name
         self._request_routing_key = "%s.requests" % self._service_name
         self._lightweight = lightweight
@@ -329,6 +435,10 @@ class RpcClient(object):
             self.response_thread = RpcClientResponseHandler(self._response_routing_key)
             self.response_thread.start()
             self.response_thread.wait_for_start()
+        else:
+            # Shared with the other lightweight clients in this process, see RpcClientFactory
+            self.response_thread = response_thread
+            self._response_routing_key = response_thread.response_routing_key
 
     def stop(self):
         if not self._lightweight:
@@ -355,54 +465,17 @@ class RpcClient(object):
 
     def call(self, request, rpc_timeout = RESPONSE_TIMEOUT):
         request_id = request['request_id']
+        connections = lw_connections if self._lightweight else tx_connections
 
-        if not self._lightweight:
-            self.response_thread.start_wait(request_id, rpc_timeout)
-            with tx_connections[_amqp_connection()].acquire(block = True) as connection:
+        self.response_thread.start_wait(request_id, rpc_timeout)
+        try:
+            with connections[_amqp_connection()].acquire(block = True) as connection:
                 self._send(connection, request)
-            return self.response_thread.complete_wait(request_id)
-        else:
-            self._response_routing_key = "%s.responses_%s_%s_%s" % (
-                self._service_name, os.uname()[1], os.getpid(), request_id)
-            self._complete = False
+        except:
+            self.response_thread.cancel_wait(request_id)
+            raise
 
-            def callback(body, message):
-                # log.debug(body)
-                try:
-                    jsonschema.validate(body, RESPONSE_SCHEMA)
-                except jsonschema.ValidationError as e:
-                    log.debug("Malformed response: %s" % e)
-                else:
-                    self._result = body
-                    self._complete = True
-                finally:
-                    message.ack()
-
-            with lw_connections[_amqp_connection()].acquire(block = True) as connection:
-                with connection.Consumer(
-                    queues = [kombu.messaging.Queue(self._response_routing_key,
-                              _amqp_exchange(),
-                              routing_key=self._response_routing_key,
-                              auto_delete = True, durable = False)],
-                        callbacks = [callback]):
-
-                    self._send(connection, request)
-
-                    timeout_at = time.time() + rpc_timeout
-                    while not self._complete:
-                        try:
-                            connection.drain_events(timeout = 1)
-                        except socket.timeout:
-                            pass
-                        except IOError as e:
-                            #  See HYD-2551
-                            if e.errno != errno.EINTR:
-                                # if not [Errno 4] Interrupted system call
-                                raise
-                        if time.time() > timeout_at:
-                            raise RpcTimeout()
-
-                    return self._result
+        return self.response_thread.complete_wait(request_id)
 
 
 class RpcClientFactory(object):
@@ -417,11 +490,13 @@ class RpcClientFactory(object):
     in a multi-threaded mode depending on whether `initialize_threads`
     is called.
 
-    Lightweight mode does not spawn any additional threads to handle
-    RPC responses, but has the overhead of creating separate AMQP connections
-    for each concurrent RPC, and creating a separate response queue for each
-    call.  This is for use in WSGI handlers performing comparatively rare
-    operations (things that happen when a user clicks a button).
+    Lightweight mode spawns a single response handler thread per process,
+    started on first use, which consumes one response queue on behalf of all
+    the RPC services that the process calls into, matching responses to callers
+    by request ID.  Connections from a small pool are only held while publishing
+    requests.  This is for use in WSGI handlers, where each worker process
+    issues RPCs for the API requests it serves.  The handler is replaced if
+    the process forks or the handler thread dies.
 
     Threaded mode spawns a response handler thread for each named RPC
     service that the calling process interacts with.  This reduces the number
@@ -435,14 +510,16 @@ class RpcClientFactory(object):
     _available = True
 
     _lightweight = True
-    _lightweight_initialized = False
+    _lightweight_pid = None
+    _lightweight_lock = None
+    _lightweight_handler = None
 
     @classmethod
     def initialize_threads(cls):
         """Set up for multi-threaded operation.  Calling this turns off
-        'lightweight' mode, and causes the rpc module to use multiple
-        threads when issuing RPCs.  If this is not called, then no
-        extra threads are started when issuing RPCs
+        'lightweight' mode, and causes the rpc module to use a response
+        handler thread per RPC service.  If this is not called, then a single
+        response handler thread is shared by all the RPCs issued by the process
 
         """
 
@@ -477,20 +554,37 @@ class RpcClientFactory(object):
             cls._available = False
 
     @classmethod
-    def get_client(cls, queue_name):
-        # This is code to disable _lightweight threads. Because we are past FF I am not removing the
-        # code however the patch for on going master and so I don't want the risk of pulling out the
-        # lightweight code.
-        if cls._lightweight:
-            cls.initialize_threads()
+    def _get_lightweight_handler(cls):
+        if cls._lightweight_pid != os.getpid():
+            with _lightweight_init_lock:
+                if cls._lightweight_pid != os.getpid():
+                    # First use in this process (perhaps a forked WSGI worker): anything
+                    # inherited from the parent belongs to the parent's connections
+                    global lw_connections
+                    lw_connections = kombu.pools.Connections(limit = LIGHTWEIGHT_CONNECTIONS_LIMIT)
+                    cls._lightweight_lock = threading.Lock()
+                    cls._lightweight_handler = None
+                    cls._lightweight_pid = os.getpid()
+
+        with cls._lightweight_lock:
+            if cls._lightweight_handler is None or not cls._lightweight_handler.is_alive():
+                if cls._lightweight_handler is not None:
+                    log.warning("%s: response handler exited, restarting" % cls.__name__)
+                    cls._lightweight_handler.timeout_all()
+
+                handler = RpcClientResponseHandler("responses_%s_%s_%s" % (os.uname()[1], os.getpid(), uuid.uuid4()),
+                                                   dedicated_connection = True)
+                handler.daemon = True
+                handler.start()
+                handler.wait_for_start()
+                cls._lightweight_handler = handler
+
+            return cls._lightweight_handler
 
+    @classmethod
+    def get_client(cls, queue_name):
         if cls._lightweight:
-            if not cls._lightweight_initialized:
-                # connections.limit = LIGHTWEIGHT_CONNECTIONS_LIMIT
-                global lw_connections
-                lw_connections = kombu.pools.Connections(limit = LIGHTWEIGHT_CONNECTIONS_LIMIT)
-                cls._lightweight_initialized = True
-            return RpcClient(queue_name, lightweight = True)
+            return RpcClient(queue_name, lightweight = True, response_thread = cls._get_lightweight_handler())
         else:
             with cls._factory_lock:
                 if not cls._available:
@@ -3,34 +3,188 @@
 # license that can be found in the LICENSE file.
 
 
+import time
+import struct
+import threading
 import traceback
+import collections
+from datetime import datetime, timedelta
 from django import db
 from django.utils import dateparse
+from django.utils.timezone import utc
 from chroma_core.models import Stats
-from chroma_core.services import ChromaService, log_register, queue
+from chroma_core.models.stats import epoch, timestamp
+from chroma_core.services import ChromaService, ServiceThread, log_register, queue
+
+import settings
 
 
 log = log_register(__name__)
 
 
 class StatsQueue(queue.ServiceQueue):
+    """Queue of samples (id, dt, value) to insert.
+
+    Samples are packed as a version and count header followed by arrays of series ids, timestamps
+    in microseconds since the epoch and values.  JSON lists of (id, dt string, value) from older
+    senders are still accepted.
+    """
     name = 'stats'
+    HEADER = struct.Struct('<BI')
+    VERSION = 1
 
     def put(self, samples):
-        queue.ServiceQueue.put(self, [(id, str(dt), value) for id, dt, value in samples])
+        self.put_raw(self.encode(samples))
+
+    @classmethod
+    def encode(cls, samples):
+        "Return samples packed into a byte string."
+        ids, timestamps, values, cache = [], [], [], {}
+        for id, dt, value in samples:
+            try:
+                ts = cache[dt]
+            except KeyError:
+                ts = cache[dt] = timestamp(dt) * 1000000 + dt.microsecond
+            ids.append(id)
+            timestamps.append(ts)
+            values.append(value)
+        count = len(ids)
+        return cls.HEADER.pack(cls.VERSION, count) + struct.pack('<{0:d}q{0:d}q{0:d}d'.format(count), *(ids + timestamps + values))
+
+    @classmethod
+    def decode(cls, message):
+        "Return samples (id, dt, value) from a packed byte string or a JSON list."
+        if not isinstance(message, basestring):
+            return [(id, dateparse.parse_datetime(dt), value) for id, dt, value in message]
+        version, count = cls.HEADER.unpack_from(message)
+        assert version == cls.VERSION, "Unsupported stats message version {0}".format(version)
+        fields = struct.unpack_from('<{0:d}q{0:d}q{0:d}d'.format(count), message, cls.HEADER.size)
+        ids, timestamps, values = fields[:count], fields[count:count * 2], fields[count * 2:]
+        datetimes = dict((ts, epoch + timedelta(microseconds=ts)) for ts in set(timestamps))
+        return [(id, datetimes[ts], value) for id, ts, value in zip(ids, timestamps, values)]
+
+
+class StatsBatcher(object):
+    """Coalesce stats messages into batched inserts.
+
+    Messages are buffered until STATS_BATCH_SIZE samples are pending or STATS_BATCH_WINDOW seconds have passed.
+    When more than STATS_MAX_PENDING_SAMPLES are waiting, because inserts are not keeping up, the oldest messages
+    are shed rather than letting the backlog grow without bound.
+    """
+    def __init__(self, insert):
+        self._insert = insert
+        self._pending = collections.deque()  # (received time, samples)
+        self._pending_samples = 0
+        self._condition = threading.Condition()
+        self._stopping = False
+        self.shed = 0
+        self.lag = 0.0
+
+    def put(self, *messages):
+        "Buffer messages' samples, shedding the oldest messages if too many are pending."
+        with self._condition:
+            received = time.time()
+            for samples in messages:
+                self._pending.append((received, samples))
+                self._pending_samples += len(samples)
+            while self._pending_samples > settings.STATS_MAX_PENDING_SAMPLES and len(self._pending) > 1:
+                received, dropped = self._pending.popleft()
+                self._pending_samples -= len(dropped)
+                self.shed += len(dropped)
+            if self._pending_samples >= settings.STATS_BATCH_SIZE:
+                self._condition.notify()
+
+    def _get(self):
+        "Wait for a full batch, the end of the batch window or stop, and return the pending messages."
+        with self._condition:
+            deadline = time.time() + settings.STATS_BATCH_WINDOW
+            while not self._stopping and self._pending_samples < settings.STATS_BATCH_SIZE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            pending, self._pending, self._pending_samples = self._pending, collections.deque(), 0
+            shed, self.shed = self.shed, 0
+        if shed:
+            log.warning("Stats inserts falling behind, shed {0} samples".format(shed))
+        return pending
+
+    def run(self):
+        while True:
+            pending = self._get()
+            if pending:
+                self._flush(pending)
+            elif self._stopping:
+                break
+
+    def _flush(self, pending):
+        "Insert samples coalesced from pending messages."
+        self.lag = time.time() - pending[0][0]
+        if self.lag > settings.STATS_BATCH_WINDOW * 2:
+            log.warning("Stats inserts lagging by {0:.1f}s with {1} messages".format(self.lag, len(pending)))
+        # drop duplicate samples, e.g. from redelivered messages, which would fail the whole batch
+        samples = collections.OrderedDict()
+        for received, message in pending:
+            for id, dt, value in message:
+                samples.setdefault((id, dt), value)
+        self._insert([(id, dt, value) for (id, dt), value in samples.items()])
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+
+class StatsRetention(object):
+    """Expire old stats in the background, so that inserts never pay for deletes.
+
+    Every STATS_RETENTION_INTERVAL seconds, each Sample table which is due has up to STATS_RETENTION_CHUNKS chunks
+    of STATS_RETENTION_CHUNK_SIZE expired points deleted.
+    """
+    def __init__(self):
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                deleted = Stats.retain(datetime.now(utc), settings.STATS_RETENTION_CHUNK_SIZE, settings.STATS_RETENTION_CHUNKS)
+            except:
+                log.error("Error expiring stats: " + traceback.format_exc())
+                db.transaction.rollback()
+            else:
+                if deleted:
+                    log.debug("Expired {0} samples".format(deleted))
+            self._stopping.wait(settings.STATS_RETENTION_INTERVAL)
+
+    def stop(self):
+        self._stopping.set()
 
 
 class Service(ChromaService):
+    def __init__(self):
+        super(Service, self).__init__()
+
+        self._children_started = threading.Event()
+        self.batcher = StatsBatcher(self.insert)
+        self._next_cache_info = time.time() + settings.STATS_CACHE_INFO_INTERVAL
+
     def run(self):
         super(Service, self).run()
 
         self.queue = StatsQueue()
         self.queue.purge()
-        self.queue.serve(callback=self.insert)
+
+        self._batcher_thread = ServiceThread(self.batcher)
+        self._batcher_thread.start()
+        self._retention_thread = ServiceThread(StatsRetention())
+        self._retention_thread.start()
+        self._children_started.set()
+
+        self.queue.serve(batch_callback=lambda messages: self.batcher.put(*map(StatsQueue.decode, messages)))
 
     def insert(self, samples):
         try:
-            outdated = Stats.insert((id, dateparse.parse_datetime(dt), value) for id, dt, value in samples)
+            outdated = Stats.insert(samples)
         except db.IntegrityError:
             log.error("Duplicate stats insert: " + db.connection.queries[-1]['sql'])
             db.transaction.rollback()  # allow future stats to still work
@@ -40,7 +194,19 @@ class Service(ChromaService):
             if outdated:
                 log.warn("Outdated samples ignored: {0}".format(outdated))
 
+        if time.time() > self._next_cache_info:
+            # so that the cache sizes can be checked against the number of series
+            log.info("Stats caches: {0}".format(Stats.cache_info()))
+            self._next_cache_info = time.time() + settings.STATS_CACHE_INFO_INTERVAL
+
     def stop(self):
         super(Service, self).stop()
 
+        # Guard against trying to stop after child threads are created, but before they are started
+        self._children_started.wait()
+
         self.queue.stop()
+        self._batcher_thread.stop()
+        self._retention_thread.stop()
+        self._batcher_thread.join()
+        self._retention_thread.join()
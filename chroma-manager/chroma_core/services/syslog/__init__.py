@@ -67,29 +67,34 @@ class Service(ChromaService):
         return removed_num_entries
 
     def on_data(self, fqdn, body):
+        self.on_data_batch([(fqdn, body)])
+
+    def on_data_batch(self, messages):
+        """Insert the log lines from a batch of messages in one transaction"""
         with transaction.commit_on_success():
             with LogMessage.delayed as log_messages:
-                for msg in body['log_lines']:
-                    try:
-                        log_messages.insert(dict(
-                            fqdn = fqdn,
-                            message = msg['message'],
-                            severity = msg['severity'],
-                            facility = msg['facility'],
-                            tag = msg['source'],
-                            datetime = IMLDateTime.parse(msg['datetime']).as_datetime,
-                            message_class = LogMessage.get_message_class(msg['message'])
-                        ))
-                        self._table_size += 1
-
-                        self._parser.parse(fqdn, msg)
-                    except Exception, e:
-                        self.log.error("Error %s ingesting syslog entry: %s" % (e, msg))
+                for fqdn, body in messages:
+                    for msg in body['log_lines']:
+                        try:
+                            log_messages.insert(dict(
+                                fqdn = fqdn,
+                                message = msg['message'],
+                                severity = msg['severity'],
+                                facility = msg['facility'],
+                                tag = msg['source'],
+                                datetime = IMLDateTime.parse(msg['datetime']).as_datetime,
+                                message_class = LogMessage.get_message_class(msg['message'])
+                            ))
+                            self._table_size += 1
+
+                            self._parser.parse(fqdn, msg)
+                        except Exception, e:
+                            self.log.error("Error %s ingesting syslog entry: %s" % (e, msg))
 
     def run(self):
         super(Service, self).run()
 
-        self._queue.serve(data_callback = self.on_data)
+        self._queue.serve(data_batch_callback = self.on_data_batch)
 
     def stop(self):
         super(Service, self).stop()
@@ -0,0 +1,130 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import collections
+import threading
+import time
+import traceback
+
+from chroma_core.services.log import log_register
+
+
+log = log_register('worker_pool')
+
+
+class WorkerPool(object):
+    """Run tasks on at most `size` threads, which are started as they are needed and
+    then reused.
+
+    Tasks are queued by key (e.g. RPC method or job class) and the keys are served in turn,
+    so that a burst of one kind of task does not hold up the others.  When `max_queued`
+    tasks are already waiting, submit refuses the task.
+
+    Queue depth and the time tasks wait for a thread are recorded for `stats`.
+    """
+
+    def __init__(self, name, size, max_queued = None):
+        self.name = name
+        self.size = size
+        self.max_queued = max_queued
+
+        self._condition = threading.Condition()
+        self._queues = collections.OrderedDict()  # key -> deque of (submit time, fn, args, kwargs)
+        self._queued = 0
+        self._threads = []
+        self._idle = 0
+        self._stopping = False
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) to be run, return False if it was refused because the
+        queue is full or the pool is stopping"""
+        with self._condition:
+            if self._stopping or (self.max_queued is not None and self._queued >= self.max_queued):
+                self.rejected += 1
+                return False
+
+            self._queues.setdefault(key, collections.deque()).append((time.time(), fn, args, kwargs))
+            self._queued += 1
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self._queued)
+
+            if self._idle < self._queued and len(self._threads) < self.size:
+                thread = threading.Thread(target = self._work, name = "%s-%d" % (self.name, len(self._threads)))
+                self._threads.append(thread)
+                self._idle += 1
+                thread.start()
+            else:
+                self._condition.notify()
+
+            return True
+
+    def _get(self):
+        """Wait for a task, taking the next key in turn, or return None when stopping with nothing queued"""
+        with self._condition:
+            while not self._queued and not self._stopping:
+                self._condition.wait()
+
+            if not self._queued:
+                return None
+
+            key, queue = self._queues.popitem(last = False)
+            task = queue.popleft()
+            if queue:
+                self._queues[key] = queue
+            self._queued -= 1
+            self._idle -= 1
+
+            wait = time.time() - task[0]
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+            return task
+
+    def _work(self):
+        while True:
+            task = self._get()
+            if task is None:
+                return
+
+            submitted_at, fn, args, kwargs = task
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                log.error("%s: unhandled exception in task %s: %s" % (self.name, fn, traceback.format_exc()))
+            finally:
+                with self._condition:
+                    self._idle += 1
+                    self.completed += 1
+
+    def stats(self):
+        with self._condition:
+            return {
+                'threads': len(self._threads),
+                'busy': len(self._threads) - self._idle,
+                'queued': self._queued,
+                'max_queued': self.max_depth,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'mean_wait': self.total_wait / max(self.submitted - self._queued, 1),
+                'max_wait': self.max_wait
+            }
+
+    def stop(self):
+        """Refuse further tasks, and let the threads exit once the queued tasks have run"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+    def join(self):
+        for thread in list(self._threads):
+            thread.join()
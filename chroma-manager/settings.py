@@ -231,13 +231,34 @@ STORAGE_PLUGIN_DEBUG_PLUGINS = []
 STORAGE_PLUGIN_ENABLE_STATS = True
 
 # Control of the statistics storage
-STATS_SIMPLE_WIPE = True                    # True means we simple delete everything that is older than the expiration, data not rolled up is lost.
 STATS_10_SECOND_EXPIRATION = {'days': 1}    # Expiration must be multiple of 10 seconds.
 STATS_1_MINUTE_EXPIRATION = {'days': 3}     # Expiration must be multiple of 1 minute.
 STATS_5_MINUTE_EXPIRATION = {'days': 7}     # Expiration must be multiple of 5 minute.
 STATS_1_HOUR_EXPIRATION = {'days': 30}      # Expiration must be multiple of 1 hour.
 STATS_1_DAY_EXPIRATION = {'weeks': 10000}   # Expiration must be multiple of 1 day
 STATS_FLUSH_RATE = 20                       # Flush 20 times per expiration interval - for 10 seconds sample flush every 1day/20.
+STATS_SERIES_CACHE_SIZE = 100000            # Maximum number of series cached by measured object and name.
+STATS_10_SECOND_CACHE_SIZE = 100000         # Maximum number of series with recent points cached per sample table.
+STATS_1_MINUTE_CACHE_SIZE = 100000
+STATS_5_MINUTE_CACHE_SIZE = 100000
+STATS_1_HOUR_CACHE_SIZE = 100000
+STATS_1_DAY_CACHE_SIZE = 100000
+STATS_CACHE_INFO_INTERVAL = 3600            # Seconds between logging the sizes, hits, misses and evictions of the caches.
+STATS_BATCH_SIZE = 100000                   # Insert stats once this many samples are pending...
+STATS_BATCH_WINDOW = 2                      # ...or after this many seconds.
+STATS_MAX_PENDING_SAMPLES = 1000000         # Shed the oldest stats messages beyond this many pending samples.
+STATS_RETENTION_INTERVAL = 10              # Seconds between passes deleting expired stats in the background.
+STATS_RETENTION_CHUNK_SIZE = 10000          # Maximum number of expired samples deleted per statement...
+STATS_RETENTION_CHUNKS = 10                 # ...and statements per table each pass.
+
+# Incoming RPCs are run on a pool of worker threads per class of method (see chroma_core.services.rpc), rather
+# than a thread each.  Calls beyond RPC_POOL_MAX_QUEUED waiting in a pool are refused.
+RPC_POOL_SIZES = {'default': 75, 'long_poll': 500}
+RPC_POOL_MAX_QUEUED = 1000
+RPC_FULL_VALIDATION = False                 # Validate RPC messages with jsonschema, rather than just the types of their fields.
+
+# Maximum number of threads running job steps in the job_scheduler, further jobs wait for a thread.
+JOB_SCHEDULER_WORKERS = 100
 
 # When agent sends VPD 0x80 and 0x83 serial numbers, which do we prefer to use
 # for the canonical device serial on the manager?  Favorite first.
@@ -264,6 +285,14 @@ NTP_SERVER_HOSTNAME = None
 # check if clocks are 'reasonably' in sync
 AGENT_CLOCK_TOLERANCE = 20
 
+# Limits on messages waiting in http_agent to be sent to each server.  Beyond HTTP_AGENT_TX_QUEUE_LIMIT DATA
+# messages, either the oldest queued ('drop_oldest') or the new ('drop_newest') message is discarded and its
+# session reset.  Each GET response to an agent holds up to HTTP_AGENT_MAX_BYTES_PER_GET of messages, like
+# the agent's MAX_BYTES_PER_POST.
+HTTP_AGENT_TX_QUEUE_LIMIT = 10000
+HTTP_AGENT_TX_QUEUE_OVERFLOW = 'drop_oldest'
+HTTP_AGENT_MAX_BYTES_PER_GET = 8 * 1024 ** 2
+
 # Set to False to require logins even for read-only access
 # to chroma_api
 ALLOW_ANONYMOUS_READ = True
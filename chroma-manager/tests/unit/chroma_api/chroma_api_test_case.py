@@ -72,6 +72,20 @@ class ChromaApiTestCase(ResourceTestCase):
         self.old_get_locks = job_scheduler_client.JobSchedulerClient.get_locks
         job_scheduler_client.JobSchedulerClient.get_locks = fake_get_locks
 
+        #  The API fetches all of the above in one call, so compose it from
+        #  the fakes, which tests may redefine.
+        @classmethod
+        def fake_object_state_summary(cls, object_list):
+            transitions = cls.available_transitions(object_list)
+            jobs = cls.available_jobs(object_list)
+            return dict((str(obj_id), {'transitions': transitions[str(obj_id)],
+                                       'jobs': jobs[str(obj_id)],
+                                       'locks': cls.get_locks(obj_ct, obj_id)})
+                        for obj_ct, obj_id in object_list)
+
+        self.old_object_state_summary = job_scheduler_client.JobSchedulerClient.object_state_summary
+        job_scheduler_client.JobSchedulerClient.object_state_summary = fake_object_state_summary
+
     def tearDown(self):
         from chroma_api.authentication import CsrfAuthentication
         CsrfAuthentication.is_authenticated = self.old_is_authenticated
@@ -80,6 +94,8 @@ class ChromaApiTestCase(ResourceTestCase):
         from chroma_core.services.job_scheduler import job_scheduler_client
         job_scheduler_client.JobSchedulerClient.available_transitions = self.old_available_transitions
         job_scheduler_client.JobSchedulerClient.available_jobs = self.old_available_jobs
+        job_scheduler_client.JobSchedulerClient.get_locks = self.old_get_locks
+        job_scheduler_client.JobSchedulerClient.object_state_summary = self.old_object_state_summary
 
         ObjectCache.clear()
 
@@ -17,6 +17,16 @@ class TestFilesystemResource(ChromaApiTestCase):
         self.create_simple_filesystem(self.host)
         self.spider_api()
 
+    def test_nested_locks(self):
+        """Test that targets nested in a filesystem have their locks filled in"""
+        self.create_simple_filesystem(self.host)
+
+        response = self.api_client.get("/api/filesystem/")
+        self.assertHttpOK(response)
+        filesystem = self.deserialize(response)['objects'][0]
+        for target in [filesystem['mgt']] + filesystem['mdts']:
+            self.assertEqual(target['locks'], {'read': [1, 2], 'write': [3, 4]})
+
     def test_HYD1483(self):
         """Test that adding a second MGS to a host emits a useful error."""
         mgt, _ = ManagedMgs.create_for_volume(synthetic_volume_full(self.host).id, name = "MGS")
@@ -1,12 +1,15 @@
 import os
 import json
+import time
 import collections
 import operator
 
 from chroma_core.lib.cache import ObjectCache
 from chroma_core.lib import metrics
 from chroma_core.models import ManagedTarget, ManagedTargetMount, ManagedMgs, ManagedMdt, ManagedOst, ManagedFilesystem
-from chroma_core.models import Stats
+from chroma_core.models import Series, Stats
+from chroma_core.chroma_common.lib.date_time import IMLDateTime
+from chroma_api.utils import MetricResource
 from .chroma_api_test_case import ChromaApiTestCase
 from tests.unit.chroma_core.helpers import synthetic_host, synthetic_volume_full
 
@@ -137,3 +140,97 @@ class TestStats(ChromaApiTestCase):
         for data, in content.values():
             prefixes = set(name.split('_')[0] for name in data['data'])
             self.assertEqual(prefixes, set(['mem', 'cpu']))
+
+    def test_reduce_many(self):
+        "Test reducing in the database matches reducing fetched series."
+        begin, end = IMLDateTime.parse('2013-04-19T20:33:00Z'), IMLDateTime.parse('2013-04-19T20:34:30Z')
+        names = ['kbytesfree', 'stats_read_bytes', 'stats_write_bytes']
+        for reduce_fn in ('sum', 'average'):
+            results = metrics.MetricStore.fetch_many(self.osts, names, begin, end)
+            expected = MetricResource()._reduce(names, results, reduce_fn)
+            self.assertTrue(expected)
+            reduced = metrics.MetricStore.reduce_many({'osts': self.osts}, names, begin, end, reduce_fn)
+            self.assertEqual(sorted(reduced['osts']), sorted(expected))
+            for dt in expected:
+                for name in names:
+                    self.assertAlmostEqual(reduced['osts'][dt][name], expected[dt][name])
+
+    def test_filesystem_totals(self):
+        "Test filesystem totals are stored as series of the filesystem."
+        names = ['kbytesfree', 'kbytestotal']
+        dt, expected = self.fs.metrics.fetch_last(ManagedOst, names)
+        Stats.insert(self.fs.metrics.serialize(time.time()))
+        latest, data = self.fs.metrics.fetch_last(ManagedOst, names)
+        self.assertEqual(data, expected)
+        self.assertGreater(latest, dt)
+        self.assertTrue(set(['ost_kbytesfree', 'ost_kbytestotal', 'mdt_filesfree']) <= metrics.MetricStore(self.fs).names)
+        content, = self.fetch('filesystem/{0}/metric/'.format(self.fs.id), metrics='ost_kbytesfree', latest='true')
+        self.assertEqual(content['data'], {'ost_kbytesfree': expected['kbytesfree']})
+
+    def test_filesystem_membership(self):
+        "Test filesystem totals wait for every mounted target, and follow targets joining and leaving."
+        store = metrics.FilesystemMetricStore
+        store.targets.clear()
+        store.counters.clear()
+        ManagedTarget.objects.filter(id__in=[self.mdt.id] + [ost.id for ost in self.osts]).update(state='mounted')
+
+        def record(target, read_bytes, kbytesfree):
+            store.record(target, {'stats_read_bytes': {'value': read_bytes, 'type': 'Counter'},
+                                  'kbytesfree': {'value': kbytesfree, 'type': 'Gauge'}})
+
+        def totals():
+            samples = self.fs.metrics.serialize()
+            return dict((Series.objects.get(id=id).name, value) for id, dt, value in samples)
+
+        record(self.osts[0], 100, 10)
+        record(self.mdt, 0, 1)
+        self.assertEqual(totals(), {})
+        record(self.osts[1], 1000, 20)
+        self.assertEqual(totals(), {'ost_stats_read_bytes': 1100, 'ost_kbytesfree': 30, 'mdt_stats_read_bytes': 0, 'mdt_kbytesfree': 1})
+        record(self.osts[0], 150, 5)
+        self.assertEqual(totals()['ost_stats_read_bytes'], 1150)
+
+        # a new target's counter only adds what it has counted since it first reported
+        ost = ManagedOst.create_for_volume(synthetic_volume_full(self.hosts[1]).id, filesystem=self.fs)[0]
+        ManagedTarget.objects.filter(id=ost.id).update(state='mounted')
+        self.assertEqual(totals(), {})
+        record(ost, 5000, 40)
+        self.assertEqual(totals(), {'ost_stats_read_bytes': 1150, 'ost_kbytesfree': 65, 'mdt_stats_read_bytes': 0, 'mdt_kbytesfree': 1})
+        record(ost, 5010, 40)
+        self.assertEqual(totals()['ost_stats_read_bytes'], 1160)
+
+        # a removed target is forgotten, and takes nothing from the counter total
+        ManagedTarget.objects.filter(id=ost.id).update(not_deleted=None)
+        self.assertEqual(totals(), {'ost_stats_read_bytes': 1160, 'ost_kbytesfree': 25, 'mdt_stats_read_bytes': 0, 'mdt_kbytesfree': 1})
+        self.assertNotIn(ost.id, store.targets)
+
+    def test_filesystem_restart(self):
+        "Test counter totals carry on from the stored totals when the recorded values are lost."
+        store = metrics.FilesystemMetricStore
+        store.targets.clear()
+        store.counters.clear()
+        ManagedTarget.objects.filter(id__in=[self.mdt.id] + [ost.id for ost in self.osts]).update(state='mounted')
+        timestamp = int(time.time()) // 10 * 10
+
+        def record(*read_bytes):
+            for target, value in zip(self.osts + [self.mdt], read_bytes + (0,)):
+                store.record(target, {'stats_read_bytes': {'value': value, 'type': 'Counter'}})
+
+        def total(offset):
+            samples = self.fs.metrics.serialize(timestamp + offset)
+            Stats.insert(samples)
+            value, = [value for id, dt, value in samples if Series.objects.get(id=id).name == 'ost_stats_read_bytes']
+            return value
+
+        record(100, 1000)
+        self.assertEqual(total(10), 1100)
+        record(150, 1000)
+        self.assertEqual(total(20), 1150)
+
+        # restart, during which the second OST's counter was reset
+        store.targets.clear()
+        store.counters.clear()
+        record(160, 5)
+        self.assertEqual(total(30), 1150)
+        record(170, 15)
+        self.assertEqual(total(40), 1170)
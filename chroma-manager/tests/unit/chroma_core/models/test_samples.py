@@ -11,11 +11,7 @@ from django.utils.unittest import skipIf
 
 from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
 from chroma_core.models import Point, Stats
-from chroma_core.models.stats import total_seconds
-from chroma_core.lib.util import chroma_settings
-
-
-settings = chroma_settings()
+from chroma_core.models.stats import total_seconds, Cache, Rollup
 
 
 id = 0
@@ -58,13 +54,11 @@ class TestModels(IMLUnitTestCase):
         Stats.delete_all()
         connection.use_debug_cursor = True
         connection.cursor().execute('SET enable_seqscan = off')
-        self.preserve_stats_wipe = settings.STATS_SIMPLE_WIPE
 
     def tearDown(self):
         connection.cursor().execute('SET enable_seqscan = on')
         connection.use_debug_cursor = False
         Stats.delete_all()
-        settings.STATS_SIMPLE_WIPE = self.preserve_stats_wipe
 
     def test_point(self):
         self.assertEqual(Point(now, 0.0, 0).mean, 0)
@@ -78,6 +72,43 @@ class TestModels(IMLUnitTestCase):
         self.assertEqual(point, (points[1].dt, 1.0, 10))
         self.assertEqual(point.mean, 0.1)
 
+    def test_cache(self):
+        cache = Cache(list, size=2)
+        cache[0].append(0)
+        cache[1]
+        self.assertEqual(cache[0], [0])
+        cache[2]
+        self.assertEqual(sorted(cache), [0, 2])
+        self.assertEqual(cache.info(), {'size': 2, 'capacity': 2, 'hits': 1, 'misses': 3, 'evictions': 1})
+        cache = Cache(size=1)
+        with self.assertRaises(KeyError):
+            cache[0]
+        cache[0] = cache[1] = None
+        self.assertEqual(cache.info(), {'size': 1, 'capacity': 1, 'hits': 0, 'misses': 1, 'evictions': 1})
+
+    def test_cache_methods(self):
+        "Test dict methods keep the cache's recency order and bound."
+        cache = Cache(size=2)
+        cache.update({0: 'a'}, b=1)
+        self.assertEqual(cache.setdefault(0), 'a')
+        self.assertEqual(cache.get('c', 2), 2)
+        cache[2] = None  # evicts 'b', which is least recently used
+        self.assertEqual(sorted(cache), [0, 2])
+        self.assertEqual(cache.pop(0), 'a')
+        self.assertEqual(cache.pop(0, None), None)
+        self.assertEqual(cache.setdefault(3, 'd'), 'd')
+        self.assertEqual(cache.popitem(), (2, None))
+        self.assertEqual(dict(cache), {3: 'd'})
+        self.assertEqual(list(cache.order), [3])
+
+    def test_rollup(self):
+        rollup = Rollup()
+        columns = rollup.columns({id: points, id + 1: points[::2]})
+        for model in Stats:
+            result = rollup.reduce(model.step, columns)
+            self.assertListEqual(result[id], list(model.reduce(points)))
+            self.assertListEqual(result[id + 1], list(model.reduce(points[::2])))
+
     def test_sample_select(self):
         model = Stats[0]
         with assertQueries('SELECT', 'SELECT', 'SELECT'):
@@ -87,75 +118,18 @@ class TestModels(IMLUnitTestCase):
         self.assertEqual(point.timestamp, 0)
         self.assertEqual(point.dt - start, model.expiration_time)
 
-    def test_sample_expire(self):
+    def test_retain(self):
         model = Stats[0]
-        settings.STATS_SIMPLE_WIPE = False
-
-        model.objects.all().delete()
-
-        with assertQueries('INSERT', 'SELECT'):
-            model.insert({id: points})
-            point = model.latest(id)
-            model.cache.clear()
-            self.assertEqual(point, model.latest(id))
-        self.assertEqual(point, points[-1])
-        floor = model.floor(point.dt)
-        self.assertLessEqual(floor, point.dt)
-        self.assertEqual(floor.microsecond, 0)
-
-        with assertQueries('SELECT', 'DELETE', 'SELECT'):
-            model.expire([id])
-            self.assertListEqual(list(model.select(id)), points)
-
-        self.assertEqual(len(list(model.reduce(points))), len(points))
-        self.assertLess(len(list(Stats[1].reduce(points))), len(points))
-
-        with assertQueries('DELETE'):
-            model.delete(id=id)
-        self.assertListEqual(list(model.select(id)), [])
-        self.assertTrue(Stats[-1].start(id))
-
-    def test_sample_simple_wipe(self):
-        model = Stats[0]
-        settings.STATS_SIMPLE_WIPE = True
-
-        model.objects.all().delete()
-
-        with assertQueries('INSERT', 'SELECT'):
-            model.insert({id: points})
-            point = model.latest(id)
-            model.cache.clear()
-            self.assertEqual(point, model.latest(id))
-        self.assertEqual(point, points[-1])
-        floor = model.floor(point.dt)
-        self.assertLessEqual(floor, point.dt)
-        self.assertEqual(floor.microsecond, 0)
-
-        # Check it tries to expire something
-        model.next_flush_orphans_time = epoch
-        with assertQueries('DELETE', 'SELECT'):
-            model.expire([id])
-            self.assertListEqual(list(model.select(id)), points)
-
-        # Now it should not expire because time has not passed.
+        model.insert({id: [Point(epoch, 1.0, 1), Point(epoch + timedelta(seconds=10), 1.0, 1)] + points})
+        for sample in Stats:
+            sample.next_flush_orphans_time = epoch
+        self.assertEqual(Stats.retain(now, 1, chunks=1), 1)
+        self.assertEqual(Stats.next_retention(), epoch)
+        self.assertEqual(Stats.retain(now, 1), 1)
+        self.assertListEqual(list(model.select(id)), points)
+        self.assertGreater(Stats.next_retention(), now)
         with assertQueries():
-            model.expire([id])
-
-        self.assertEqual(len(list(model.reduce(points))), len(points))
-        self.assertLess(len(list(Stats[1].reduce(points))), len(points))
-
-        # Insert and old record, and check it is deleted.
-        model.insert({id: [Point(epoch, 1, 1)]})
-        model.next_flush_orphans_time = epoch
-        self.assertListEqual(list(model.select(id)), [Point(epoch, 1, 1)] + points)
-        with assertQueries('DELETE', 'SELECT'):
-            model.expire([id])
-            self.assertListEqual(list(model.select(id)), points)
-
-        with assertQueries('DELETE'):
-            model.delete(id=id)
-        self.assertListEqual(list(model.select(id)), [])
-        self.assertTrue(Stats[-1].start(id))
+            self.assertEqual(Stats.retain(now, 1), 0)
 
     def test_stats(self):
         outdated = Stats.insert((id, point.dt, point.sum) for point in points)
@@ -195,6 +169,11 @@ class TestModels(IMLUnitTestCase):
             self.assertEqual(sum(point.len for point in selection), 6)
 
         self.assertEqual(selection[0].len, 0)
+        for kwargs in ({}, {'rate': True}, {'maxlen': 100}, {'fixed': 3}):
+            start, stop = point.dt - timedelta(hours=1), point.dt
+            selection = Stats.select_many([id, id + 1], start, stop, **kwargs)
+            self.assertListEqual(selection[id], list(Stats.select(id, start, stop, **kwargs)))
+            self.assertEqual(len(selection[id + 1]), kwargs.get('fixed', 0))
         point, = Stats.select(id, now, now + timedelta(seconds=5), fixed=1)
         with assertQueries(*['DELETE'] * 5):
             Stats.delete(id)
@@ -206,13 +185,11 @@ class TestModels(IMLUnitTestCase):
 class TestMonsterData(IMLUnitTestCase):
     def setUp(self):
         Stats.delete_all()
-        self.preserve_stats_wipe = settings.STATS_SIMPLE_WIPE
 
     def tearDown(self):
         Stats.delete_all()
-        settings.STATS_SIMPLE_WIPE = self.preserve_stats_wipe
 
-    def _test_monster_data(self, simple_wipe, ids_to_create = 500, job_stats_to_create = 50, days = 365 * 10):
+    def _test_monster_data(self, ids_to_create = 500, job_stats_to_create = 50, days = 365 * 10):
         '''
         Push 10 years worth of data through that stats system for 550 (50 of which are jobstats) ids.
         '''
@@ -220,7 +197,6 @@ class TestMonsterData(IMLUnitTestCase):
         date = start_time = datetime.now(utc)
         end_date = now + timedelta(days=days)
 
-        settings.STATS_SIMPLE_WIPE = simple_wipe
         first_job_stat = ids_to_create + 1
         iterations_completed = 0
 
@@ -236,6 +212,7 @@ class TestMonsterData(IMLUnitTestCase):
 
                 dt.now.return_value = date
                 Stats.insert(data)
+                Stats.retain(date, 10000)
 
                 date += timedelta(seconds=10)
                 first_job_stat += 1
@@ -243,20 +220,13 @@ class TestMonsterData(IMLUnitTestCase):
 
         end_time = datetime.now(utc)
 
-        print "Time to run test_monster_data %s, time per 10 second step %s, wipe=%s" % (end_time - start_time,
-                                                                                         (end_time - start_time) / iterations_completed,
-                                                                                         settings.STATS_SIMPLE_WIPE)
-
-        # This test fails if we are not using SIMPLE_WIPE and we have job_stats, so don't run the test
-        # in that case.
-        if settings.STATS_SIMPLE_WIPE or job_stats_to_create == 0:
-            for stat in Stats:
-                actual_records = stat.objects.count()
-                max_expected_records = ids_to_create * total_seconds(stat.expiration_time + stat.flush_orphans_interval) / stat.step
-                self.assertLess(actual_records, max_expected_records)
+        print "Time to run test_monster_data %s, time per 10 second step %s" % (end_time - start_time,
+                                                                               (end_time - start_time) / iterations_completed)
 
-    def test_monster_data_simple_wipe(self):
-        self._test_monster_data(True, 20, 20, 2)
+        for stat in Stats:
+            actual_records = stat.objects.count()
+            max_expected_records = ids_to_create * total_seconds(stat.expiration_time + stat.flush_orphans_interval) / stat.step
+            self.assertLess(actual_records, max_expected_records)
 
-    def test_monster_data_selective_wipe(self):
-        self._test_monster_data(False, 20, 20, 2)
+    def test_monster_data(self):
+        self._test_monster_data(20, 20, 2)
@@ -42,6 +42,17 @@ class TestSeries(IMLUnitTestCase):
             self.assertEqual(series, Series.get(self.obj, field))
         self.assertFalse(Series.cache)
 
+    def test_get_many(self):
+        types = dict(field[:2] for field in fields)
+        series = Series.get_many(self.obj, types)
+        self.assertEqual(sorted(series), sorted(types))
+        Series.forget(self.obj)
+        self.assertFalse(set(Series.cache.values()) & set(series.values()))
+        with self.assertNumQueries(1):
+            self.assertEqual(Series.get_many(self.obj, types), series)
+        with self.assertRaises(Series.DoesNotExist):
+            Series.get(self.obj, 'missing')
+
     def test_fast(self):
         "Small data set with short intervals."
         for data in zip(*[gen_series(5, 100)] * 10):
@@ -79,6 +90,8 @@ class TestSeries(IMLUnitTestCase):
             else:
                 self.assertGreaterEqual(data[name], -delta)
                 self.assertLessEqual(data[name], delta)
+        # verify bulk fetching matches fetching a single object
+        self.assertEqual(metrics.MetricStore.fetch_many([self.obj], names, epoch, epoch + timedelta(seconds=20)), {self.obj.id: stats})
         # verify update queries would aggregate to the same result
         stats = self.store.fetch(names, epoch, epoch + timedelta(seconds=40))
         for delta in (0, 10, 20):
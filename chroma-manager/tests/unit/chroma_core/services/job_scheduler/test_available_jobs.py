@@ -177,6 +177,30 @@ class TestAvailableJobs(IMLUnitTestCase):
         self.assertFalse(locks['read'])
         self.assertEqual(2, len(locks['write']))
 
+    def test_object_state_summary(self):
+        """The summary matches available_transitions, available_jobs and get_locks"""
+
+        js = JobScheduler()
+        self._fake_add_lock(js, self.host.lnet_configuration, 'lnet_up')
+
+        object_list = [(ContentType.objects.get_for_model(obj.downcast()).natural_key(), obj.id)
+                       for obj in [self.host, self.host.lnet_configuration, self.mgs, self.mdt, self.ost]]
+        object_list.append((ContentType.objects.get_for_model(ManagedOst).natural_key(), 0))
+
+        summary = js.object_state_summary(object_list)
+        transitions = js.available_transitions(object_list)
+        jobs = js.available_jobs(object_list)
+
+        self.assertEqual(len(summary), len(object_list))
+        for obj_key, obj_id in object_list:
+            self.assertEqual(summary[obj_id]['transitions'], transitions[obj_id])
+            self.assertEqual(summary[obj_id]['jobs'], jobs[obj_id])
+            self.assertEqual(summary[obj_id]['locks'], js.get_locks(obj_key, obj_id))
+
+        self.assertEqual(2, len(summary[self.host.lnet_configuration.id]['locks']['write']))
+        self.assertFalse(summary[self.host.lnet_configuration.id]['transitions'])
+        self.assertTrue(summary[self.host.id]['jobs'])
+
     def test_managed_host_undeployed(self):
         """Test that an undeployed host can only be force removed"""
 
@@ -154,6 +154,20 @@ class TestAvailableTransitions(IMLUnitTestCase):
             received_transitions = [t['state'] for t in self._get_transition_states(self.host.lnet_configuration)]
             self.assertEqual(set(received_transitions), set(expected_transitions))
 
+    def test_advertised_transitions(self):
+        """The per class table advertises the same transitions as the verbs of the available states"""
+
+        mgs = ManagedMgs.objects.create(volume=self.volume)
+        fs = ManagedFilesystem.objects.create(name='mgsfs', mgs=mgs)
+        ost = ManagedOst.objects.create(volume=self.volume, filesystem=fs, index=1)
+
+        for stateful_object in [mgs, fs, ost, self.host, self.host.lnet_configuration]:
+            for state in stateful_object.states:
+                stateful_object.state = state
+                expected = self.js._add_verbs(stateful_object, stateful_object.get_available_states(state))
+                received = self.js._advertised_transitions(stateful_object)
+                self.assertEqual(sorted(received), sorted(expected))
+
     def test_no_locks_query_count(self):
         """Check that query count to pull in available jobs hasn't changed
 
@@ -0,0 +1,53 @@
+import json
+import zlib
+
+from django.test.client import RequestFactory
+
+from chroma_agent_comms.views import decode_body, encoded_response
+from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TestCompression(IMLUnitTestCase):
+    """Message bodies are compressed according to what the agent sends and accepts"""
+
+    def setUp(self):
+        super(TestCompression, self).setUp()
+
+        self.factory = RequestFactory()
+        self.content = json.dumps({'messages': [{'type': 'DATA', 'body': 'x' * 4096}]})
+
+    def test_decode_body(self):
+        request = self.factory.post('/agent/message/', data = gzip_compress(self.content), content_type = 'application/json',
+                                    HTTP_CONTENT_ENCODING = 'gzip')
+        self.assertEqual(decode_body(request, len(self.content)), self.content)
+        self.assertRaises(ValueError, decode_body, request, len(self.content) - 1)
+
+        request = self.factory.post('/agent/message/', data = zlib.compress(self.content), content_type = 'application/json',
+                                    HTTP_CONTENT_ENCODING = 'deflate')
+        self.assertEqual(decode_body(request, len(self.content)), self.content)
+
+        request = self.factory.post('/agent/message/', data = self.content, content_type = 'application/json')
+        self.assertEqual(decode_body(request, len(self.content)), self.content)
+
+        request = self.factory.post('/agent/message/', data = self.content, content_type = 'application/json',
+                                    HTTP_CONTENT_ENCODING = 'br')
+        self.assertRaises(ValueError, decode_body, request, len(self.content))
+
+    def test_encoded_response(self):
+        response = encoded_response(self.factory.get('/agent/message/', HTTP_ACCEPT_ENCODING = 'gzip, deflate'), self.content)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(response.content, 16 + zlib.MAX_WBITS), self.content)
+        self.assertIn('gzip', response['Accept-Encoding'])
+
+        response = encoded_response(self.factory.get('/agent/message/'), self.content)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, self.content)
+
+        # Small responses are not worth compressing
+        response = encoded_response(self.factory.get('/agent/message/', HTTP_ACCEPT_ENCODING = 'gzip'), '{"messages": []}')
+        self.assertFalse(response.has_header('Content-Encoding'))
@@ -0,0 +1,54 @@
+import Queue
+
+import mock
+
+from chroma_core.services.http_agent.queues import HostQueueCollection
+from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
+
+
+class TestTxQueue(IMLUnitTestCase):
+    def setUp(self):
+        super(TestTxQueue, self).setUp()
+
+        self.overflows = []
+        self.queues = HostQueueCollection(overflow_callback = lambda *args: self.overflows.append(args))
+
+    def _message(self, session_id, type = 'DATA'):
+        return {'fqdn': 'myserver', 'type': type, 'plugin': 'action_runner', 'session_id': session_id}
+
+    def _drain(self):
+        tx = self.queues.get('myserver').tx
+        messages = []
+        while True:
+            try:
+                messages.append(tx.get(block = False)['session_id'])
+            except Queue.Empty:
+                return messages
+
+    @mock.patch('settings.HTTP_AGENT_TX_QUEUE_LIMIT', 2)
+    def test_drop_oldest(self):
+        for session_id in ['a', 'b']:
+            self.queues.send(self._message(session_id))
+        self.queues.send(self._message('terminate', type = 'SESSION_TERMINATE'))
+        self.queues.send(self._message('c'))
+
+        self.assertEqual(self._drain(), ['b', 'terminate', 'c'])
+        self.assertEqual(self.overflows, [('myserver', 'action_runner', 'a')])
+        self.assertEqual(self.queues.stats()['myserver'], {'depth': 0, 'data_depth': 0, 'max_depth': 3, 'dropped': 1})
+
+    @mock.patch('settings.HTTP_AGENT_TX_QUEUE_LIMIT', 2)
+    @mock.patch('settings.HTTP_AGENT_TX_QUEUE_OVERFLOW', 'drop_newest')
+    def test_drop_newest(self):
+        for session_id in ['a', 'b', 'c']:
+            self.queues.send(self._message(session_id))
+
+        self.assertEqual(self.overflows, [('myserver', 'action_runner', 'c')])
+
+        # A message returned to the head of the queue is next out, and counts against the limit
+        tx = self.queues.get('myserver').tx
+        tx.put_front(tx.get())
+        self.queues.send(self._message('d'))
+        self.assertEqual(self._drain(), ['a', 'b'])
+
+    def test_get_timeout(self):
+        self.assertRaises(Queue.Empty, self.queues.get('myserver').tx.get, block = True, timeout = 0.01)
@@ -0,0 +1,36 @@
+import mock
+
+from chroma_core.services.http_agent.sessions import SessionCollection
+from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
+
+
+class TestSessionCollection(IMLUnitTestCase):
+    def setUp(self):
+        super(TestSessionCollection, self).setUp()
+
+        self.queues = mock.Mock()
+        self.sessions = SessionCollection(self.queues)
+
+    def test_reset_replaced_session(self):
+        """A reset for a session which has been replaced leaves its successor alone"""
+        old_session = self.sessions.create('myserver', 'lustre')
+        new_session = self.sessions.create('myserver', 'lustre')
+
+        self.sessions.reset_session('myserver', 'lustre', old_session.id)
+        self.assertEqual(self.sessions.get('myserver', 'lustre'), new_session)
+        self.assertFalse(self.queues.send.called)
+
+        self.sessions.reset_session('myserver', 'lustre', new_session.id)
+        self.assertRaises(KeyError, self.sessions.get, 'myserver', 'lustre')
+        self.assertEqual(self.queues.send.call_args[0][0]['type'], 'SESSION_TERMINATE')
+
+    def test_remove_host(self):
+        """Removing a host ends its sessions, and tells services so"""
+        session = self.sessions.create('myserver', 'lustre')
+        self.sessions.create('otherserver', 'lustre')
+
+        self.sessions.remove_host('myserver')
+        self.assertRaises(KeyError, self.sessions.get, 'myserver', 'lustre')
+        self.sessions.get('otherserver', 'lustre')
+        self.assertEqual(self.queues.receive.call_args[0][0]['type'], 'SESSION_TERMINATE')
+        self.assertEqual(self.queues.receive.call_args[0][0]['session_id'], session.id)
@@ -0,0 +1,65 @@
+import json
+
+from chroma_core.models import Job
+from chroma_core.services.job_scheduler.job_scheduler import JobCollection
+from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
+
+
+class TestJobCollection(IMLUnitTestCase):
+    """Check that readiness is tracked as jobs complete, rather than by rescanning pending jobs"""
+
+    def _job(self, job_id, wait_for = (), state = 'pending'):
+        return Job(id = job_id, state = state, wait_for_json = json.dumps(list(wait_for)))
+
+    def test_ready_jobs(self):
+        collection = JobCollection()
+        first, second, third, fourth = self._job(1), self._job(2, [1]), self._job(3, [1, 2]), self._job(4, [1])
+        for job in [first, second, third, fourth]:
+            collection.add(job)
+
+        self.assertEqual(collection.ready_jobs, [first])
+
+        collection.update_many([first], 'tasked')
+        self.assertEqual(collection.ready_jobs, [])
+
+        collection.update(first, 'complete')
+        self.assertEqual(collection.ready_jobs, [second, fourth])
+
+        # Cancelling a pending job makes its waiters ready, just like completing it
+        collection.update(second, 'complete', cancelled = True)
+        self.assertEqual(collection.ready_jobs, [third, fourth])
+
+        collection.update_many([third, fourth], 'tasked')
+        collection.update(third, 'complete')
+        collection.update(fourth, 'complete')
+        self.assertEqual(collection.ready_jobs, [])
+        self.assertEqual(collection.pending_jobs, [])
+
+    def test_wait_for_complete(self):
+        "A job which only waits for already complete jobs is ready as soon as it is added"
+        collection = JobCollection()
+        collection.add(self._job(1, state = 'complete'))
+        collection.add(self._job(2, state = 'tasked'))
+        waiting = self._job(3, [1, 2])
+        collection.add(waiting)
+        ready = self._job(4, [1])
+        collection.add(ready)
+
+        self.assertEqual(collection.ready_jobs, [ready])
+
+        collection.update(collection.get(2), 'complete')
+        self.assertEqual(collection.ready_jobs, [waiting, ready])
+
+    def test_cancel_waiter(self):
+        "A pending job cancelled while it waits is forgotten by the job it waited for"
+        collection = JobCollection()
+        running, waiter, other = self._job(1, state = 'tasked'), self._job(2, [1]), self._job(3, [1])
+        for job in [running, waiter, other]:
+            collection.add(job)
+
+        collection.update(waiter, 'complete', cancelled = True)
+        collection.update(running, 'complete')
+
+        self.assertEqual(collection.ready_jobs, [other])
+        self.assertEqual(collection.pending_jobs, [other])
+
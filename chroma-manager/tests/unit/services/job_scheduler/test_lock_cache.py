@@ -0,0 +1,70 @@
+import mock
+
+from chroma_core.models import StateLock
+from chroma_core.services.job_scheduler.lock_cache import LockCache
+from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
+
+
+class FakeJob(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class TestLockCache(IMLUnitTestCase):
+    """Check LockCache lookups and removals.
+
+    Jobs and locked items are stand-ins, and the lock change receivers are disabled.
+    The cost of the cache as the number of locks grows is measured by the
+    benchlockcache management command.
+    """
+
+    ITEMS = 10
+
+    def setUp(self):
+        super(TestLockCache, self).setUp()
+
+        patcher = mock.patch.object(LockCache, 'lock_change_receivers', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _locks(self, count):
+        # Like a bulk start: each job reads one of a few items and writes one of the others
+        locks = []
+        for job_id in xrange(1, count / 2 + 1):
+            job = FakeJob(job_id)
+            locks.append(StateLock(job, 'item%d' % (job_id % self.ITEMS), False))
+            locks.append(StateLock(job, 'item%d' % ((job_id + 1) % self.ITEMS), True, 'a', 'b'))
+        return locks
+
+    def test_lookups(self):
+        lock_cache = LockCache()
+        locks = self._locks(6 * self.ITEMS)
+        for lock in locks:
+            lock_cache.add(lock)
+
+        write_locks = [lock for lock in locks if lock.write and lock.locked_item == 'item1']
+        read_locks = [lock for lock in locks if not lock.write and lock.locked_item == 'item1']
+        self.assertEqual(lock_cache.get_latest_write('item1'), write_locks[-1])
+        self.assertEqual(lock_cache.get_latest_write('item1', not_job = write_locks[-1].job), write_locks[-2])
+        self.assertEqual(lock_cache.get_read_locks('item1', after = read_locks[1].job.id, not_job = None), read_locks[1:])
+        self.assertEqual(lock_cache.get_write_by_locked_item()['item1'], write_locks[-1])
+        self.assertEqual(lock_cache.get_latest_write('missing'), None)
+
+        self.assertEqual(lock_cache.remove_job(write_locks[-1].job), 2)
+        self.assertEqual(lock_cache.get_latest_write('item1'), write_locks[-2])
+        self.assertEqual(lock_cache.get_by_job(write_locks[-1].job), [])
+
+    def test_remove_all(self):
+        """Removing every job leaves nothing behind, as CommandPlan would see it"""
+        lock_cache = LockCache()
+        locks = self._locks(1000)
+        for lock in locks:
+            lock_cache.get_latest_write(lock.locked_item, not_job = lock.job)
+            lock_cache.get_read_locks(lock.locked_item, after = lock.job.id - self.ITEMS, not_job = lock.job)
+            lock_cache.add(lock)
+        self.assertEqual(len(lock_cache.get_write_by_locked_item()), self.ITEMS)
+
+        for lock in locks[::2]:
+            lock_cache.remove_job(lock.job)
+        self.assertFalse(lock_cache.write_by_item)
+        self.assertFalse(lock_cache.all_by_item)
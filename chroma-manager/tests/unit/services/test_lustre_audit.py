@@ -1,3 +1,4 @@
+import copy
 import mock
 
 from chroma_core.services.job_scheduler import job_scheduler_notify
@@ -6,6 +7,7 @@ from tests.unit.chroma_core.helpers import load_default_profile
 from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
 from chroma_core.models import Package, PackageVersion, PackageAvailability
 from chroma_core.services.lustre_audit import UpdateScan
+from chroma_core.services.lustre_audit.update_scan import ScanBaselines
 from chroma_core.models.package import PackageInstallation
 from tests.chroma_common.lib.date_time import IMLDateTime
 
@@ -162,3 +164,80 @@ class TestAudit(IMLUnitTestCase):
         self.assertEqual(update_scan.host.properties, '{}')
         update_scan.update_properties(None)
         update_scan.update_properties({'key': 'value'})
+
+
+class TestScanBaselines(IMLUnitTestCase):
+    scan = {
+        'started_at': '2017-01-01T00:00:00Z',
+        'agent_version': '4.0',
+        'capabilities': [],
+        'metrics': {'raw': {'node': {'meminfo': {'MemFree': 100, 'MemTotal': 200}}}},
+        'properties': {},
+        'mounts': [],
+        'packages': {'agent': {}},
+        'resource_locations': {'MGS': 'test1'}
+    }
+
+    def setUp(self):
+        super(TestScanBaselines, self).setUp()
+
+        self.baselines = ScanBaselines()
+        self.assertEqual(self.baselines.apply('test1', 'abc', dict(copy.deepcopy(self.scan), version = 1)), self.scan)
+
+    def _patch(self, patch, session_id = 'abc', version = 2):
+        return self.baselines.apply('test1', session_id, {
+            'started_at': '2017-01-01T00:00:10Z',
+            'version': version,
+            'base_version': version - 1,
+            'patch': patch
+        })
+
+    def test_patch(self):
+        """Patches apply to the previous scan, and the fields which they do not change are
+        passed on as None, as UpdateScan expects"""
+        data = self._patch({
+            'set': {'packages': None},
+            'patch': {'metrics': {'patch': {'raw': {'patch': {'node': {'patch': {'meminfo': {'set': {'MemFree': 90}}}}}}}}}
+        })
+        self.assertEqual(data['started_at'], '2017-01-01T00:00:10Z')
+        self.assertEqual(data['metrics'], {'raw': {'node': {'meminfo': {'MemFree': 90, 'MemTotal': 200}}}})
+        self.assertEqual(data['agent_version'], '4.0')
+        for field in ScanBaselines.unchanged_fields:
+            self.assertEqual(data[field], None)
+
+        data = self._patch({'patch': {'resource_locations': {'set': {'MGS': None}}}}, version = 3)
+        self.assertEqual(data['resource_locations'], {'MGS': None})
+        self.assertEqual(data['metrics']['raw']['node']['meminfo']['MemFree'], 90)
+
+    def test_resync(self):
+        """A patch which does not follow the last scan of the session is refused, and so are
+        any after it until a full scan arrives.  The session is reset once to get one."""
+        self.assertEqual(self._patch({}, version = 3), None)
+        self.assertTrue(self.baselines.resync('test1', 'abc'))
+        self.assertEqual(self._patch({}), None)
+        self.assertFalse(self.baselines.resync('test1', 'abc'))
+        self.assertEqual(self.baselines.apply('test2', 'abc', dict(self.scan, version = 1, base_version = 0, patch = {})), None)
+
+        self.baselines.apply('test1', 'def', dict(copy.deepcopy(self.scan), version = 1))
+        self.assertNotEqual(self._patch({}, session_id = 'def'), None)
+
+    def test_replaced_session(self):
+        """Patches left over from a session which has been replaced are dropped without
+        resetting the new session"""
+        self.baselines.apply('test1', 'def', dict(copy.deepcopy(self.scan), version = 1))
+        self.assertEqual(self._patch({}), None)
+        self.assertFalse(self.baselines.resync('test1', 'abc'))
+        self.assertNotEqual(self._patch({}, session_id = 'def'), None)
+
+    def test_remove(self):
+        """The baseline goes when its session ends, but not when an older one does"""
+        self.baselines.remove('test1', 'xyz')
+        self.assertNotEqual(self._patch({}), None)
+
+        self.baselines.remove('test1', 'abc')
+        self.assertEqual(self._patch({}, version = 3), None)
+        self.assertEqual(self.baselines._baselines, {})
+
+        self.baselines.apply('test1', 'def', dict(copy.deepcopy(self.scan), version = 1))
+        self.baselines.remove('test1')
+        self.assertEqual(self.baselines._baselines, {})
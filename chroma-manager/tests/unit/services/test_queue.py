@@ -0,0 +1,98 @@
+import socket
+
+import mock
+
+from chroma_core.services.queue import ServiceQueue, AgentRxQueue
+from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
+
+
+class FakeMessage(object):
+    def __init__(self, headers = None):
+        self.headers = headers or {}
+        self.acked = False
+
+    def ack(self):
+        self.acked = True
+
+
+class FakeConnection(object):
+    """Deliver each list of bodies in `deliveries` from one drain_events call,
+    timing out once they are used up."""
+
+    def __init__(self, deliveries, on_idle):
+        self.deliveries = list(deliveries)
+        self.on_idle = on_idle
+        self.timeouts = []
+        self.messages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def Consumer(self, queues, callbacks):
+        self.callbacks = callbacks
+        consumer = mock.MagicMock()
+        consumer.__enter__.return_value = consumer
+        return consumer
+
+    def drain_events(self, timeout):
+        self.timeouts.append(timeout)
+        if not self.deliveries:
+            self.on_idle()
+            raise socket.timeout()
+        for body, headers in self.deliveries.pop(0):
+            message = FakeMessage(headers)
+            self.messages.append(message)
+            for callback in self.callbacks:
+                callback(body, message)
+
+
+class TestServiceQueue(IMLUnitTestCase):
+    def _serve(self, queue, deliveries, **kwargs):
+        connection = FakeConnection(deliveries, queue._stopping.set)
+        with mock.patch('chroma_core.services.queue._amqp_connection', return_value = connection):
+            queue.serve(**kwargs)
+        self.assertTrue(all(message.acked for message in connection.messages))
+        return connection
+
+    def test_batches(self):
+        "Messages arriving together are passed on in batches of up to batch_size"
+        queue = ServiceQueue()
+        queue.name = 'test'
+        queue.batch_size = 3
+        batches = []
+
+        connection = self._serve(queue, [[(1, None)], [(2, None), (3, None)], [(4, None)], [(5, None)]],
+                                 batch_callback = batches.append)
+
+        self.assertEqual(batches, [[1, 2, 3], [4, 5]])
+        self.assertEqual(connection.timeouts, [queue.stop_check_interval, queue.batch_wait, queue.stop_check_interval,
+                                               queue.batch_wait, queue.batch_wait])
+
+    def test_wakeup(self):
+        "Only this queue's wakeup message is treated as one, and neither reaches the callback"
+        queue = ServiceQueue()
+        queue.name = 'test'
+        received = []
+
+        def callback(message):
+            received.append(message)
+            queue._stopping.set()
+
+        self._serve(queue, [[(None, {'wakeup': 'another'}), ('a', None), (None, {'wakeup': queue._wakeup_id})]],
+                    callback = callback)
+
+        self.assertEqual(received, ['a'])
+
+    def test_agent_rx_batches(self):
+        queue = AgentRxQueue('test')
+        batches = []
+        message = {'type': 'DATA', 'fqdn': 'myserver', 'body': 'x', 'plugin': 'test', 'session_id': 'abc'}
+
+        self._serve(queue, [[(message, None), (dict(message, type = 'SESSION_CREATE'), None), (message, None)]],
+                    data_batch_callback = batches.append)
+
+        self.assertEqual(batches, [[('myserver', 'x'), ('myserver', 'x')]])
+        self.assertRaises(AssertionError, queue.serve, data_callback = lambda fqdn, body: None, data_batch_callback = batches.append)
@@ -0,0 +1,76 @@
+import jsonschema
+import mock
+
+from chroma_core.services.rpc import RpcClientResponseHandler, RpcTimeout, REQUEST_VALIDATOR, RESPONSE_VALIDATOR
+from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
+
+
+class TestRpcClientResponseHandler(IMLUnitTestCase):
+    """Check response handling and timeouts, without starting the handler thread"""
+
+    def setUp(self):
+        super(TestRpcClientResponseHandler, self).setUp()
+
+        self.handler = RpcClientResponseHandler('test.responses')
+
+    def test_timeouts(self):
+        self.handler.start_wait('expired', -1)
+        self.handler.start_wait('answered', -1)
+        self.handler.start_wait('waiting', 300)
+
+        answered = self.handler._response_states['answered']
+        answered.result = {'request_id': 'answered', 'result': 1, 'exception': None}
+        answered.complete.set()
+
+        self.handler._age_response_states()
+
+        self.assertRaises(RpcTimeout, self.handler.complete_wait, 'expired')
+        self.assertEqual(self.handler.complete_wait('answered')['result'], 1)
+        self.assertFalse(self.handler._response_states['waiting'].complete.is_set())
+        self.assertEqual(self.handler._timeouts, [(self.handler._response_states['waiting'].timeout_at, 'waiting')])
+
+    def test_completed_entries_discarded(self):
+        "Timeouts of answered requests do not accumulate in the heap"
+        for i in range(1000):
+            request_id = str(i)
+            self.handler.start_wait(request_id, 300)
+            self.handler._response_states[request_id].complete.set()
+            self.handler.complete_wait(request_id)
+        self.handler.start_wait('waiting', 300)
+
+        self.handler._age_response_states()
+
+        self.assertEqual([request_id for timeout_at, request_id in self.handler._timeouts], ['waiting'])
+
+
+class TestMessageValidator(IMLUnitTestCase):
+    """The fast checks accept and refuse the same messages as jsonschema"""
+
+    request = {
+        'request_id': 'abc',
+        'method': 'get_locks',
+        'args': [],
+        'kwargs': {},
+        'response_routing_key': 'JobSchedulerRpc.responses'
+    }
+
+    def _check(self, validator, message, valid):
+        for full_validation in [False, True]:
+            with mock.patch('settings.RPC_FULL_VALIDATION', full_validation):
+                if valid:
+                    validator.validate(message)
+                else:
+                    self.assertRaises(jsonschema.ValidationError, validator.validate, message)
+
+    def test_request(self):
+        self._check(REQUEST_VALIDATOR, self.request, True)
+        self._check(REQUEST_VALIDATOR, dict(self.request, method = u'get_locks'), True)
+        self._check(REQUEST_VALIDATOR, dict(self.request, args = {}), False)
+        self._check(REQUEST_VALIDATOR, dict((k, v) for k, v in self.request.items() if k != 'response_routing_key'), False)
+        self._check(REQUEST_VALIDATOR, [self.request], False)
+
+    def test_response(self):
+        self._check(RESPONSE_VALIDATOR, {'request_id': 'abc', 'result': [1], 'exception': None}, True)
+        self._check(RESPONSE_VALIDATOR, {'request_id': 'abc', 'result': None, 'exception': 'Failed', 'traceback': None}, True)
+        self._check(RESPONSE_VALIDATOR, {'request_id': 'abc', 'exception': None}, False)
+        self._check(RESPONSE_VALIDATOR, {'request_id': 'abc', 'result': None, 'exception': 1}, False)
@@ -0,0 +1,54 @@
+import threading
+from datetime import datetime
+
+import mock
+from django.utils.timezone import utc
+
+from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
+from tests.utils import patch
+from chroma_core.services.stats import StatsBatcher, StatsQueue
+
+import settings
+
+
+class TestStatsBatcher(IMLUnitTestCase):
+    def setUp(self):
+        super(TestStatsBatcher, self).setUp()
+
+        self.insert = mock.Mock()
+        self.batcher = StatsBatcher(self.insert)
+
+    def _run_once(self):
+        thread = threading.Thread(target=self.batcher.run)
+        thread.start()
+        self.batcher.stop()
+        thread.join()
+
+    def test_coalesce(self):
+        "Messages are coalesced into one insert, without duplicate samples."
+        with patch(settings, STATS_BATCH_SIZE=10, STATS_BATCH_WINDOW=60):
+            self.batcher.put([(1, '2013-04-19T20:34:10+00:00', 1.0)])
+            self.batcher.put([(1, '2013-04-19T20:34:10+00:00', 1.0), (2, '2013-04-19T20:34:10+00:00', 2.0)])
+            self._run_once()
+        self.insert.assert_called_once_with([(1, '2013-04-19T20:34:10+00:00', 1.0), (2, '2013-04-19T20:34:10+00:00', 2.0)])
+
+    def test_shed(self):
+        "The oldest messages are shed when too many samples are pending."
+        with patch(settings, STATS_BATCH_SIZE=10, STATS_BATCH_WINDOW=60, STATS_MAX_PENDING_SAMPLES=2):
+            for id in range(3):
+                self.batcher.put([(id, '2013-04-19T20:34:10+00:00', 1.0)])
+            self.assertEqual(self.batcher.shed, 1)
+            self._run_once()
+        self.insert.assert_called_once_with([(1, '2013-04-19T20:34:10+00:00', 1.0), (2, '2013-04-19T20:34:10+00:00', 1.0)])
+
+
+class TestStatsQueue(IMLUnitTestCase):
+    def test_encoding(self):
+        "Samples are packed and unpacked intact, and JSON messages are still decoded."
+        now = datetime.now(utc)
+        samples = [(1, now, 1.5), (2, now, 2.0), (3, datetime.fromtimestamp(0, utc), -1.0)]
+        message = StatsQueue.encode(samples)
+        self.assertLess(len(message), len(repr([(id, str(dt), value) for id, dt, value in samples])))
+        self.assertEqual(StatsQueue.decode(message), samples)
+        self.assertEqual(StatsQueue.decode([(id, str(dt), value) for id, dt, value in samples]), samples)
+        self.assertEqual(StatsQueue.decode(StatsQueue.encode([])), [])
@@ -0,0 +1,48 @@
+import threading
+
+from chroma_core.services.worker_pool import WorkerPool
+from tests.unit.lib.iml_unit_test_case import IMLUnitTestCase
+
+
+class TestWorkerPool(IMLUnitTestCase):
+    def setUp(self):
+        super(TestWorkerPool, self).setUp()
+
+        self.pool = WorkerPool('test', 1, max_queued = 4)
+        self.gate = threading.Event()
+        self.order = []
+
+    def tearDown(self):
+        self.gate.set()
+        self.pool.stop()
+        self.pool.join()
+
+    def _task(self, key, index):
+        self.gate.wait()
+        self.order.append((key, index))
+
+    def test_fair_and_bounded(self):
+        "Keys are served in turn, and tasks beyond max_queued are refused"
+
+        # The first task occupies the only thread until the gate opens
+        self.assertTrue(self.pool.submit('a', self._task, 'a', 0))
+        while not self.pool.stats()['busy']:
+            pass
+
+        for index in range(1, 4):
+            self.assertTrue(self.pool.submit('a', self._task, 'a', index))
+        self.assertTrue(self.pool.submit('b', self._task, 'b', 0))
+        self.assertFalse(self.pool.submit('b', self._task, 'b', 1))
+
+        stats = self.pool.stats()
+        self.assertEqual((stats['threads'], stats['queued'], stats['rejected']), (1, 4, 1))
+
+        self.gate.set()
+        self.pool.stop()
+        self.pool.join()
+
+        self.assertEqual(self.order, [('a', 0), ('a', 1), ('b', 0), ('a', 2), ('a', 3)])
+        stats = self.pool.stats()
+        self.assertEqual((stats['queued'], stats['completed'], stats['max_queued']), (0, 5, 4))
+        self.assertGreater(stats['max_wait'], 0)
+        self.assertFalse(self.pool.submit('a', self._task, 'a', 4))